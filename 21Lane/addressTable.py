@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+# connections per client address, counted by all prefork workers together
+# in shared memory. The addresses themselves are kept, in an open
+# addressing table, so that two clients never share a count. Made before
+# the fork, used by every worker under the one lock of its counts.
+
+from zlib import crc32
+
+ADDRESS_SLOTS = 4096
+# bytes kept of an address: the longest IPv6 text, scope id included
+ADDRESS_SIZE = 64
+EMPTY = bytes(ADDRESS_SIZE)
+
+
+class AddressTable:
+    def __init__(self, context, slots=ADDRESS_SLOTS):
+        # a slot is never used while its key is EMPTY; one whose count
+        # fell to 0 keeps its key, searches go on past it
+        self.counts = context.Array('i', slots)
+        self.keys = context.Array('c', slots * ADDRESS_SIZE, lock=False)
+        self.slots = slots
+
+    def key(self, slot):
+        return self.keys[slot * ADDRESS_SIZE:(slot + 1) * ADDRESS_SIZE]
+
+    def setKey(self, slot, key):
+        self.keys[slot * ADDRESS_SIZE:(slot + 1) * ADDRESS_SIZE] = key
+
+    def add(self, address, limit):
+        # (whether address is at limit already, slot it is counted in); the
+        # slot is None when at the limit, or with no room left to count it
+        key = address.encode()[:ADDRESS_SIZE].ljust(ADDRESS_SIZE, b"\0")
+        start = crc32(key) % self.slots
+        with self.counts.get_lock():
+            free = None
+            for i in range(self.slots):
+                slot = (start + i) % self.slots
+                stored = self.key(slot)
+                if stored == key:
+                    break
+                if self.counts[slot] == 0:
+                    if free is None:
+                        free = slot
+                    if stored == EMPTY:
+                        slot = None
+                        break
+            else:
+                slot = None
+            if slot is None:
+                # not counted yet, in the first slot it could be found in
+                if free is None:
+                    return False, None
+                slot = free
+                self.setKey(slot, key)
+            if self.counts[slot] >= limit:
+                return True, None
+            self.counts[slot] += 1
+            return False, slot
+
+    def remove(self, slot):
+        with self.counts.get_lock():
+            self.counts[slot] -= 1
+            # no search goes past a never used slot, so the unused ones
+            # right before it can be made never used as well
+            if self.counts[slot] or self.key((slot + 1) % self.slots) != EMPTY:
+                return
+            while self.counts[slot] == 0 and self.key(slot) != EMPTY:
+                self.setKey(slot, EMPTY)
+                slot = (slot - 1) % self.slots
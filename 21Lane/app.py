@@ -1,11 +1,17 @@
 #!/usr/bin/python3 
 
 from server import Server
+from serverStats import REJECT_CONNECTIONS, REJECT_PER_IP, REJECT_TRANSFERS
 from downman import DownloadManager
 from exchangeClient import ExchangeClient 
 from browser import Browser
+from engine import sharedEngine, STOP_TIMEOUT
 from downloader import DownloadItem
 from config import Settings
+from metrics import MetricsServer, registerShareGauges, shareHealth
+from bandwidth import MEGABIT
+from network import advertisedAddresses, formatHost
+from ftplib import error_perm, error_temp
 from customSignals import *
 from customErrors import * 
 
@@ -13,21 +19,22 @@ from webbrowser import open as xdg_open
 from mimetypes import guess_type as guess_mime
 from os.path import join as join_path
 from os.path import dirname as get_dirname
+from time import time
 
 import resources_rc
 from window import Ui_mainWindow 
 from PyQt5.QtWidgets import QDialog, QMessageBox, QFileDialog, QTableWidgetItem
-from PyQt5.QtWidgets import QHBoxLayout, QProgressBar, QLabel, QPushButton, QFrame
+from PyQt5.QtWidgets import QHBoxLayout, QProgressBar, QLabel, QPushButton, QFrame, QLineEdit
 from PyQt5.QtWidgets import QMenu, QAction, QSystemTrayIcon, qApp, QMenuBar
 from PyQt5.QtGui import QIcon
 from PyQt5.QtCore import Qt 
 
-from PyQt5.QtNetwork import QNetworkInterface, QAbstractSocket, QHostAddress
 
 
 KB = 1024
 MB = 1048576
 GB = 1073741824
+SEARCH_RESULTS_SHOWN = 1000 # pages are fetched until there are this many
 
 def toHumanReadable(bytes):
     inKB = round(bytes / KB, 2)
@@ -43,17 +50,6 @@ def toHumanReadable(bytes):
         return str(bytes)+ " bytes"
 
 
-def getAllAddresses():
-    addresses = QNetworkInterface.allAddresses()
-    required = []
-    for address in addresses:
-        if (address.protocol() == QAbstractSocket.IPv4Protocol) and \
-            (address != QHostAddress(QHostAddress.LocalHost)):
-            if address.toString().startswith('169'): # to avoid link-local addresses
-                required.append(address.toString())
-    return required
-
-
 class GUI(Ui_mainWindow):
     def __init__(self, window):
         super().__init__()
@@ -62,14 +58,24 @@ class GUI(Ui_mainWindow):
         self.settings = Settings() 
         self.window.closeEvent = self.closeEvent
         self.server = Server()
-        self.downman = DownloadManager()
-        self.browser = Browser()
+        # downloads, browsing and heartbeats run on the engine's loop
+        self.engine = sharedEngine()
+        self.downman = DownloadManager(self.engine)
+        self.browser = Browser(self.engine)
         # snapshot updater is to be started on exchange connect
-        self.xchgClient = ExchangeClient()  
+        self.xchgClient = ExchangeClient(self.engine)  
+        # server and exchange client signals arrive on their own threads,
+        # results of the engine's work on its loop thread
+        self.bridge = CallbackBridge()
         self.lastKnownDir = "/tmp"
         self.destPrefix = ''
         self.userlist = None 
+        # the peer whose addresses are being tried, see showBrowser()
+        self.pickingPeer = None
         self.di_list = []
+        self.workerStats = {}
+        self.rejections = {}
+        self.startTime = time()
         self.addEventListeners() 
         self.browserTable.setColumnHidden(0, True)
         self.userListTable.setColumnHidden(0, True)
@@ -78,8 +84,12 @@ class GUI(Ui_mainWindow):
         self.window.setWindowIcon(QIcon(":/images/favicon.ico"))
         self.window.setWindowTitle("21Lane")
         self.makeMenuBar()
+        self.makeRejectionStats()
+        self.makeSearchBox()
         self.setupSystemTray()
         self.loadSettings()
+        self.metricsServer = None
+        self.startMetricsServer()
         self.window.show()
 
     
@@ -98,6 +108,29 @@ class GUI(Ui_mainWindow):
 
 
 
+    def makeRejectionStats(self):
+        # not part of the designer form, appended to the stats row
+        self.line_rejected = QFrame(self.groupBox)
+        self.line_rejected.setFrameShape(QFrame.VLine)
+        self.line_rejected.setFrameShadow(QFrame.Sunken)
+        self.horizontalLayout_8.addWidget(self.line_rejected)
+        self.stats_rejected = QLabel(self.groupBox)
+        self.stats_rejected.setText("0 rejected")
+        self.stats_rejected.setToolTip("<html><head/><body><p>Connections and transfers turned away by the server limits</p></body></html>")
+        self.horizontalLayout_8.addWidget(self.stats_rejected)
+
+
+
+    def makeSearchBox(self):
+        # not part of the designer form either, ends the browser bar
+        self.browserSearchInput = QLineEdit(self.browserTab)
+        self.browserSearchInput.setPlaceholderText("Search")
+        self.browserSearchInput.setToolTip("<html><head/><body><p>Find files and folders anywhere in this share, e.g. <i>beatles</i>, <i>*.mp3</i> or <i>IMG_20??*</i></p></body></html>")
+        self.horizontalLayout.addWidget(self.browserSearchInput)
+        self.browserSearchInput.returnPressed.connect(self.searchBrowser)
+
+
+
     def loadSettings(self):
         success = self.settings.load()
         self.publicNameInput.setText(self.settings.configDic["publicName"])
@@ -113,6 +146,30 @@ class GUI(Ui_mainWindow):
             self.reloadUsersBtn.click()
 
 
+    def startMetricsServer(self):
+        port = self.settings.configDic["metricsPort"]
+        if not port:
+            return
+        metrics = self.server.ftp_handler.stats.metrics
+        metrics.gauge("downloads_queued", "Downloads waiting for a worker", lambda: self.downman.queueDepths()["queued"])
+        metrics.gauge("downloads_active", "Downloads in progress", lambda: self.downman.queueDepths()["active"])
+        metrics.counter("browse_cache_hits_total", "Folder listings shown from the browser's cache", lambda: self.browser.cache.hits)
+        metrics.counter("browse_cache_stale_hits_total", "Cached folder listings shown and fetched again", lambda: self.browser.cache.staleHits)
+        metrics.counter("browse_cache_misses_total", "Folder listings fetched from peers", lambda: self.browser.cache.misses)
+        metrics.gauge("browse_cache_bytes", "Approximate size of the browser's listing cache", lambda: self.browser.cache.size)
+        registerShareGauges(metrics, self.server, self.xchgClient)
+        try:
+            self.metricsServer = MetricsServer(metrics, port, self.health)
+        except OSError as e:
+            print ("metrics endpoint unavailable", e)
+            return
+        self.metricsServer.start()
+
+
+    def health(self):
+        return shareHealth(self.server, self.xchgClient, self.startTime)
+
+
     def keyPressedEvent(self, event):
         if event.key() == Qt.Key_Escape:
             event.ignore()
@@ -128,17 +185,26 @@ class GUI(Ui_mainWindow):
             self.server.stopServer()
         if self.xchgClient.isRunning():
             print ('attempting to shut down exchange client')
-            self.xchgClient.quit()
-            print ('asked to end xchgclient politely')
-            if not self.xchgClient.wait(1):
-                print('forced closure of xchgclient required')
-                self.xchgClient.terminate()
-            print('xchgclient forcefully closed')
+            self.xchgClient.stop()
         if self.downman.running:
             self.downman.stopDownloader()
+        if self.metricsServer:
+            self.metricsServer.stop()
+        try:
+            # say goodbye to peers we kept sessions with
+            self.engine.run(self.browser.close(), STOP_TIMEOUT)
+        except Exception as e:
+            print ("browser sessions not closed", e)
+        self.engine.stop()
         qApp.exit()
 
 
+    def runAsync(self, coro, callback):
+        # coro on the engine, callback(future) back on the GUI thread; the
+        # future is returned, cancel() stops coro
+        return self.engine.submit(coro, self.bridge.wrap(callback))
+
+
     def showMessage(self, maintext=None, subtext=None):
         QMessageBox.information(self.window, maintext, subtext, QMessageBox.Ok, QMessageBox.Ok)
 
@@ -154,9 +220,12 @@ class GUI(Ui_mainWindow):
         self.downloadLocationBtn.clicked.connect(self.showDirectorySelector)
         self.toggleShareBtn.setText("Start Sharing")
         self.toggleShareBtn.clicked.connect(self.toggleShare)
-        self.server.ftp_handler.stats.clientConnect.connect(self.statClientConnected)
-        self.server.ftp_handler.stats.clientDisconnect.connect(self.statClientDisconnected)
-        self.server.ftp_handler.stats.fileTransfer[int] .connect(self.statFileTransferred)
+        self.server.ftp_handler.stats.clientConnect.connect(self.bridge.wrap(self.statClientConnected))
+        self.server.ftp_handler.stats.clientDisconnect.connect(self.bridge.wrap(self.statClientDisconnected))
+        self.server.ftp_handler.stats.fileTransfer.connect(self.bridge.wrap(self.statFileTransferred))
+        self.server.ftp_handler.stats.throughput.connect(self.bridge.wrap(self.statThroughput))
+        self.server.ftp_handler.stats.workerUpdate.connect(self.bridge.wrap(self.statWorkerUpdated))
+        self.server.ftp_handler.stats.rejection.connect(self.bridge.wrap(self.statRejected))
         self.reloadUsersBtn.clicked.connect(self.loadUsers)
         self.browserInput.returnPressed.connect(self.browserGoBtn.click)
         self.browserGoBtn.clicked.connect(self.loadBrowserTable)
@@ -178,6 +247,7 @@ class GUI(Ui_mainWindow):
     def updateSpeedLimit(self, value):
         self.speedLimitSlider.setValue(value)
         self.speedLimitSpin.setValue(value)
+        self.server.setBandwidth(value * MEGABIT)
 
 
     def statClientConnected(self):
@@ -191,10 +261,35 @@ class GUI(Ui_mainWindow):
 
 
     def statFileTransferred(self, filesize):
-        self.server.bytesTransferred += filesize 
         self.server.filesTransferred += 1
         self.stats_files.setText(str(self.server.filesTransferred))
-        self.stats_bytes.setText(toHumanReadable(self.server.bytesTransferred))
+
+
+    def statThroughput(self, totalBytes, bytesPerSec):
+        self.server.bytesTransferred = totalBytes
+        self.stats_bytes.setText(toHumanReadable(totalBytes) + " (" + toHumanReadable(bytesPerSec) + "/s)")
+
+
+    def statWorkerUpdated(self, worker, connections, bytesSent):
+        self.workerStats[worker] = (connections, bytesSent)
+        tooltip = "<html><body>"
+        for worker in sorted(self.workerStats):
+            connections, bytesSent = self.workerStats[worker]
+            tooltip += "worker %d: %d connected, %s<br>" % (worker, connections, toHumanReadable(bytesSent))
+        tooltip += "</body></html>"
+        self.stats_connected.setToolTip(tooltip)
+        self.stats_bytes.setToolTip(tooltip)
+
+
+    def statRejected(self, reason, count):
+        self.rejections[reason] = count
+        self.stats_rejected.setText("%d rejected" % sum(self.rejections.values()))
+        tooltip = "<html><body>"
+        tooltip += "server full: %d<br>" % self.rejections.get(REJECT_CONNECTIONS, 0)
+        tooltip += "too many from one address: %d<br>" % self.rejections.get(REJECT_PER_IP, 0)
+        tooltip += "too many transfers: %d<br>" % self.rejections.get(REJECT_TRANSFERS, 0)
+        tooltip += "</body></html>"
+        self.stats_rejected.setToolTip(tooltip)
 
 
     def toggleShare(self):
@@ -204,35 +299,37 @@ class GUI(Ui_mainWindow):
                 (not self.sharedLocationInput.text()):
                 raise FormIncompleteError 
             if self.xchgClient.isRunning():
-                self.xchgClient.quit()
-                if not self.xchgClient.wait(1):
-                    self.xchgClient.terminate()
+                self.xchgClient.stop()
             if self.server.isRunning():
                 self.server.stopServer()
                 self.toggleShareBtn.setText("Start Sharing")
                 self.toggleShareBtn.setIcon(QIcon(":/images/failed.svg"))
                 self.urlFrame.setVisible(False)
             else:
+                # settings first, the port is checked on the addresses they bind
+                self.server.applySettings(self.settings.configDic)
                 self.server.setPort(self.port.value())
                 self.server.setSharedDirectory(self.sharedLocationInput.text())
+                self.server.setBandwidth(self.speedLimitSlider.value() * MEGABIT)
+                self.workerStats.clear()
                 self.server.start()
                 if not self.exchangeURLInput.text():
-                    self.xchgClient.updateInfo(self.publicNameInput.text(), None, self.port.value())
+                    self.xchgClient.updateInfo(self.publicNameInput.text(), None, self.port.value(), self.server.bindAddresses)
                 else:
-                    self.xchgClient.updateInfo(self.publicNameInput.text(), self.exchangeURLInput.text(), self.port.value())                         
-                self.xchgClient.updateDir(self.sharedLocationInput.text())
+                    self.xchgClient.updateInfo(self.publicNameInput.text(), self.exchangeURLInput.text(), self.port.value(), self.server.bindAddresses)
+                self.xchgClient.updateDir(self.sharedLocationInput.text(), self.server.index)
                 self.settings.update(self.publicNameInput.text(), self.port.value(), \
                     self.sharedLocationInput.text(), self.downloadLocationInput.text(), self.speedLimitSlider.value(), self.exchangeURLInput.text())
                 self.toggleShareBtn.setText("Stop Sharing")
                 self.toggleShareBtn.setIcon(QIcon(":/images/complete.svg"))
-                addresses = getAllAddresses()
+                addresses = advertisedAddresses(self.server.bindAddresses)
                 print (addresses)
                 if len(addresses) != 0:
                     lblstr = "<html><body>"
                     current = 0
                     end = len(addresses)-1
                     for addr in addresses:
-                        hyperlink = 'ftp://'+addr+':'+str(self.server.port)
+                        hyperlink = 'ftp://'+formatHost(addr)+':'+str(self.server.port)
                         lblstr += "<a href=\'"+hyperlink+"\'>"+hyperlink+"</a>"
                         if current != (end-1):
                             lblstr += '<br>'
@@ -245,12 +342,20 @@ class GUI(Ui_mainWindow):
             self.showMessage("Don't fool me", "Shared location doesn't exist")
         except PortUnavailableError:
             self.showMessage("Port unavailable", "Please select some other port number")
+        except BindAddressError as e:
+            self.showMessage("Cannot share", "Check the interfaces to listen on: " + str(e))
         except FormIncompleteError:
             self.showMessage("Form incomplete", "Please fill in proper values!")
+        except OSError as e:
+            self.showMessage("Cannot share", "The server could not listen: " + str(e.strerror or e))
 
 
     def loadUsers(self):
-        userlist = self.xchgClient.getUserList()  
+        self.runAsync(self.xchgClient.fetchUserList(), self.showUsers)
+
+
+    def showUsers(self, future):
+        userlist = future.result()
         self.userlist = userlist      
         if not userlist:
             self.showMessage("Sorry", "Cannot retrieve list of users")
@@ -270,25 +375,95 @@ class GUI(Ui_mainWindow):
         current = self.userListTable.selectedItems()[0]
         index = int(self.userListTable.item(current.row(), 0).text())
         user = self.userlist[index]
-        self.browser.update(user["ip"], int(user["port"]))
-        self.tabWidget.setCurrentIndex(2)
-        self.browserInput.setText("/")
-        self.browserGoBtn.click()
+        # newer peers list all their addresses, use the one answering first
+        addresses = [ user["ip"] ] + str(user.get("addresses") or "").split(",")
+        port = int(user["port"])
+        self.pickingPeer = user
+
+        def picked(future):
+            # another peer may have been picked meanwhile
+            if self.pickingPeer is not user:
+                return 
+            try:
+                host = future.result() or user["ip"]
+            except Exception:
+                host = user["ip"]
+            self.browser.update(host, port)
+            self.tabWidget.setCurrentIndex(2)
+            self.browserInput.setText("/")
+            self.browserGoBtn.click()
+
+        self.runAsync(self.browser.pickHost(addresses, port), picked)
 
 
     def loadBrowserTable(self):
         pwd = self.browserInput.text()
-        filelist = []
+        host, port = self.browser.host, self.browser.port
+        # Go on the folder shown is a reload, not a look at the cached copy
+        history = self.browser.historyStack
+        reload = bool(history) and history[-1] == pwd
+
+        def loaded(future):
+            filelist = []
+            try:
+                filelist = future.result()
+                if filelist is None:
+                    self.showMessage("Error", "The path does not exist!")
+                    return 
+                self.browser.historyStack.append(pwd)
+                self.browser.filelist = filelist
+            except (OSError, EOFError, error_temp):
+                self.showMessage("Offline", "The remote machine cannot be contacted!\nBetter luck next time.")
+                self.tabWidget.setCurrentIndex(1)
+            self.showFileList(filelist)
+
+        def refreshed(old, filelist):
+            # a newer listing of a folder shown from the cache, put up if
+            # that listing is still what the table shows, of the same peer
+            if self.browser.filelist is old and (host, port) == (self.browser.host, self.browser.port):
+                self.browser.filelist = filelist
+                self.showFileList(filelist)
+
+        # one round trip on a pooled session, not two logins, and none for
+        # a folder seen lately
+        self.runAsync(self.browser.listDir(host, port, pwd, self.bridge.wrap(refreshed), reload), loaded)
+
+
+    def searchBrowser(self):
+        query = self.browserSearchInput.text().strip()
+        if not query or not self.browser.host:
+            return 
+        host, port = self.browser.host, self.browser.port
+
+        async def search():
+            filelist = []
+            offset = 0
+            while offset is not None and len(filelist) < SEARCH_RESULTS_SHOWN:
+                offset, page = await self.browser.search(host, port, query, offset)
+                filelist += page
+            return filelist
+
+        self.runAsync(search(), self.showSearchResults)
+
+
+    def showSearchResults(self, future):
         try:
-            if not self.browser.pathExists(self.browser.host, self.browser.port, pwd):
-                self.showMessage("Error", "The path does not exist!")
-                return 
-            self.browser.historyStack.append(pwd)
-            filelist = self.browser.getFileList(self.browser.host, self.browser.port, pwd)
-            self.browser.filelist = filelist
-        except ConnectionRefusedError:
+            filelist = future.result()
+        except error_perm:
+            self.showMessage("Sorry", "This peer cannot search its files.\nBrowse them instead.")
+            return 
+        except error_temp as e:
+            self.showMessage("Search failed", str(e))
+            return 
+        except OSError:
             self.showMessage("Offline", "The remote machine cannot be contacted!\nBetter luck next time.")
-            self.tabWidget.setCurrentIndex(1)
+            return 
+        self.browser.filelist = filelist
+        # results come from all over the share, show where
+        self.showFileList(filelist, fullPaths=True)
+
+
+    def showFileList(self, filelist, fullPaths=False):
         table = self.browserTable
         table.clearContents()
         table.setRowCount(len(filelist))
@@ -300,7 +475,7 @@ class GUI(Ui_mainWindow):
                 table.setItem(i, 3, QTableWidgetItem(QIcon(":/images/folder.png"), ""))
             else:
                 table.setItem(i, 3, QTableWidgetItem(guess_mime(file["filename"])[0]))
-            table.setItem(i, 4, QTableWidgetItem(file["filename"]))
+            table.setItem(i, 4, QTableWidgetItem(file["pathname"] if fullPaths else file["filename"]))
 
 
     def handleBackBtnClick(self):
@@ -335,23 +510,86 @@ class GUI(Ui_mainWindow):
             destDir = join_path(self.getPathFromDialog())
         else:
             destDir = self.destPrefix
-        meta = None 
-        if file["isDir"]:
-            meta = self.browser.getRecursiveFileList(self.browser.host, self.browser.port, file["pathname"])
-            filelist = self.browser.recfilelist 
-        else:
-            meta = { "totalFiles": 1, "totalSize":file["filesize"] }
-            filelist = [ file ]
+        self.startDownload(self.browser.host, self.browser.port, file, destDir)
+
+
+    def startDownload(self, host, port, file, destDir):
+        # a folder's files are queued as the folders they are in are
+        # listed, the total grows with them
         signal = DownloadItemUpdater() 
-        diui = self.createDownloadItemBox(file["filename"], meta["totalSize"])
+        diui = self.createDownloadItemBox(file["filename"], 0)
         dilist = []
-        for item in filelist:
-            di = DownloadItem(item["filename"], self.browser.host, self.browser.port, item["pathname"], join_path(destDir, item["filename"]), item["filesize"], signal)
+        meta = { "totalFiles": 0, "totalSize": 0, "failed": [] }
+        # walk: the future of the walk while it runs, walked: whether it
+        # got to the end, folder: the DownloadItem of a tar download
+        state = { "walk": None, "walked": False, "completed": 0, "folder": None }
+        # source paths queued, a walk started again skips them
+        queued = set()
+
+        def add(files, failed):
+            for item in files:
+                if item["pathname"] in queued:
+                    continue
+                queued.add(item["pathname"])
+                meta["totalFiles"] += 1
+                meta["totalSize"] += item["filesize"]
+                if state["folder"] is None:
+                    di = DownloadItem(item["filename"], host, port, item["pathname"], join_path(destDir, item["filename"]), item["filesize"], signal)
+                    di.updateGuiComponents(diui)
+                    dilist.append(di)
+                    self.downman.addItem(di)
+            meta["failed"].extend(failed)
+            diui["filesize"].setText(toHumanReadable(meta["totalSize"]))
+            diui["progress"].setMaximum(max(meta["totalSize"], 1))
+            if state["folder"] is not None:
+                state["folder"].filesize = meta["totalSize"]
+
+        def fetchFolder():
+            # the whole folder over one connection, unpacked into destDir
+            di = DownloadItem(file["filename"], host, port, file["pathname"], destDir, meta["totalSize"], signal, folder=True)
             di.updateGuiComponents(diui)
             dilist.append(di)
-        
+            state["folder"] = di
+            self.downman.addItem(di)
+
+        tell = self.bridge.wrap(add)
+        async def walk(askTar):
+            if askTar and await self.browser.supportsTar(host, port):
+                self.bridge.wrap(fetchFolder)()
+            async for files, failed in self.browser.walkFiles(host, port, file["pathname"], file["unique"]):
+                tell(files, failed)
+
+        def walked(future):
+            state["walk"] = None
+            if future.cancelled():
+                return 
+            try:
+                future.result()
+                state["walked"] = True
+            except (OSError, EOFError, error_temp):
+                self.showMessage("Offline", "The remote machine cannot be contacted!\nBetter luck next time.")
+            except error_perm:
+                self.showMessage("Not found", "The folder is no longer shared.")
+            except Exception as e:
+                print ("cannot list", file["pathname"], e)
+            if meta["failed"] and state["folder"] is None:
+                paths = "\n".join(path for path, error in meta["failed"][:10])
+                self.showMessage("Incomplete", "%d folders could not be listed and were not downloaded:\n%s" % (len(meta["failed"]), paths))
+            if not state["walked"] and not dilist:
+                diui["completion"].setText("Failed")
+                cancelCallback()
+            elif state["completed"] >= len(dilist):
+                completeCallback()
+
+        def startWalk():
+            meta["failed"] = []
+            # a walk started again goes on the way the first one went
+            state["walk"] = self.runAsync(walk(not dilist), walked)
+
         # create callbacks for gui events
         def cancelCallback():
+            if state["walk"] is not None:
+                state["walk"].cancel()
             for di in dilist:
                 di.cancel()
             diui["cancelBtn"].setIcon(QIcon(":/images/reload.png"))
@@ -363,20 +601,33 @@ class GUI(Ui_mainWindow):
             for di in dilist:
                 sum += di.completed
             diui["progress"].setValue(sum)
-            diui["completion"].setText(toHumanReadable(sum))
+            text = toHumanReadable(sum)
+            if state["folder"] is not None:
+                text += ", %d/%d files" % (state["folder"].filesCompleted, meta["totalFiles"])
+            diui["completion"].setText(text)
 
         def retryCallback():
             print ("retrying")
-            di.completed = 0
-            self.downman.addItem(di)
             diui["cancelBtn"].clicked.disconnect()
             diui["cancelBtn"].clicked.connect(cancelCallback)
             diui["cancelBtn"].setIcon(QIcon(":/images/cancel.png"))
+            for di in dilist:
+                if not di.done:
+                    # folders go on after the last file they got in full
+                    di.completed = di.bytesKept
+                    self.downman.addItem(di)
+            if file["isDir"] and not state["walked"]:
+                startWalk()
 
         def errorCallback():
             diui["completion"].setText("Failed")
             cancelCallback()
 
+        def itemCompleteCallback():
+            state["completed"] += 1
+            if state["walked"] and state["completed"] >= len(dilist):
+                completeCallback()
+
         def completeCallback():
             diui["completion"].setText("Completed")
             diui["cancelBtn"].clicked.disconnect()
@@ -393,12 +644,14 @@ class GUI(Ui_mainWindow):
         diui["cancelBtn"].clicked.connect(cancelCallback)
         signal.progress[int].connect(updateProgressCallback)
         signal.error.connect(errorCallback)
-        signal.complete.connect(completeCallback)
+        signal.complete.connect(itemCompleteCallback)
         diui["openDestBtn"].clicked.connect(openDir)
         self.downloadsLayout.insertWidget(0, diui["widget"])
-        for entry in dilist:
-            self.downman.addItem(entry)
-        # print ("downloading", di.filename, di.filesize, "to")
+        if file["isDir"]:
+            startWalk()
+        else:
+            state["walked"] = True
+            add([ file ], [])
 
 
     def createDownloadItemBox(self, filename, filesize):
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+
+# token bucket used to pace data connections without giving up sendfile()
+
+from time import monotonic
+from threading import Lock
+
+# number of chunks a throttled connection is paced into every second
+PACING_STEPS = 10
+MIN_CHUNK_SIZE = 4096
+MEGABIT = 125000 # bytes, speed limits are configured in Mbps
+
+
+class TokenBucket:
+    def __init__(self, rate=0, capacity=None):
+        # rate and capacity are in bytes, a rate of 0 means no limit
+        self.rate = rate
+        self.capacity = capacity if capacity else rate
+        self.tokens = self.capacity
+        self.stamp = monotonic()
+
+    def setRate(self, rate, capacity=None):
+        self.refill()
+        self.rate = rate
+        self.capacity = capacity if capacity else rate
+        self.tokens = min(self.tokens, self.capacity)
+
+    def refill(self):
+        now = monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def charge(self, amount):
+        # tokens are allowed to go negative, the debt is paid back by sleeping
+        if not self.rate:
+            return
+        self.refill()
+        self.tokens -= amount
+
+    def delay(self):
+        # seconds to wait before the next chunk may be sent
+        if not self.rate:
+            return 0
+        self.refill()
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class ClientShare:
+    # the slice of the governor's bandwidth handed to one client address,
+    # shared by every data connection coming from that address
+    def __init__(self, governor, ip):
+        self.governor = governor
+        self.ip = ip
+        self.connections = 0
+        self.bucket = TokenBucket()
+
+    def charge(self, amount):
+        with self.governor.lock:
+            self.bucket.charge(amount)
+            self.governor.bucket.charge(amount)
+
+    def delay(self):
+        with self.governor.lock:
+            return max(self.bucket.delay(), self.governor.bucket.delay())
+
+    def chunkSize(self, size):
+        if not self.bucket.rate:
+            return size
+        return max(MIN_CHUNK_SIZE, min(size, self.bucket.rate // PACING_STEPS))
+
+
+class BandwidthGovernor:
+    # one token bucket for the whole server, split evenly between the
+    # client addresses that currently have a data connection open
+    def __init__(self, rate=0):
+        self.lock = Lock()
+        self.rate = rate
+        self.bucket = TokenBucket(rate, rate // PACING_STEPS)
+        self.clients = {}
+
+    def setRate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.bucket.setRate(rate, rate // PACING_STEPS)
+            self.rebalance()
+
+    def rebalance(self):
+        # callers hold self.lock
+        share = max(1, self.rate // len(self.clients)) if self.rate and self.clients else 0
+        for client in self.clients.values():
+            client.bucket.setRate(share, share // PACING_STEPS)
+
+    def register(self, ip):
+        with self.lock:
+            client = self.clients.get(ip)
+            if client is None:
+                client = self.clients[ip] = ClientShare(self, ip)
+                self.rebalance()
+            client.connections += 1
+            return client
+
+    def unregister(self, client):
+        with self.lock:
+            client.connections -= 1
+            if client.connections <= 0 and self.clients.get(client.ip) is client:
+                del self.clients[client.ip]
+                self.rebalance()
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+# folder listings of peers kept in memory by the browser, so that going
+# back, or to a folder seen a moment ago, shows it without a round trip.
+# Runs on the engine's loop with the Browser that owns it, no locking.
+# A listing younger than freshFor is served as it is, an older one is
+# served too but due for a refresh, one older than maxAge is forgotten.
+# Least recently used listings go first once the memory cap is reached.
+
+from collections import OrderedDict
+from time import monotonic
+
+DEFAULT_CACHE_SIZE = 16 * 1048576 # bytes, roughly
+FRESH_FOR = 10 # seconds
+MAX_AGE = 600 # seconds
+# what an Entry takes besides its names, near enough
+ENTRY_SIZE = 200
+
+
+def listingSize(filelist):
+    return sum(ENTRY_SIZE + len(entry.filename) + len(entry.pathname) for entry in filelist)
+
+
+def sameListing(a, b):
+    return [ (e.filename, e.isDir, e.filesize, e.mtime) for e in a ] == \
+        [ (e.filename, e.isDir, e.filesize, e.mtime) for e in b ]
+
+
+class BrowseCache:
+    def __init__(self, maxSize=DEFAULT_CACHE_SIZE, freshFor=FRESH_FOR, maxAge=MAX_AGE):
+        self.maxSize = maxSize
+        self.freshFor = freshFor
+        self.maxAge = maxAge
+        self.size = 0
+        # (host, port, path) -> (when fetched, size, filelist), least
+        # recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # hits on listings due for a refresh, counted in hits as well
+        self.staleHits = 0
+
+    def get(self, key):
+        # (filelist, whether it is due for a refresh), None on a miss
+        entry = self.entries.get(key)
+        if entry is not None:
+            age = monotonic() - entry[0]
+            if age < self.maxAge:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                stale = age >= self.freshFor
+                if stale:
+                    self.staleHits += 1
+                return entry[2], stale
+            self.discard(key)
+        self.misses += 1
+        return None
+
+    def peek(self, key):
+        # the filelist held for key, not counted and not moved
+        entry = self.entries.get(key)
+        return entry[2] if entry is not None else None
+
+    def store(self, key, filelist):
+        self.discard(key)
+        size = listingSize(filelist)
+        if size > self.maxSize // 2:
+            return
+        self.entries[key] = (monotonic(), size, filelist)
+        self.size += size
+        while self.size > self.maxSize:
+            self.discard(next(iter(self.entries)))
+
+    def touch(self, key):
+        # key was fetched again and found unchanged
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries[key] = (monotonic(), entry[1], entry[2])
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
@@ -1,88 +1,291 @@
 #!/usr/bin/python3
 
 # code for file browser 
-from ftplib import FTP, error_perm
-from copy import deepcopy
-from os.path import join, dirname
+# every method that talks to a peer is a coroutine for the engine's loop,
+# the GUI submits them and gets the result back through its bridge.
+# Peers are talked to over logged in sessions from a SessionPool, which
+# also never has a peer busy with more than a few of them
+import asyncio
+from ftplib import error_perm
+from os.path import dirname, basename
+
+from engine import sharedEngine
+from network import pickAddress
+from sessionPool import SessionPool
+from browseCache import BrowseCache, sameListing
+from listing import Entry, MLST_FACTS, listFolder
+from manifest import parseManifest, TYPE_FILE, TYPE_DIR
+from searchIndex import parseSearchPage, SEARCH_PAGE_SIZE
+
+# folders deeper than this below the one walked are not listed, the last
+# guard against loops on peers that do not say which folder is which
+MAX_WALK_DEPTH = 64
+
 
 class Browser:
-    def __init__(self):
+    def __init__(self, engine=None):
+        self.engine = engine or sharedEngine()
         self.host = None 
         self.port = 2121 
         self.filelist = None 
         self.historyStack = []
+        # (host, port) -> (version, {path: (type, size, mtime)}), None
+        # instead of the dict for peers without SITE MANIFEST
+        self.manifests = {}
+        # (host, port) -> whether the peer sends folders with SITE TAR
+        self.tarPeers = {}
+        # (host, port) -> whether the peer lists folders with MLSD
+        self.mlsdPeers = {}
+        self.pool = SessionPool(setup=self.prepareSession)
+        self.cache = BrowseCache()
+        # (host, port, path) -> task fetching a cached listing again
+        self.refreshing = {}
     
     def update(self, host, port):
+        if (host, port) != (self.host, self.port):
+            # listings of the last peer are no use now, and a refresh of
+            # one must not come back to the table of this one
+            self.engine.call(self.forget)
         self.host = host 
         self.port = port 
         self.historyStack.clear()
 
-    def getFileList(self, host, port, pwd):
+    def forget(self):
+        # on the loop, like everything else touching the cache
+        self.cache.clear()
+        for task in list(self.refreshing.values()):
+            task.cancel()
+        self.refreshing.clear()
+
+    async def close(self):
+        for task in list(self.refreshing.values()):
+            task.cancel()
+        await self.pool.close()
+
+    async def pickHost(self, addresses, port):
+        # the address of a peer answering first, None if none does;
+        # connecting blocks, so it is tried off the loop
+        return await asyncio.get_running_loop().run_in_executor(None, pickAddress, addresses, port)
+
+    async def prepareSession(self, ftp):
+        # MLSD with the facts we read, unique included; a peer refusing
+        # the options gets LIST
+        try:
+            await ftp.voidcmd("OPTS MLST " + MLST_FACTS)
+            self.mlsdPeers[(ftp.host, ftp.port)] = True
+        except error_perm:
+            self.mlsdPeers[(ftp.host, ftp.port)] = False
+
+    async def getFileList(self, host, port, pwd):
         filelist = None 
-        ftp = FTP()
-        # the following is a result of hours of manual tuning and string manipulation
-        # please bear with the complexity
+        async def listing(ftp):
+            return await listFolder(ftp, pwd, self.mlsdPeers.get((host, port)), pwd)
         try:
-            l = []
-            ftp.connect(host, port)
-            ftp.login()
-            ftp.dir(pwd, l.append)
-            ftp.quit()
-            m = deepcopy(l)
-            for i in range(len(l)):
-                l[i] = l[i].split()
-            tmplist = {}
-            for i in range(len(l)):
-                # l[i] = [ x for x in l[i] if x!= '' ] # no need if using string.split(), which was string.split(' ') earlier
-                isDir = l[i][0].startswith('d')
-                filesize = int(l[i][4])
-                for item in l[i][:8]:
-                    m[i] = m[i].replace(item, '', 1)
-                filename = m[i].strip()
-                tmplist[i] = {'isDir':isDir, 'filesize':filesize, 'filename':filename, 'pathname':join(pwd, filename) }
+            filelist = await self.pool.call(host, port, listing)
         except Exception as e:
-            ftp.close()
-            print('error occured')
-        else:
-            filelist = list(tmplist.values())
+            print('error occured', e)
         return filelist 
 
-    def getRecursiveList(self, host, port, pwd, relativeTo, depth=1):
+    async def listDir(self, host, port, pwd, refreshed=None, reload=False):
+        # pathExists() and getFileList() in one go, on one session: None
+        # if pwd is not a folder of the peer. A listing seen lately comes
+        # from the cache; if it may be out of date it is fetched again in
+        # the background, and refreshed(old, new) called should it differ.
+        # reload skips the cache, for a folder asked for again on purpose
+        if (not host) or (not port) or (not pwd):
+            return None
+        key = (host, port, pwd)
+        if reload:
+            self.cache.discard(key)
+            task = self.refreshing.pop(key, None)
+            if task is not None:
+                task.cancel()
+        cached = self.cache.get(key)
+        if cached is not None:
+            filelist, stale = cached
+            if stale and key not in self.refreshing:
+                task = asyncio.ensure_future(self.refresh(key, refreshed))
+                self.refreshing[key] = task
+                task.add_done_callback(lambda task: self.refreshing.pop(key, None))
+            return filelist
+        filelist = await self.fetchDir(host, port, pwd)
+        if filelist is None:
+            self.cache.discard(key)
+        else:
+            self.cache.store(key, filelist)
+        return filelist
+
+    async def refresh(self, key, refreshed):
+        host, port, pwd = key
         try:
-            fl = self.getFileList(host, port, pwd)
-            for file in fl:
-                file["filename"] = file["pathname"].replace(relativeTo, '', 1)
-                if file["isDir"]:
-                    self.getRecursiveList(host, port, deepcopy(file["pathname"]), relativeTo, depth+1)
+            filelist = await self.fetchDir(host, port, pwd)
+        except Exception as e:
+            print ("cannot refresh", pwd, e)
+            return
+        old = self.cache.peek(key)
+        if filelist is None:
+            # gone, the next visit says so
+            self.cache.discard(key)
+        elif old is not None and sameListing(old, filelist):
+            self.cache.touch(key)
+        else:
+            self.cache.store(key, filelist)
+            if refreshed is not None and old is not None:
+                refreshed(old, filelist)
+
+    async def fetchDir(self, host, port, pwd):
+        async def listing(ftp):
+            await ftp.voidcmd("CWD " + pwd)
+            return await listFolder(ftp, pwd, self.mlsdPeers.get((host, port)))
+        try:
+            return await self.pool.call(host, port, listing)
+        except error_perm:
+            return None
+
+    async def getRecursiveList(self, host, port, pwd, relativeTo, unique=None):
+        # the files below pwd, with filenames relative to relativeTo, as
+        # ([Entry], [(path, error)]) for every folder listed, the second
+        # naming the folders that could not be. The tree is walked breadth
+        # first with as many folders listed at once as the pool lends
+        # sessions to the peer; pwd failing raises
+        # (path, depth, unique of every folder from pwd down to path)
+        queue = asyncio.Queue()
+        found = asyncio.Queue()
+        # folders queued whose files are yet to be yielded
+        pending = 0
+        # names do not start with a slash, whatever relativeTo ends with
+        prefix = relativeTo.rstrip('/') + '/'
+        # set when the walk is over: wait_for() drops a cancel that comes
+        # as what it waits on is done, so a walker can miss its own
+        stopped = False
+
+        def add(depth, above, entries):
+            nonlocal pending
+            files = []
+            failed = []
+            for entry in entries:
+                if not entry.isDir:
+                    entry.filename = entry.pathname[len(prefix):]
+                    files.append(entry)
+                elif entry.unique is not None and entry.unique in above:
+                    print ("not following folder loop", entry.pathname)
+                elif depth >= MAX_WALK_DEPTH:
+                    failed.append((entry.pathname, "too deep"))
                 else:
-                    self.recfilelist.append(file)
-        except RecursionError:
-            pass 
-        except TypeError:
-            pass
+                    pending += 1
+                    queue.put_nowait((entry.pathname, depth + 1, above + (entry.unique,)))
+            return files, failed
+
+        async def listing(path):
+            return await self.pool.call(host, port, \
+                lambda ftp: listFolder(ftp, path, self.mlsdPeers.get((host, port)), path))
+
+        async def walker():
+            while True:
+                item = await queue.get()
+                if stopped:
+                    return
+                path, depth, above = item
+                try:
+                    found.put_nowait(add(depth, above, await listing(path)))
+                except Exception as e:
+                    print ("cannot list", path, e)
+                    found.put_nowait(([], [(path, str(e))]))
+
+        yield add(0, (unique,), await listing(pwd))
+        walkers = [ asyncio.ensure_future(walker()) for i in range(self.pool.maxPerHost) ]
+        try:
+            while pending:
+                files, failed = await found.get()
+                pending -= 1
+                yield files, failed
+        finally:
+            stopped = True
+            for w in walkers:
+                w.cancel()
+                queue.put_nowait(None)
+
+    async def getManifest(self, host, port):
+        # the peer's whole share in one round trip, in full the first time
+        # and then only what changed since the version we hold
+        version, entries = self.manifests.get((host, port), (0, {}))
+        if entries is None:
+            return None
+        async def fetch(ftp):
+            data = []
+            await ftp.retrbinary("SITE MANIFEST %d" % version, data.append)
+            return b''.join(data)
+        try:
+            header, changes = parseManifest(await self.pool.call(host, port, fetch))
+        except error_perm:
+            # an older peer, crawl it directory by directory
+            self.manifests[(host, port)] = (0, None)
+            return None
         except Exception as e:
-            print("Error occured", e)
-            raise e
-
-    def getRecursiveFileList(self, host, port, pwd):
-        self.recfilelist = []
-        print ("making recursive listing for", host, port, pwd, "relative to", dirname(pwd))
-        self.getRecursiveList(host, port, deepcopy(pwd), dirname(pwd))
-        meta = { "totalFiles": 0, "totalSize": 0 }
-        for file in self.recfilelist:
-            meta["totalFiles"] += 1
-            meta["totalSize"] += file["filesize"]
-        return meta
-
-    def pathExists(self, host, port, pwd):
-        ftp = FTP()
+            print ("manifest unavailable", e)
+            return None
+        if header["full"]:
+            entries = {}
+        for op, path, type, size, mtime in changes:
+            if op == "-":
+                entries.pop(path, None)
+            else:
+                entries[path] = (type, size, mtime)
+        self.manifests[(host, port)] = (header["version"], entries)
+        return entries
+
+    async def search(self, host, port, query, offset=0):
+        # one page of the peer's files and folders matching query, and the
+        # offset of the next page, None after the last one
+        async def fetch(ftp):
+            data = []
+            await ftp.retrbinary("SITE SEARCH %d %s" % (offset, query), data.append)
+            return b''.join(data)
+        header, results = parseSearchPage(await self.pool.call(host, port, fetch))
+        filelist = []
+        for path, type, size, mtime in results:
+            filelist.append(Entry(basename(path), type == TYPE_DIR, size, mtime, path))
+        nextOffset = header["offset"] + SEARCH_PAGE_SIZE if header["more"] else None
+        return nextOffset, filelist
+
+    async def supportsTar(self, host, port):
+        # asked once per peer, older ones are fetched file by file
+        if (host, port) not in self.tarPeers:
+            try:
+                await self.pool.call(host, port, lambda ftp: ftp.sendcmd("SITE HELP SITE TAR"))
+                self.tarPeers[(host, port)] = True
+            except error_perm:
+                self.tarPeers[(host, port)] = False
+            except Exception as e:
+                print ("cannot ask", host, "for SITE TAR", e)
+                return False
+        return self.tarPeers[(host, port)]
+
+    async def walkFiles(self, host, port, pwd, unique=None):
+        # the files below pwd, named relative to the folder pwd is in, as
+        # they are found: all of them at once from the manifest, or a
+        # folder at a time from getRecursiveList()
+        relativeTo = dirname(pwd.rstrip('/'))
+        print ("making recursive listing for", host, port, pwd, "relative to", relativeTo)
+        entries = await self.getManifest(host, port)
+        if entries is None:
+            async for files, failed in self.getRecursiveList(host, port, pwd, relativeTo, unique):
+                yield files, failed
+            return
+        files = []
+        prefix = pwd.rstrip('/') + '/'
+        relativeTo = relativeTo.rstrip('/') + '/'
+        for path in sorted(entries):
+            type, size, mtime = entries[path]
+            if type == TYPE_FILE and path.startswith(prefix):
+                files.append(Entry(path[len(relativeTo):], False, size, mtime, path))
+        yield files, []
+
+    async def pathExists(self, host, port, pwd):
         if (not host) or (not port) or (not pwd):
             return False 
         try:
-            ftp.connect(host, port)
-            ftp.login()
-            ftp.cwd(pwd)
-            ftp.quit()
+            await self.pool.call(host, port, lambda ftp: ftp.voidcmd("CWD " + pwd))
             return True     
         except error_perm:
             return False 
\ No newline at end of file
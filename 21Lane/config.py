@@ -3,6 +3,10 @@
 import json 
 
 CONFIG_FILE = "config.json"
+# keys filled from the settings form, everything else is optional
+FORM_KEYS = {"publicName", "port", "sharedDir", "downloadDir", "speedLimit", "exchangeURL"}
+# keys older versions saved and that are no longer read
+OBSOLETE_KEYS = {"mmapMaxKB"}
 
 class Settings:
     configDic = {
@@ -11,9 +15,30 @@ class Settings:
         "sharedDir": "",
         "downloadDir": "",
         "speedLimit": 2,
-        "exchangeURL": ""
+        "exchangeURL": "",
+        "serverEngine": "single",
+        "serverWorkers": 0,
+        "metricsPort": 0,
+        "listingCacheMB": 64,
+        "hashCacheFile": "hashes.db",
+        "maxConnections": 256,
+        "maxConnectionsPerIP": 8,
+        "maxTransfers": 32,
+        "controlTimeout": 300,
+        "dataTimeout": 300,
+        "listenBacklog": 100,
+        "bindAddresses": [],
+        "manifestFile": "manifest.db",
+        "indexFile": "shareindex.db",
+        "compressionLevel": 6,
+        "httpPort": 0,
+        "dropBehindMB": 256,
+        "readaheadMB": 0
     }
 
+    def __init__(self, filename=CONFIG_FILE):
+        self.filename = filename
+
     def update(self, publicName, port, sharedDir, downloadDir, speedLimit, exchangeURL):
         self.configDic["publicName"] = publicName 
         self.configDic["port"] = port 
@@ -24,18 +49,20 @@ class Settings:
         self.dump()
 
     def dump(self):
-        with open(CONFIG_FILE, 'w') as file:
+        with open(self.filename, 'w') as file:
             file.write(json.dumps(self.configDic))
 
     def load(self):
         data = {}
         try:
-            with open(CONFIG_FILE) as file:
+            with open(self.filename) as file:
                 data = json.loads(file.read())
         except Exception as e:
             pass 
-        if data.keys() == self.configDic.keys():
-            self.configDic = data 
+        for key in OBSOLETE_KEYS:
+            data.pop(key, None)
+        if FORM_KEYS <= data.keys() <= self.configDic.keys():
+            self.configDic.update(data)
             return True 
         return False 
 
@@ -4,4 +4,12 @@ class PortUnavailableError(Exception):
     pass 
 
 class FormIncompleteError(Exception):
+    pass 
+
+class RangeNotSatisfiableError(Exception):
+    pass
+
+class BindAddressError(Exception):
+    # listening was restricted to interfaces or addresses, none of which
+    # can be listened on
     pass 
\ No newline at end of file
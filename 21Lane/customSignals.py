@@ -12,19 +12,20 @@ class DownloadItemUpdater(QObject):
         self.signal.emit()
 
 
-class ServerStatsUpdater(QObject):
-    clientConnect = pyqtSignal()
-    clientDisconnect = pyqtSignal()
-    fileTransfer = pyqtSignal(int)
+class CallbackBridge(QObject):
+    # runs callbacks connected to events.Signal on the GUI thread, the
+    # server emits them from its own threads
+    call = pyqtSignal(object, tuple)
 
-    def connected(self):
-        self.clientConnect.emit()
+    def __init__(self):
+        super().__init__()
+        self.call.connect(self.dispatch)
 
-    def disconnected(self):
-        self.clientDisconnect.emit()
+    def dispatch(self, callback, args):
+        callback(*args)
 
-    def transferred(self, filesize):
-        self.fileTransfer.emit(filesize)
+    def wrap(self, callback):
+        return lambda *args: self.call.emit(callback, args)
 
 
 class DownloadItemUpdater(QObject):
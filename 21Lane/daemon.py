@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+# `start.py serve`: share a folder without the GUI and without loading Qt
+# settings come from config.json, options on the command line override them
+
+import argparse
+import signal
+from threading import Event
+from time import time
+
+from config import Settings, CONFIG_FILE
+from server import Server
+from exchangeClient import ExchangeClient
+from metrics import MetricsServer, registerShareGauges, shareHealth
+from bandwidth import MEGABIT
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(prog="21lane serve", description="Share a folder without the GUI.")
+    parser.add_argument("--config", default=CONFIG_FILE, help="settings file, default %(default)s")
+    parser.add_argument("--shared-dir", dest="sharedDir", help="folder to share")
+    parser.add_argument("--port", type=int, help="FTP port")
+    parser.add_argument("--name", dest="publicName", help="name shown to peers")
+    parser.add_argument("--exchange-url", dest="exchangeURL", help="group URL, empty for none")
+    parser.add_argument("--speed-limit", dest="speedLimit", type=int, help="Mbps, 0 for no limit")
+    parser.add_argument("--bind", dest="bindAddresses", action="append", metavar="ADDRESS", \
+        help="interface name or address to listen on, repeat for more; default all")
+    parser.add_argument("--http-port", dest="httpPort", type=int, help="serve the share over HTTP too, 0 for FTP only")
+    parser.add_argument("--metrics-port", dest="metricsPort", type=int, help="0 turns the endpoint off")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parseArgs(argv)
+    settings = Settings(args.config)
+    settings.load()
+    configDic = settings.configDic
+    for key in ("sharedDir", "port", "publicName", "exchangeURL", "speedLimit", "metricsPort", "bindAddresses", "httpPort"):
+        if getattr(args, key) is not None:
+            configDic[key] = getattr(args, key)
+    if not configDic["sharedDir"]:
+        print ("nothing to share, set sharedDir in %s or pass --shared-dir" % args.config)
+        return 1
+
+    server = Server()
+    xchgClient = ExchangeClient()
+    # settings first, the port is checked on the addresses they bind
+    server.applySettings(configDic)
+    try:
+        server.setPort(configDic["port"])
+        server.setSharedDirectory(configDic["sharedDir"])
+    except Exception as e:
+        print ("cannot share", configDic["sharedDir"], "on port", configDic["port"], e.__class__.__name__, e)
+        return 1
+    server.setBandwidth(configDic["speedLimit"] * MEGABIT)
+
+    stopped = Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+
+    try:
+        server.start()
+    except Exception as e:
+        print ("cannot listen on port", configDic["port"], e.__class__.__name__, e)
+        return 1
+    xchgClient.updateInfo(configDic["publicName"], configDic["exchangeURL"] or None, configDic["port"], server.bindAddresses)
+    xchgClient.updateDir(configDic["sharedDir"], server.index)
+    print ("sharing", configDic["sharedDir"], "on port", configDic["port"])
+    if server.http is not None:
+        print ("HTTP on port", configDic["httpPort"])
+
+    startTime = time()
+    metricsServer = None
+    if configDic["metricsPort"]:
+        metrics = server.ftp_handler.stats.metrics
+        registerShareGauges(metrics, server, xchgClient)
+        try:
+            metricsServer = MetricsServer(metrics, configDic["metricsPort"], \
+                lambda: shareHealth(server, xchgClient, startTime))
+            metricsServer.start()
+        except OSError as e:
+            print ("metrics endpoint unavailable", e)
+
+    # wake up now and then, a server thread that died takes us down with it
+    while not stopped.wait(1):
+        if not server.isRunning():
+            print ("server stopped unexpectedly")
+            break
+
+    server.stopServer()
+    xchgClient.stop()
+    if metricsServer:
+        metricsServer.stop()
+    return 0 if stopped.is_set() else 1
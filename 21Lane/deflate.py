@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+# MODE Z transfers: everything sent over the data connection is one zlib
+# stream. Files that are compressed already, and data that turns out not
+# to compress, go out as stored deflate blocks, which cost about a copy.
+# The stream is put together from raw deflate pieces, each ended with a
+# sync flush, so the level can change from one chunk to the next.
+
+import zlib
+import struct
+from mimetypes import guess_type
+
+DEFAULT_LEVEL = 6
+# a chunk is test compressed every PROBE_INTERVAL bytes, at level 1
+PROBE_INTERVAL = 1048576
+# compressing to more than this part of the size is not worth it
+POOR_RATIO = 0.9
+ZLIB_HEADER = b"\x78\x9c"
+COMPRESSED_PREFIXES = ("video/", "audio/", "image/")
+# media types among those that are not compressed
+UNCOMPRESSED_MEDIA = {"audio/x-wav", "audio/wav", "image/bmp", "image/x-ms-bmp", "image/tiff", \
+    "image/svg+xml", "image/x-portable-pixmap", "image/x-portable-graymap", "image/x-portable-bitmap"}
+COMPRESSED_TYPES = {"application/zip", "application/gzip", "application/x-gzip", "application/x-bzip2", \
+    "application/x-xz", "application/x-7z-compressed", "application/x-rar-compressed", "application/vnd.rar", \
+    "application/zstd", "application/java-archive", "application/vnd.android.package-archive", \
+    "application/epub+zip", "application/x-iso9660-image"}
+# zip based office documents
+COMPRESSED_TYPE_PREFIXES = ("application/vnd.openxmlformats-officedocument.", "application/vnd.oasis.opendocument.")
+
+
+def isCompressed(path):
+    # whether the file's name says its content is compressed already
+    type, encoding = guess_type(path)
+    if encoding is not None:
+        return True
+    if type is None or type in UNCOMPRESSED_MEDIA:
+        return False
+    return type.startswith(COMPRESSED_PREFIXES) or type.startswith(COMPRESSED_TYPE_PREFIXES) \
+        or type in COMPRESSED_TYPES
+
+
+class DeflateProducer:
+    # wraps a pyftpdlib producer, more() returns the zlib stream of what it
+    # produces; done(bytesIn, bytesOut) is called once the stream is complete
+    def __init__(self, producer, level, stored=False, done=None):
+        self.producer = producer
+        self.level = level
+        # stored from start to end, without probing
+        self.stored = stored
+        self.done = done
+        self.compressor = None
+        self.currentLevel = None
+        self.checksum = zlib.adler32(b"")
+        self.sinceProbe = PROBE_INTERVAL
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.started = False
+        self.finished = False
+
+    def chooseLevel(self, chunk):
+        if self.stored:
+            return 0
+        if self.sinceProbe < PROBE_INTERVAL:
+            return self.currentLevel
+        self.sinceProbe = 0
+        if len(zlib.compress(chunk, 1)) > len(chunk) * POOR_RATIO:
+            return 0
+        return self.level
+
+    def switchLevel(self, level, out):
+        if self.compressor is not None:
+            # byte aligned and not the last block, the next piece carries on
+            out.append(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.currentLevel = level
+
+    def more(self):
+        if self.finished:
+            return b""
+        header = b"" if self.started else ZLIB_HEADER
+        self.started = True
+        out = []
+        # the compressor keeps small inputs back, feed it until there is
+        # something to send
+        while not any(out):
+            chunk = self.producer.more()
+            if not chunk:
+                if self.compressor is None:
+                    self.switchLevel(0, out)
+                out.append(self.compressor.flush(zlib.Z_FINISH))
+                out.append(struct.pack(">I", self.checksum))
+                self.finished = True
+                break
+            self.checksum = zlib.adler32(chunk, self.checksum)
+            self.bytesIn += len(chunk)
+            level = self.chooseLevel(chunk)
+            self.sinceProbe += len(chunk)
+            if level != self.currentLevel:
+                self.switchLevel(level, out)
+            out.append(self.compressor.compress(chunk))
+        data = header + b"".join(out)
+        self.bytesOut += len(data)
+        if self.finished and self.done is not None:
+            self.done(self.bytesIn, self.bytesOut)
+        return data
@@ -1,13 +1,75 @@
 #!/usr/bin/python3 
 
-from ftplib import FTP
-from time import sleep
+import zlib
+import asyncio
+from ftplib import error_perm
+from time import monotonic
+from urllib.parse import quote
 from os.path import exists as path_exists
 from os.path import dirname as get_dirname
-from os import makedirs
+from os.path import join as join_path
+from os.path import realpath
+from os import makedirs, utime, sep
+
+from ftpClient import AsyncFTP
+from tarStream import TarReader
+
+CHUNK_SIZE = 65536
+# progress is reported this often at most, a thousand downloads must not
+# flood the GUI with signals
+PROGRESS_INTERVAL = 0.1 # seconds
+
+
+class DataStream:
+    # the data connection, inflated on the way in for MODE Z transfers
+    def __init__(self, ftp, reader, decompressor):
+        self.ftp = ftp
+        self.reader = reader
+        self.decompressor = decompressor
+        self.pending = bytearray()
+
+    async def fill(self):
+        # more bytes into pending, False at the end of the stream
+        if self.decompressor is None:
+            data = await self.ftp.wait(self.reader.read(CHUNK_SIZE))
+            self.pending += data
+            return bool(data)
+        if self.decompressor.eof:
+            return False
+        # bounded, a few KB of zeros inflate to any size
+        data = self.decompressor.unconsumed_tail
+        if not data:
+            data = await self.ftp.wait(self.reader.read(CHUNK_SIZE))
+            if not data:
+                raise EOFError("compressed stream ended early")
+        self.pending += self.decompressor.decompress(data, CHUNK_SIZE)
+        return True
+
+    async def read1(self):
+        # whatever comes next, b"" at the end
+        while not self.pending:
+            if not await self.fill():
+                return b""
+        data = bytes(self.pending)
+        self.pending.clear()
+        return data
+
+    async def read(self, size):
+        # exactly size bytes
+        while len(self.pending) < size:
+            if not await self.fill():
+                raise EOFError("stream ended early")
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+    async def drain(self):
+        while await self.read1():
+            pass
+
 
 class DownloadItem:
-    def __init__(self, filename, host, port, sourcePath, destPath, size, signal):
+    def __init__(self, filename, host, port, sourcePath, destPath, size, signal, folder=False):
         self.filename = filename 
         self.host = host 
         self.port = port 
@@ -18,6 +80,14 @@ class DownloadItem:
         self.guisignal = signal 
         self.completed = False
         self.worker = None 
+        # a folder comes as one tar stream, unpacked into destPath
+        self.folder = folder
+        # the last file unpacked in full, a retry goes on after it
+        self.resumeAfter = None
+        self.filesCompleted = 0
+        self.bytesKept = 0
+        # got in full, a retry leaves it be
+        self.done = False
 
     def updateGuiComponents(self, dic):
         self.gui = dic 
@@ -32,61 +102,147 @@ class DownloadItem:
 
 
 class Downloader:
-    def __init__(self, sema):
-        self.di = None
-        self.ftp = None 
-        self.fileptr = None 
-        self.running = False 
-        self.sharedSem = sema
-    
-    def update(self, di):
-        self.di = di 
-    
+    # one download, run as a task on the engine's loop by DownloadManager
+    def __init__(self, di):
+        self.di = di
+        self.ftp = None
+        self.fileptr = None
+        self.running = False
+        # the engine's future for the task, cancelled by abort()
+        self.future = None
+        self.lastReport = 0
+
     def abort(self):
-        self.running = False 
+        self.running = False
+        if self.future is not None:
+            self.future.cancel()
 
     def cleanup(self):
         try:
             if self.ftp:
-                self.ftp.quit()
-            self.fileptr.close() 
-            self.running = False 
-            del self.fileptr
-            del self.ftp 
+                self.ftp.close()
+            if self.fileptr:
+                self.fileptr.close()
         except Exception as e:
-            print ("cleanup", self.di.filename, e) 
+            print ("cleanup", self.di.filename, e)
         finally:
-            self.di = None 
-            self.ftp = None 
-            self.fileptr = None 
-
-    def callback(self, data):
-        if not self.running:
-            self.ftp.quit()
-            self.running = False 
-            self.di.guisignal.raiseError()
-            return
+            self.running = False
+            self.ftp = None
+            self.fileptr = None
+
+    def report(self, force=False):
+        now = monotonic()
+        if force or now - self.lastReport >= PROGRESS_INTERVAL:
+            self.lastReport = now
+            self.di.guisignal.updateProgress(self.di.completed)
+
+    def write(self, data):
         self.fileptr.write(data)
-        self.di.completed += len(data) 
-        self.di.guisignal.updateProgress(self.di.completed)
-            
-    def download(self):
+        # progress counts bytes of the file, not of the wire
+        self.di.completed += len(data)
+        self.report()
+
+    async def fetchFile(self, decompressor):
+        reader, writer = await self.ftp.transfercmd("RETR " + self.di.source)
+        try:
+            stream = DataStream(self.ftp, reader, decompressor)
+            while True:
+                data = await stream.read1()
+                if not data:
+                    break
+                self.write(data)
+            if decompressor is not None and not decompressor.eof:
+                raise EOFError("compressed stream ended early")
+        finally:
+            writer.close()
+        await self.ftp.voidresp()
+
+    async def fetchFolder(self, decompressor):
+        # one SITE TAR transfer unpacked as it comes in, every file done
+        # is remembered so that a retry only asks for those after it
+        after = quote(self.di.resumeAfter, errors="surrogateescape") if self.di.resumeAfter else "-"
+        # a file cut off last time is sent again in full
+        self.di.completed = self.di.bytesKept
+        reader, writer = await self.ftp.transfercmd("SITE TAR %s %s" % (after, self.di.source))
+        try:
+            stream = DataStream(self.ftp, reader, decompressor)
+            tar = TarReader(stream.read)
+            while True:
+                member = await tar.next()
+                if member is None:
+                    break
+                await self.extract(tar, member)
+            # the rest of the stream, the server finishes before we hang up
+            await stream.drain()
+        finally:
+            writer.close()
+        await self.ftp.voidresp()
+
+    async def extract(self, tar, member):
+        base = realpath(self.di.destination)
+        target = realpath(join_path(base, member.name))
+        # nothing lands outside the destination, whatever the names say
+        if not target.startswith(base + sep):
+            return
+        if member.isdir():
+            makedirs(target, exist_ok=True)
+            return
+        if not member.isfile():
+            return
+        makedirs(get_dirname(target), exist_ok=True)
+        with open(target, "wb") as file:
+            while True:
+                data = await tar.readData()
+                if not data:
+                    break
+                file.write(data)
+                self.di.completed += len(data)
+                self.report()
+        utime(target, (member.mtime, member.mtime))
+        self.di.resumeAfter = member.name
+        self.di.filesCompleted += 1
+        self.di.bytesKept = self.di.completed
+
+    async def download(self):
+        failed = True
+        self.running = True
         try:
-            if not path_exists(get_dirname(self.di.destination)):
-                makedirs(get_dirname(self.di.destination))
-            self.fileptr = open(self.di.destination, "wb")
-            self.ftp = FTP()
-            self.ftp.connect(self.di.host, self.di.port)
-            self.ftp.login()
-            self.running = True 
-            self.ftp.retrbinary("RETR "+self.di.source, self.callback)
+            if self.di.folder:
+                makedirs(self.di.destination, exist_ok=True)
+            else:
+                if not path_exists(get_dirname(self.di.destination)):
+                    makedirs(get_dirname(self.di.destination))
+                self.fileptr = open(self.di.destination, "wb")
+            self.ftp = AsyncFTP()
+            await self.ftp.connect(self.di.host, self.di.port)
+            await self.ftp.login()
+            await self.ftp.setType("I")
+            try:
+                # peers that cannot compress refuse it, the file comes plain
+                await self.ftp.sendcmd("MODE Z")
+                decompressor = zlib.decompressobj()
+            except error_perm:
+                decompressor = None
+            if self.di.folder:
+                await self.fetchFolder(decompressor)
+            else:
+                await self.fetchFile(decompressor)
+            failed = False
+            try:
+                await self.ftp.quit()
+            except Exception:
+                pass
+        except asyncio.CancelledError:
+            print ("download:", self.di.filename, "cancelled")
+            raise
         except Exception as e:
             print ("download:", self.di.filename, e)
-            self.di.guisignal.raiseError()
-        else:
-            self.di.guisignal.complete.emit()
         finally:
-            print (self.di.filename, "completed by", self)
-            self.di.worker = None 
             self.cleanup()
-            self.sharedSem.release()
+            self.di.worker = None
+            self.report(True)
+            if failed:
+                self.di.guisignal.raiseError()
+            else:
+                self.di.done = True
+                self.di.guisignal.complete.emit()
@@ -1,92 +1,77 @@
-#!/usr/bin/python3 
+#!/usr/bin/python3
+
+import asyncio
 
 from downloader import Downloader, DownloadItem
-from os import cpu_count
-from os import path 
-from threading import Thread, BoundedSemaphore, Lock, Condition
+from engine import sharedEngine
 
-max_workers = cpu_count()
+# downloads are tasks on the engine's loop, not threads, so the limits are
+# about the peers: a server takes 8 connections per address by default and
+# the browser needs one of them
+MAX_ACTIVE_DOWNLOADS = 64
+MAX_DOWNLOADS_PER_HOST = 4
 
 class DownloadManager:
-    def __init__(self):
-        self.workerPool = []
-        # semaphore blocks on 0
-        self.workerSem = BoundedSemaphore(max_workers-1) 
-        self.downloadQueue = []
-        # to wakeup and suspend downloader subprocess
-        self.queueCv = Condition()
-        # classical producer consumer problem (applying condition variables)
-        self.batchProcessor = None   
-        self.running = False   
-        for i in range(max_workers):
-            self.workerPool.append(Downloader(self.workerSem))
+    def __init__(self, engine=None):
+        self.engine = engine or sharedEngine()
+        self.slots = asyncio.Semaphore(MAX_ACTIVE_DOWNLOADS)
+        # (host, port) -> Semaphore
+        self.hostSlots = {}
+        # the Downloader of every item queued or running
+        self.workers = set()
+        self.queued = 0
+        self.active = 0
+        self.running = False
         self.startDownloader()
-        
+
     def startDownloader(self):
-        if (not self.batchProcessor) or (not self.batchProcessor.is_alive()):
-            self.batchProcessor = Thread(target=self.downloadManager)
-            self.running = True 
-            self.batchProcessor.start()
-            print("download manager started")
-        else:
-            print('download manager already running', end=' ')
+        self.running = True
+        self.engine.start()
+        print("download manager started")
 
     def stopDownloader(self):
-        try:
-            self.running = False 
-            self.queueCv.acquire()
-            self.queueCv.notify() 
-            self.queueCv.release()
-        except ValueError:
-            pass 
-        self.batchProcessor.join()
-        del self.batchProcessor
-        self.batchProcessor = None 
+        self.running = False
+        for worker in list(self.workers):
+            worker.abort()
+        print ("download manager quits")
 
     def addItem(self, di):
-        self.queueCv.acquire()
-        self.downloadQueue.append(di)
+        # safe from any thread, the download waits on the loop for a slot
+        worker = Downloader(di)
+        di.worker = worker
+        self.workers.add(worker)
+        worker.future = self.engine.submit(self.fetch(worker))
         print ('added', di.filename)
-        self.queueCv.notify()
-        self.queueCv.release()
-        print ('notified')
+
+    def queueDepths(self):
+        return { "queued": self.queued, "active": self.active }
 
     def removeItem(self, di):
         if di.worker:
             di.worker.abort()
-        self.queueCv.acquire()
-        self.downloadQueue.remove(di)
-        self.queueCv.release()       
-    
-    def downloadManager(self):
-        threadlist = []
-        workingList = []
-        while self.running:
-            self.queueCv.acquire()
-            while not self.downloadQueue and self.running:
-                self.queueCv.wait()
-            if not self.running:
-                break
-            di = self.downloadQueue.pop()
-            workingList.append(di)
-            self.queueCv.release()
-            self.workerSem.acquire()
-            print (self.workerSem._value)
-            avail_workers = [ worker for worker in self.workerPool if not worker.running ]
-            if not avail_workers:
-                print ("WTF in worker synchronisation")
-                raise Exception
-            worker = avail_workers[0]
-            di.worker = worker
-            worker.update(di)
-            th = Thread(target=worker.download)
-            th.start()
-            while not worker.running:
-                pass 
-            threadlist.append(th)
-        
-        print ('waiting for downloaders to exit')
-        for thread in threadlist:
-            thread.join()
-        print ("download manager quits")
 
+    async def fetch(self, worker):
+        di = worker.di
+        host = (di.host, di.port)
+        if host not in self.hostSlots:
+            self.hostSlots[host] = asyncio.Semaphore(MAX_DOWNLOADS_PER_HOST)
+        self.queued += 1
+        queued = True
+        try:
+            async with self.slots, self.hostSlots[host]:
+                self.queued -= 1
+                queued = False
+                self.active += 1
+                try:
+                    await worker.download()
+                finally:
+                    self.active -= 1
+        except asyncio.CancelledError:
+            if queued:
+                # cancelled before it started, the GUI still hears of it
+                di.worker = None
+                di.guisignal.raiseError()
+        finally:
+            if queued:
+                self.queued -= 1
+            self.workers.discard(worker)
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+# one asyncio loop, in a thread of its own, that downloads, browses peers,
+# sends exchange heartbeats and serves HTTP, so that a thousand transfers
+# are a thousand tasks rather than a thousand threads. The FTP server keeps
+# to pyftpdlib's own loop.
+# Work is handed in from any thread with submit(); what it returns comes
+# back through a callback, which the GUI passes through
+# customSignals.CallbackBridge to have it run on its own thread.
+
+import asyncio
+from threading import Thread, Lock, get_ident
+
+STOP_TIMEOUT = 2 # seconds given to what is still running on stop()
+
+
+class Engine:
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.lock = Lock()
+
+    def start(self):
+        with self.lock:
+            if self.isRunning():
+                return
+            self.loop = asyncio.new_event_loop()
+            self.thread = Thread(target=self.loop.run_forever, name="engine", daemon=True)
+            self.thread.start()
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def inLoop(self):
+        return self.thread is not None and self.thread.ident == get_ident()
+
+    def submit(self, coro, callback=None):
+        # runs coro on the loop, callback(future) once it is done, on the
+        # loop thread; the concurrent.futures.Future is returned
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def run(self, coro, timeout=None):
+        # submit() and wait for the result, never from the loop itself
+        if self.inLoop():
+            raise RuntimeError("engine.run() would block the loop it waits on")
+        return self.submit(coro).result(timeout)
+
+    def call(self, callback, *args):
+        # callback(*args) on the loop thread, as soon as it gets to it
+        self.start()
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self):
+        with self.lock:
+            if not self.isRunning():
+                return
+            future = asyncio.run_coroutine_threadsafe(self.cancelAll(), self.loop)
+            try:
+                future.result(STOP_TIMEOUT)
+            except Exception as e:
+                print ("engine tasks did not stop in time", e)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(STOP_TIMEOUT)
+            if not self.thread.is_alive():
+                self.loop.close()
+            self.thread = None
+
+    async def cancelAll(self):
+        current = asyncio.current_task()
+        tasks = [ task for task in asyncio.all_tasks() if task is not current ]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=STOP_TIMEOUT)
+
+
+shared = Engine()
+
+def sharedEngine():
+    # the engine of this process, started on first use
+    return shared
@@ -0,0 +1,32 @@
+#!/usr/bin/python3
+
+# a Qt-free stand-in for pyqtSignal, so the server and the exchange client
+# run without loading Qt. Callbacks are run on the emitting thread, the GUI
+# hands them to its own thread through customSignals.CallbackBridge.
+
+from threading import Lock
+
+
+class Signal:
+    def __init__(self):
+        self.lock = Lock()
+        self.callbacks = []
+
+    def connect(self, callback):
+        with self.lock:
+            self.callbacks.append(callback)
+
+    def disconnect(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def emit(self, *args):
+        with self.lock:
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            try:
+                callback(*args)
+            except Exception as e:
+                # one broken subscriber must not stop the server
+                print ("signal handler failed", e)
@@ -1,33 +1,42 @@
 #!/usr/bin/python3 
 
-from threading import Thread  
+import asyncio
 from requests import post as POST
-from time import sleep  
+from time import time
 
-from os import listdir as ls 
-from os.path import join, getsize, isdir, islink
-
-from PyQt5.QtCore import QThread
+from engine import sharedEngine
+from network import advertisedAddresses
+from shareIndex import ShareIndex
 
 REFRESH_INTERVAL = 900 # 15 minutes
+SIZE_UPDATE_INTERVAL = 60 # earliest heartbeat after the share changed
 REQUEST_TIMEOUT  = 5   # 5 seconds
 HEADERS = {
     "user-agent": "21Lane"
 }
 
-class ExchangeClient(QThread):
-    def __init__(self):
-        super().__init__()
+class ExchangeClient:
+    # heartbeats are a task on the engine's loop; requests blocks, so the
+    # POSTs themselves go to the loop's executor
+    def __init__(self, engine=None):
         self.exchangeURI = ''
         self.port = 2121
         self.sessionId = None 
         self.publicName = ''
         self.sharedSize = 0
-        self.setTerminationEnabled(True)
-        self.finished.connect(self.deauthorize)
+        # heartbeat health, reported by the metrics endpoint
+        self.lastHeartbeat = 0
+        self.heartbeatOk = False
+        # what the server listens on, the matching addresses are advertised
+        self.bindAddresses = []
+        self.engine = engine or sharedEngine()
+        self.task = None
+        self.stopped = None
+        self.wakeup = None
 
-    def updateInfo(self, publicName, exchange_url=None, port=2121):
+    def updateInfo(self, publicName, exchange_url=None, port=2121, bindAddresses=()):
         self.port = port 
+        self.bindAddresses = list(bindAddresses)
         self.publicName = publicName
         self.exchangeURI = exchange_url 
 
@@ -39,9 +48,13 @@ class ExchangeClient(QThread):
             "publicName": self.publicName,
             "port": self.port,
             "sessionId": "" if self.sessionId is None else self.sessionId, 
-            "sharedSize": self.sharedSize                
+            "sharedSize": self.sharedSize
         }
+        self.heartbeatOk = False
         try:
+            # every address we can be reached on, peers pick the fastest;
+            # looked up on every heartbeat as they come and go
+            payload["addresses"] = ",".join(advertisedAddresses(self.bindAddresses))
             r = POST(url=self.exchangeURI, data=payload, headers=HEADERS, timeout=REQUEST_TIMEOUT)
             if r.status_code == 200:
                 if r.text.strip() == "failed":
@@ -50,6 +63,8 @@ class ExchangeClient(QThread):
                     print ("caperror")
                 else:
                     self.sessionId = r.text.strip()
+                    self.heartbeatOk = True
+                    self.lastHeartbeat = time()
                     print (self.sessionId)
             else:
                 print("error", r.status_code)
@@ -102,36 +117,74 @@ class ExchangeClient(QThread):
         except Exception as e:
             print ("Error occured", e)
     
-    def updateDir(self, directory):
-        self.sharedDir = directory
+    async def fetchUserList(self):
+        # getUserList() for the engine's loop
+        return await asyncio.get_running_loop().run_in_executor(None, self.getUserList)
+
+    def isRunning(self):
+        return self.task is not None and not self.task.done()
+
+    def stop(self):
+        # run() logs out on its way out, a request in flight may keep it
+        # a little longer than we wait here
         if self.isRunning():
-            self.quit()
-            if not self.wait(1000):
-                self.terminate()
-        self.start()
+            self.engine.call(self.stopped.set)
+            self.engine.call(self.wakeup.set)
+            try:
+                self.task.result(1)
+            except Exception:
+                pass
+
+    def updateDir(self, directory, index=None):
+        # index is the server's ShareIndex, without one the folder is
+        # walked before every heartbeat
+        self.sharedDir = directory
+        self.stop()
+        self.stopped = asyncio.Event()
+        self.wakeup = asyncio.Event()
+        self.task = self.engine.submit(self.run(self.stopped, self.wakeup, index))
         print("snapshot proc started")
 
-    def getTotalSharedSize(self, pwd):
-        if not self.isRunning():
-            return 
+    async def waitFor(self, event, timeout):
+        # whether event was set within timeout seconds
         try:
-            for file in ls(pwd):
-                if isdir(join(pwd, file)) and (not islink(join(pwd, file))):
-                    self.getTotalSharedSize(join(pwd, file))
-                else:
-                    self.sharedSize += getsize(join(pwd, file))
-        except RecursionError:
-            return 
-        except Exception as e:
-            pass 
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
 
-    def run(self):
-        while True:
-            try:
-                self.sharedSize = 0
-                self.getTotalSharedSize(self.sharedDir)
-            except RecursionError:
-                pass 
-            self.authorize()
-            self.sleep(REFRESH_INTERVAL)
-        
\ No newline at end of file
+    def walkShare(self):
+        walked = ShareIndex(self.sharedDir, useInotify=False)
+        walked.scan([ "" ], {})
+        return walked.totalSize
+
+    async def run(self, stopped, wakeup, index):
+        loop = asyncio.get_running_loop()
+        # the index tells from its own threads
+        shareChanged = lambda changes: loop.call_soon_threadsafe(wakeup.set)
+        if index is not None:
+            index.changed.connect(shareChanged)
+        try:
+            while not stopped.is_set():
+                if index is not None:
+                    # the exchange should not see the size of a half walked share
+                    if not await loop.run_in_executor(None, index.ready.wait, REQUEST_TIMEOUT):
+                        continue
+                    self.sharedSize = index.totalSize
+                else:
+                    # nobody keeps an index for us, walk the share every time
+                    self.sharedSize = await loop.run_in_executor(None, self.walkShare)
+                if stopped.is_set():
+                    break
+                await loop.run_in_executor(None, self.authorize)
+                # the next heartbeat is due after REFRESH_INTERVAL, or sooner
+                # once the share changed, but not more often than every
+                # SIZE_UPDATE_INTERVAL
+                if await self.waitFor(stopped, SIZE_UPDATE_INTERVAL):
+                    break
+                await self.waitFor(wakeup, REFRESH_INTERVAL - SIZE_UPDATE_INTERVAL)
+                wakeup.clear()
+        finally:
+            if index is not None:
+                index.changed.disconnect(shareChanged)
+            await loop.run_in_executor(None, self.deauthorize)
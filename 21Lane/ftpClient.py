@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+
+# a small FTP client for the engine's asyncio loop: what downloads and the
+# browser need of ftplib, without a thread blocked on every connection.
+# Replies are raised as ftplib's own errors, error_perm for 5xx and
+# error_temp for 4xx, so callers catch the same things as before.
+
+import asyncio
+import socket
+from ftplib import error_reply, error_temp, error_perm, error_proto
+
+MAX_LINE = 8192
+CHUNK_SIZE = 65536
+DEFAULT_TIMEOUT = 30 # seconds
+ENCODING = "utf-8"
+
+
+class AsyncFTP:
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self.host = None
+        self.port = None
+        self.reader = None
+        self.writer = None
+        self.family = socket.AF_INET
+        # the TYPE in effect, sent again only when it changes
+        self.type = None
+
+    async def wait(self, awaitable):
+        return await asyncio.wait_for(awaitable, self.timeout or None)
+
+    async def connect(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader, self.writer = await self.wait(asyncio.open_connection(host, port, limit=MAX_LINE))
+        self.family = self.writer.get_extra_info("socket").family
+        return await self.getresp()
+
+    async def login(self, user="anonymous", passwd="anonymous@"):
+        resp = await self.sendcmd("USER " + user)
+        if resp[0] == "3":
+            resp = await self.sendcmd("PASS " + passwd)
+        if resp[0] != "2":
+            raise error_reply(resp)
+        return resp
+
+    async def getline(self):
+        try:
+            line = await self.wait(self.reader.readline())
+        except ValueError:
+            raise error_proto("reply line too long")
+        if not line:
+            raise EOFError("connection closed by the server")
+        return line.decode(ENCODING, "surrogateescape").rstrip("\r\n")
+
+    async def getresp(self):
+        # the whole reply, continuation lines and all
+        line = await self.getline()
+        if line[3:4] == "-":
+            lines = [ line ]
+            while True:
+                line = await self.getline()
+                lines.append(line)
+                if line[:3] == lines[0][:3] and line[3:4] != "-":
+                    break
+            line = "\n".join(lines)
+        code = line[:1]
+        if code in "123":
+            return line
+        if code == "4":
+            raise error_temp(line)
+        if code == "5":
+            raise error_perm(line)
+        raise error_proto(line)
+
+    async def sendcmd(self, cmd):
+        self.writer.write((cmd + "\r\n").encode(ENCODING, "surrogateescape"))
+        await self.wait(self.writer.drain())
+        return await self.getresp()
+
+    async def voidcmd(self, cmd):
+        resp = await self.sendcmd(cmd)
+        if resp[0] != "2":
+            raise error_reply(resp)
+        return resp
+
+    async def voidresp(self):
+        resp = await self.getresp()
+        if resp[0] != "2":
+            raise error_reply(resp)
+        return resp
+
+    async def setType(self, type):
+        if type != self.type:
+            await self.voidcmd("TYPE " + type)
+            self.type = type
+
+    async def passive(self):
+        # like ftplib, the address in a PASV reply is ignored for the one
+        # we are connected to, it is often wrong behind NAT
+        if self.family == socket.AF_INET:
+            resp = await self.voidcmd("PASV")
+            numbers = resp[resp.index("(") + 1:resp.index(")")].split(",")
+            return (int(numbers[4]) << 8) + int(numbers[5])
+        resp = await self.voidcmd("EPSV")
+        return int(resp[resp.index("(") + 1:resp.index(")")].strip("|"))
+
+    async def transfercmd(self, cmd, rest=None):
+        # (reader, writer) of the data connection cmd opened
+        port = await self.passive()
+        reader, writer = await self.wait(asyncio.open_connection(self.host, port, limit=MAX_LINE))
+        try:
+            if rest is not None:
+                await self.sendcmd("REST %s" % rest)
+            resp = await self.sendcmd(cmd)
+            if resp[0] != "1":
+                raise error_reply(resp)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def retrbinary(self, cmd, callback, blocksize=CHUNK_SIZE, rest=None):
+        await self.setType("I")
+        reader, writer = await self.transfercmd(cmd, rest)
+        try:
+            while True:
+                data = await self.wait(reader.read(blocksize))
+                if not data:
+                    break
+                callback(data)
+        finally:
+            writer.close()
+        return await self.voidresp()
+
+    async def retrlines(self, cmd, callback):
+        await self.setType("A")
+        reader, writer = await self.transfercmd(cmd)
+        try:
+            while True:
+                line = await self.wait(reader.readline())
+                if not line:
+                    break
+                callback(line.decode(ENCODING, "surrogateescape").rstrip("\r\n"))
+        finally:
+            writer.close()
+        return await self.voidresp()
+
+    async def quit(self):
+        try:
+            await self.voidcmd("QUIT")
+        finally:
+            self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+
+# file checksums for the HASH / XMD5 / XCRC / XSHA* commands
+# digests are stored in a sqlite database keyed by (device, inode, size,
+# mtime), so every version of a file is hashed once. Hashing runs on a
+# small thread pool and reads the file in chunks, callers get a Future.
+
+import sqlite3
+import hashlib
+from zlib import crc32
+from os import stat
+from stat import S_ISREG
+from errno import EISDIR
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+HASH_CACHE_FILE = "hashes.db"
+HASH_WORKERS = 2
+HASH_CHUNK_SIZE = 1048576
+DEFAULT_ALGORITHM = "SHA-256"
+
+
+class Crc32:
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = crc32(data, self.value)
+
+    def hexdigest(self):
+        return "%08x" % self.value
+
+
+# names as used by the HASH command
+ALGORITHMS = {
+    "CRC32": Crc32,
+    "MD5": hashlib.md5,
+    "SHA-1": hashlib.sha1,
+    "SHA-256": hashlib.sha256,
+    "SHA-512": hashlib.sha512
+}
+
+
+def fileKey(path):
+    st = stat(path)
+    if not S_ISREG(st.st_mode):
+        raise IsADirectoryError(EISDIR, "Not a regular file", path)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class HashCache:
+    def __init__(self, filename=HASH_CACHE_FILE, workers=HASH_WORKERS):
+        self.lock = Lock()
+        self.db = sqlite3.connect(filename, timeout=5, check_same_thread=False)
+        # WAL lets prefork workers read while another one writes
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS hashes (
+            dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER,
+            algorithm TEXT, digest TEXT,
+            PRIMARY KEY (dev, ino, size, mtime, algorithm))""")
+        self.db.commit()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # (key, algorithm) -> Future, so concurrent requests share one run
+        self.pending = {}
+
+    def lookup(self, path, algorithm):
+        # cached digest or None, raises OSError for missing / non files
+        key = fileKey(path)
+        with self.lock:
+            try:
+                row = self.db.execute("SELECT digest FROM hashes WHERE dev=? AND ino=? AND size=? " \
+                    "AND mtime=? AND algorithm=?", key + (algorithm,)).fetchone()
+            except sqlite3.Error as e:
+                # locked, corrupt or closed: a miss, the file gets hashed
+                # without the cache
+                print ("hash cache:", e)
+                return None
+        return row[0] if row else None
+
+    def submit(self, path, algorithm):
+        key = fileKey(path)
+        with self.lock:
+            future = self.pending.get((key, algorithm))
+            if future is None:
+                future = self.executor.submit(self.compute, path, key, algorithm)
+                self.pending[(key, algorithm)] = future
+        return future
+
+    def compute(self, path, key, algorithm):
+        try:
+            digest = ALGORITHMS[algorithm]()
+            with open(path, "rb") as file:
+                while True:
+                    chunk = file.read(HASH_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+            digest = digest.hexdigest()
+            # a file rewritten while we read it gets a new key, don't
+            # store a digest of the mixture
+            if fileKey(path) == key:
+                with self.lock:
+                    try:
+                        self.db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)", \
+                            key + (algorithm, digest))
+                        self.db.commit()
+                    except sqlite3.Error as e:
+                        # closed underneath us or locked by another worker
+                        print ("hash cache:", e)
+            return digest
+        finally:
+            with self.lock:
+                self.pending.pop((key, algorithm), None)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+
+# the share over HTTP/1.1, for browsers and scripts that cannot do FTP:
+# files with Range support sent by sendfile(), folders as JSON listings,
+# many requests per connection. Served by the engine's asyncio loop, next
+# to the FTP server; downloads are paced by the same bandwidth governor
+# and counted by the same stats.
+#
+# a folder listing, GET /music/ :
+#   [{"name": "a.mp3", "type": "f", "size": 4096, "mtime": 1500000000}, ...]
+
+import asyncio
+import json
+import os
+from email.utils import formatdate
+from http import HTTPStatus
+from mimetypes import guess_type
+from stat import S_ISDIR, S_ISREG
+from urllib.parse import unquote, urlsplit
+
+from customErrors import RangeNotSatisfiableError
+from engine import sharedEngine
+from manifest import TYPE_FILE, TYPE_DIR
+from serverStats import REJECT_CONNECTIONS, REJECT_PER_IP, REJECT_TRANSFERS
+
+SERVER_NAME = "21Lane"
+# longest request or header line, and most header lines, taken
+MAX_LINE = 8192
+MAX_HEADERS = 100
+# bytes handed to sendfile() at a time when there is no speed limit
+SENDFILE_CHUNK = 1048576
+RETRY_AFTER = 5 # seconds, for clients turned away while busy
+STOP_TIMEOUT = 2
+
+
+def parseRange(header, size):
+    # (first, last) byte of a single bytes range, None for a header to
+    # ignore and send the whole file, as for several ranges at once
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            # the last so many bytes
+            count = int(last)
+            if count <= 0:
+                raise RangeNotSatisfiableError
+            return max(0, size - count), size - 1
+        first = int(first)
+        last = int(last) if last else None
+    except ValueError:
+        return None
+    if first < 0 or last is not None and last < first:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiableError
+    return first, size - 1 if last is None else min(last, size - 1)
+
+
+def wantsKeepAlive(version, headers):
+    tokens = { token.strip().lower() for token in headers.get("connection", "").split(",") }
+    if version == "HTTP/1.0":
+        return "keep-alive" in tokens
+    return "close" not in tokens
+
+
+class HttpServer:
+    def __init__(self, root, governor, stats, engine=None):
+        self.root = os.path.realpath(root)
+        self.governor = governor
+        self.stats = stats
+        # seconds to wait for a request, and for a client to take data
+        self.timeout = 0
+        self.dataTimeout = 0
+        # 0 for no limit; Semaphore with a slot per download, None for no limit
+        self.maxConnections = 0
+        self.maxConnectionsPerIP = 0
+        self.transferSlots = None
+        # readPolicy.ReadPolicy for files sent, None to leave the cache alone
+        self.readPolicy = None
+        self.clients = {} # ip -> open connections
+        self.tasks = set()
+        self.engine = engine or sharedEngine()
+        self.stopping = None
+        self.serving = None
+
+    def start(self, socks):
+        # serves on the given listening sockets until stop()
+        self.stopping = asyncio.Event()
+        self.serving = self.engine.submit(self.serve(socks))
+
+    def stop(self):
+        if self.serving is None:
+            return
+        self.engine.call(self.stopping.set)
+        try:
+            self.serving.result(STOP_TIMEOUT)
+        except Exception as e:
+            print ("http server did not stop in time", e)
+        self.serving = None
+
+    async def serve(self, socks):
+        servers = []
+        for sock in socks:
+            servers.append(await asyncio.start_server(self.handle, sock=sock, limit=MAX_LINE))
+        await self.stopping.wait()
+        for server in servers:
+            server.close()
+            await server.wait_closed()
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        ip = writer.get_extra_info("peername")[0]
+        reason = self.admit(ip)
+        try:
+            if reason is not None:
+                self.stats.rejected(reason)
+                self.sendHead(writer, 503, { "Content-Length": "0", "Retry-After": str(RETRY_AFTER) }, False)
+                await writer.drain()
+                return
+            self.stats.httpConnected()
+            try:
+                while await self.serveRequest(reader, writer):
+                    pass
+            finally:
+                self.stats.httpDisconnected()
+        except (ConnectionError, asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            print ("http:", ip, e.__class__.__name__, e)
+        finally:
+            self.tasks.discard(task)
+            if reason is None:
+                self.leave(ip)
+            writer.close()
+
+    def admit(self, ip):
+        # None if the client may stay, else why it may not
+        if self.maxConnections and sum(self.clients.values()) >= self.maxConnections:
+            return REJECT_CONNECTIONS
+        if self.maxConnectionsPerIP and self.clients.get(ip, 0) >= self.maxConnectionsPerIP:
+            return REJECT_PER_IP
+        self.clients[ip] = self.clients.get(ip, 0) + 1
+        return None
+
+    def leave(self, ip):
+        self.clients[ip] -= 1
+        if not self.clients[ip]:
+            del self.clients[ip]
+
+    async def readRequest(self, reader):
+        # (method, target, version, headers) or None once the client is
+        # gone; raises ValueError for anything malformed or too long
+        line = b"\r\n"
+        while line in (b"\r\n", b"\n"):
+            line = await reader.readline()
+        if not line:
+            return None
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+            raise ValueError("bad request line")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line:
+                return None
+            if line in (b"\r\n", b"\n"):
+                break
+            name, colon, value = line.decode("latin-1").partition(":")
+            if not colon or len(headers) >= MAX_HEADERS:
+                raise ValueError("bad header")
+            headers[name.strip().lower()] = value.strip()
+        return parts[0], parts[1], parts[2], headers
+
+    async def serveRequest(self, reader, writer):
+        # answers one request, returns whether the connection stays open
+        try:
+            request = await asyncio.wait_for(self.readRequest(reader), self.timeout or None)
+        except ValueError:
+            await self.sendError(writer, 400, False)
+            return False
+        if request is None:
+            return False
+        method, target, version, headers = request
+        keepAlive = wantsKeepAlive(version, headers)
+        # nothing here takes a body, one left unread would be taken for
+        # the next request
+        if headers.get("content-length", "0") != "0" or "transfer-encoding" in headers:
+            keepAlive = False
+        if method not in ("GET", "HEAD"):
+            await self.sendError(writer, 405, keepAlive, { "Allow": "GET, HEAD" })
+            return keepAlive
+        path = self.resolve(target)
+        try:
+            if path is None:
+                raise FileNotFoundError
+            st = os.stat(path)
+        except OSError:
+            await self.sendError(writer, 404, keepAlive)
+            return keepAlive
+        if S_ISDIR(st.st_mode):
+            return await self.sendListing(writer, method, path, keepAlive)
+        if S_ISREG(st.st_mode):
+            return await self.sendFile(writer, method, path, st, headers, keepAlive)
+        await self.sendError(writer, 404, keepAlive)
+        return keepAlive
+
+    def resolve(self, target):
+        # the file a request is for, None for anything outside the share;
+        # links leading out of it are refused, as on the FTP side
+        path = unquote(urlsplit(target).path, errors="surrogateescape")
+        parts = [ part for part in path.split("/") if part not in ("", ".") ]
+        if ".." in parts:
+            return None
+        path = os.path.realpath(os.path.join(self.root, *parts))
+        if path != self.root and not path.startswith(self.root.rstrip(os.sep) + os.sep):
+            return None
+        return path
+
+    def sendHead(self, writer, status, headers, keepAlive):
+        lines = [ "HTTP/1.1 %d %s" % (status, HTTPStatus(status).phrase),
+            "Server: " + SERVER_NAME,
+            "Date: " + formatdate(usegmt=True),
+            "Connection: " + ("keep-alive" if keepAlive else "close") ]
+        lines.extend("%s: %s" % header for header in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        self.stats.served(status)
+
+    async def sendError(self, writer, status, keepAlive, headers=None):
+        body = ("%d %s\n" % (status, HTTPStatus(status).phrase)).encode()
+        headers = dict(headers or {}, **{ "Content-Type": "text/plain", "Content-Length": str(len(body)) })
+        self.sendHead(writer, status, headers, keepAlive)
+        writer.write(body)
+        await writer.drain()
+
+    def listFolder(self, path):
+        entries = []
+        with os.scandir(path) as folder:
+            for entry in folder:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if S_ISDIR(st.st_mode):
+                    entries.append({ "name": entry.name, "type": TYPE_DIR, "size": 0, "mtime": int(st.st_mtime) })
+                elif S_ISREG(st.st_mode):
+                    entries.append({ "name": entry.name, "type": TYPE_FILE, "size": st.st_size, "mtime": int(st.st_mtime) })
+        entries.sort(key=lambda entry: entry["name"])
+        return json.dumps(entries).encode()
+
+    async def sendListing(self, writer, method, path, keepAlive):
+        self.stats.listed()
+        try:
+            # big folders take a while, the other clients go on meanwhile
+            body = await asyncio.get_running_loop().run_in_executor(None, self.listFolder, path)
+        except OSError:
+            await self.sendError(writer, 403, keepAlive)
+            return keepAlive
+        self.sendHead(writer, 200, { "Content-Type": "application/json", "Content-Length": str(len(body)), \
+            "Cache-Control": "no-cache" }, keepAlive)
+        if method == "GET":
+            writer.write(body)
+        await writer.drain()
+        return keepAlive
+
+    async def sendFile(self, writer, method, path, st, headers, keepAlive):
+        size = st.st_size
+        etag = '"%x-%x"' % (st.st_mtime_ns, size)
+        lastModified = formatdate(st.st_mtime, usegmt=True)
+        contentType = guess_type(path)[0] or "application/octet-stream"
+        common = { "Accept-Ranges": "bytes", "ETag": etag, "Last-Modified": lastModified }
+        if etag in headers.get("if-none-match", ""):
+            self.sendHead(writer, 304, common, keepAlive)
+            await writer.drain()
+            return keepAlive
+        status, first, last = 200, 0, size - 1
+        # a range of a file that changed since would be spliced onto the
+        # wrong content, If-Range asks for all of it then
+        if "range" in headers and headers.get("if-range", etag) in (etag, lastModified):
+            try:
+                byteRange = parseRange(headers["range"], size)
+            except RangeNotSatisfiableError:
+                await self.sendError(writer, 416, keepAlive, dict(common, **{ "Content-Range": "bytes */%d" % size }))
+                return keepAlive
+            if byteRange is not None:
+                status, (first, last) = 206, byteRange
+                common["Content-Range"] = "bytes %d-%d/%d" % (first, last, size)
+        if method == "HEAD":
+            self.sendHead(writer, status, dict(common, **{ "Content-Type": contentType, \
+                "Content-Length": str(last - first + 1) }), keepAlive)
+            await writer.drain()
+            return keepAlive
+        slots = self.transferSlots
+        if slots is not None and not slots.acquire(blocking=False):
+            self.stats.rejected(REJECT_TRANSFERS)
+            await self.sendError(writer, 503, keepAlive, { "Retry-After": str(RETRY_AFTER) })
+            return keepAlive
+        try:
+            try:
+                file = open(path, "rb")
+            except OSError:
+                await self.sendError(writer, 403, keepAlive)
+                return keepAlive
+            with file:
+                self.sendHead(writer, status, dict(common, **{ "Content-Type": contentType, \
+                    "Content-Length": str(last - first + 1) }), keepAlive)
+                await self.sendBody(writer, file, first, last - first + 1)
+        finally:
+            if slots is not None:
+                slots.release()
+        if last == size - 1:
+            self.stats.transferred(last - first + 1)
+        return keepAlive
+
+    async def sendBody(self, writer, file, offset, count):
+        # paced like an FTP data connection: each chunk is charged to the
+        # client's share of the governor, which says how long to wait
+        loop = asyncio.get_running_loop()
+        share = self.governor.register(writer.get_extra_info("peername")[0])
+        file.seek(offset)
+        cursor = self.readPolicy.follow(file) if self.readPolicy is not None else None
+        try:
+            while count > 0:
+                delay = share.delay()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                chunk = share.chunkSize(min(count, SENDFILE_CHUNK))
+                sent = await asyncio.wait_for(loop.sendfile(writer.transport, file, offset, chunk), \
+                    self.dataTimeout or None)
+                if not sent:
+                    # the file shrank, the promised length cannot be kept
+                    raise ConnectionAbortedError("file truncated")
+                share.charge(sent)
+                self.stats.sent(sent)
+                offset += sent
+                count -= sent
+                if cursor is not None:
+                    cursor.advance(offset)
+        finally:
+            self.governor.unregister(share)
+            if cursor is not None:
+                cursor.close()
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+# formatted LIST / MLSD output kept in memory per directory
+# an entry is valid as long as the directory mtime is unchanged; on Linux
+# inotify also catches changes to the files inside, which leave the
+# directory mtime alone. Least recently used entries go first once the
+# memory cap is reached. Missing listings are built on a few threads of
+# the cache, a big folder must not hold up the server's ioloop.
+
+from collections import OrderedDict
+from os import stat
+from select import select
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from inotify import Inotify, IN_DIR_CHANGES, IN_IGNORED, IN_Q_OVERFLOW
+
+DEFAULT_CACHE_SIZE = 64 * 1048576 # bytes
+WATCH_POLL_INTERVAL = 1 # seconds
+LISTING_WORKERS = 2
+
+
+class ListingCache:
+    def __init__(self, maxSize=DEFAULT_CACHE_SIZE, useInotify=True):
+        self.lock = Lock()
+        self.maxSize = maxSize
+        self.size = 0
+        # (path, kind) -> (mtime, data), least recently used first
+        self.entries = OrderedDict()
+        # path -> set of kinds cached for it
+        self.kinds = {}
+        self.hits = 0
+        self.misses = 0
+        self.watcher = None
+        self.watches = {} # path -> wd
+        self.watchPaths = {} # wd -> path
+        self.running = True
+        self.executor = ThreadPoolExecutor(max_workers=LISTING_WORKERS)
+        if useInotify:
+            try:
+                self.watcher = Inotify()
+            except OSError as e:
+                print ("listing cache: no inotify, relying on mtime", e)
+            else:
+                Thread(target=self.watch, daemon=True).start()
+
+    def lookup(self, path, kind):
+        # (mtime, cached bytes or None); kind tells listings of the same
+        # directory apart. Raises OSError if path cannot be stat()ed
+        mtime = stat(path).st_mtime_ns
+        key = (path, kind)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == mtime:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return mtime, entry[1]
+            self.misses += 1
+        return mtime, None
+
+    def submit(self, path, kind, mtime, build):
+        # build() returns the bytes to cache, run on the cache's threads;
+        # a Future of them is returned. mtime is lookup()'s, taken before
+        # the build so a change during it is caught next time
+        return self.executor.submit(self.build, (path, kind), mtime, build)
+
+    def build(self, key, mtime, build):
+        data = build()
+        self.store(key, mtime, data)
+        return data
+
+    def store(self, key, mtime, data):
+        if len(data) > self.maxSize // 2:
+            return
+        path = key[0]
+        with self.lock:
+            self._discard(key)
+            self.entries[key] = (mtime, data)
+            self.kinds.setdefault(path, set()).add(key[1])
+            self.size += len(data)
+            while self.size > self.maxSize:
+                oldest = next(iter(self.entries))
+                self._discard(oldest)
+        if self.watcher is not None and path not in self.watches:
+            try:
+                wd = self.watcher.addWatch(path, IN_DIR_CHANGES)
+            except OSError:
+                # out of watches, mtime checks still apply
+                return
+            with self.lock:
+                if path in self.kinds:
+                    self.watches[path] = wd
+                    self.watchPaths[wd] = path
+                    return
+            self.watcher.removeWatch(wd)
+
+    def invalidate(self, path):
+        with self.lock:
+            for kind in list(self.kinds.get(path, ())):
+                self._discard((path, kind))
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self._discard(key)
+
+    def _discard(self, key):
+        # callers hold self.lock
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= len(entry[1])
+        path, kind = key
+        kinds = self.kinds.get(path)
+        kinds.discard(kind)
+        if not kinds:
+            del self.kinds[path]
+            wd = self.watches.pop(path, None)
+            if wd is not None:
+                del self.watchPaths[wd]
+                self.watcher.removeWatch(wd)
+
+    def watch(self):
+        while self.running:
+            ready, _, _ = select([self.watcher], [], [], WATCH_POLL_INTERVAL)
+            if not ready:
+                continue
+            for wd, mask, cookie, name in self.watcher.readEvents():
+                if mask & IN_Q_OVERFLOW:
+                    self.clear()
+                    continue
+                with self.lock:
+                    path = self.watchPaths.get(wd)
+                    if mask & IN_IGNORED and path is not None:
+                        # the kernel already dropped the watch
+                        del self.watchPaths[wd]
+                        del self.watches[path]
+                if path is not None:
+                    self.invalidate(path)
+        # closed here, select() must not see the fd go away under it
+        self.watcher.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.clear()
+        self.running = False
@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+
+# versioned listing of the whole share, served by SITE MANIFEST so that a
+# peer gets every path, size and mtime over one data connection instead
+# of a LIST per directory.
+# The server keeps it in step with the share index (shareIndex.py).
+# Entries live in sqlite and carry the version they last changed in;
+# deleted paths stay behind as tombstones for a while, so the changes
+# since any recent version are a single query. Prefork workers read the
+# same database while the server process keeps it current. Until the share
+# has been copied in once, there is no manifest to serve.
+#
+# wire format, gzip compressed text, one JSON value per line:
+#   {"version": 12, "since": 9, "full": false}
+#   ["+", "/music/a.mp3", "f", 4096, 1500000000]    added or changed
+#   ["-", "/music/old.mp3"]                         deleted
+
+import gzip
+import json
+import sqlite3
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_FILE = "manifest.db"
+# tombstones older than this many versions are dropped, peers holding an
+# older version get the full manifest again
+TOMBSTONE_VERSIONS = 1000
+TYPE_FILE = "f"
+TYPE_DIR = "d"
+
+
+class Manifest:
+    def __init__(self, filename, root):
+        self.root = root
+        self.lock = Lock()
+        # (version, data) of the last full dump, most requests are first
+        # fetches and get the same bytes
+        self.lastFull = (None, None)
+        self.db = sqlite3.connect(filename, timeout=5, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS entries (
+            path TEXT PRIMARY KEY, type TEXT, size INTEGER, mtime INTEGER,
+            version INTEGER, deleted INTEGER)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_version ON entries (version)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        self.db.commit()
+        # dumps of a big share take a while, they are made here
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def getMeta(self, key, default=0):
+        row = self.db.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def setMeta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def version(self):
+        with self.lock:
+            return self.getMeta("version")
+
+    def reset(self):
+        # a different folder is shared, versions keep counting up so that
+        # no peer mistakes the new manifest for changes to the old one;
+        # root is set once refresh() has copied the new share in
+        with self.lock:
+            version = self.getMeta("version") + 1
+            self.db.execute("DELETE FROM entries")
+            self.setMeta("root", None)
+            self.setMeta("version", version)
+            self.setMeta("oldest", version)
+            self.db.commit()
+
+    def snapshot(self):
+        with self.lock:
+            rows = self.db.execute("SELECT path, type, size, mtime FROM entries WHERE deleted=0").fetchall()
+        return { path: (type, size, mtime) for path, type, size, mtime in rows }
+
+    def update(self, changes):
+        # changes maps path -> (type, size, mtime), None for deleted paths;
+        # returns the new version, unchanged if there was nothing to do
+        with self.lock:
+            version = self.getMeta("version")
+            if not changes:
+                return version
+            version += 1
+            rows = []
+            for path, entry in changes.items():
+                if entry is None:
+                    rows.append((path, TYPE_FILE, 0, 0, version, 1))
+                else:
+                    rows.append((path,) + tuple(entry) + (version, 0))
+            self.db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.setMeta("version", version)
+            cutoff = version - TOMBSTONE_VERSIONS
+            if cutoff > self.getMeta("oldest"):
+                self.db.execute("DELETE FROM entries WHERE deleted=1 AND version<=?", (cutoff,))
+                self.setMeta("oldest", cutoff + 1)
+            self.db.commit()
+            return version
+
+    def refresh(self, current):
+        # record what changed since the last refresh, current is the whole
+        # share as path -> (type, size, mtime), see shareIndex.py
+        with self.lock:
+            moved = self.getMeta("root", None) != self.root
+        if moved:
+            self.reset()
+        previous = self.snapshot()
+        changes = { path: entry for path, entry in current.items() if previous.get(path) != entry }
+        for path in previous.keys() - current.keys():
+            changes[path] = None
+        version = self.update(changes)
+        if moved:
+            with self.lock:
+                self.setMeta("root", self.root)
+                self.db.commit()
+        return version
+
+    def ready(self):
+        # whether the share was copied in, callers hold the lock
+        return self.getMeta("root", None) == self.root
+
+    def isFull(self, since, version):
+        # whether changes since that version need the whole manifest,
+        # callers hold the lock
+        return since <= 0 or since < self.getMeta("oldest") or since > version
+
+    def changes(self, since=0):
+        # (version, full, rows) with rows of (path, type, size, mtime,
+        # deleted) changed after since, every path when full
+        with self.lock:
+            version = self.getMeta("version")
+            full = self.isFull(since, version)
+            if full:
+                rows = self.db.execute("SELECT path, type, size, mtime, deleted FROM entries " \
+                    "WHERE deleted=0 ORDER BY path").fetchall()
+            else:
+                rows = self.db.execute("SELECT path, type, size, mtime, deleted FROM entries " \
+                    "WHERE version>? ORDER BY path", (since,)).fetchall()
+        return version, full, rows
+
+    def lookup(self, paths):
+        # path -> (type, size, mtime) for those of paths still shared
+        paths = list(paths)
+        if not paths:
+            return {}
+        with self.lock:
+            rows = self.db.execute("SELECT path, type, size, mtime FROM entries WHERE deleted=0 " \
+                "AND path IN (%s)" % ",".join("?" * len(paths)), paths).fetchall()
+        return { path: (type, size, mtime) for path, type, size, mtime in rows }
+
+    def submit(self, since=0):
+        # dump() on the manifest's own thread, a Future of it
+        return self.executor.submit(self.dump, since)
+
+    def dump(self, since=0):
+        # gzip compressed manifest, only the changes after since when the
+        # tombstones reach back far enough; None before the share was
+        # copied in, an empty manifest would say it has no files
+        with self.lock:
+            if not self.ready():
+                return None
+            version = self.getMeta("version")
+            if self.lastFull[0] == version and self.isFull(since, version):
+                return self.lastFull[1]
+        version, full, rows = self.changes(since)
+        if full:
+            since = 0
+        lines = [ json.dumps({ "version": version, "since": since, "full": full }) ]
+        for path, type, size, mtime, deleted in rows:
+            if deleted:
+                lines.append(json.dumps(["-", path]))
+            else:
+                lines.append(json.dumps(["+", path, type, size, mtime]))
+        data = gzip.compress(("\n".join(lines) + "\n").encode(), 6)
+        if full:
+            self.lastFull = (version, data)
+        return data
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            self.db.close()
+
+
+def parseManifest(data):
+    # the client side of dump(): (header, [(op, path, type, size, mtime)])
+    lines = gzip.decompress(data).decode().splitlines()
+    header = json.loads(lines[0])
+    changes = []
+    for line in lines[1:]:
+        item = json.loads(line)
+        changes.append(tuple(item) + (None,) * (5 - len(item)))
+    return header, changes
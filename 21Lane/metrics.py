@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+
+# scrapeable metrics and health endpoint for unattended shares
+# /metrics speaks the Prometheus text format, /health returns JSON
+
+import json
+from time import time
+from bisect import bisect_left
+from threading import Thread, Lock
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+METRICS_HOST = "127.0.0.1" # local only
+# seconds, upper bounds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = Lock()
+        # name -> [type, help, value], value is a number, a Histogram or
+        # a callable evaluated at scrape time
+        self.metrics = {}
+
+    def register(self, name, type, help, value):
+        with self.lock:
+            self.metrics[name] = [type, help, value]
+
+    def counter(self, name, help, value=0):
+        self.register(name, "counter", help, value)
+
+    def gauge(self, name, help, value=0):
+        self.register(name, "gauge", help, value)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        self.register(name, "histogram", help, Histogram(buckets))
+
+    def inc(self, name, amount=1):
+        with self.lock:
+            self.metrics[name][2] += amount
+
+    def set(self, name, value):
+        with self.lock:
+            self.metrics[name][2] = value
+
+    def observe(self, name, value):
+        with self.lock:
+            self.metrics[name][2].observe(value)
+
+    def snapshot(self):
+        # name -> (type, help, value) with callables resolved
+        with self.lock:
+            items = [ (name, list(entry)) for name, entry in self.metrics.items() ]
+        result = {}
+        for name, (type, help, value) in items:
+            if callable(value):
+                try:
+                    value = value()
+                except Exception:
+                    continue
+            result[name] = (type, help, value)
+        return result
+
+    def render(self):
+        lines = []
+        for name, (type, help, value) in sorted(self.snapshot().items()):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, type))
+            if type == "histogram":
+                with self.lock:
+                    buckets = list(value.cumulative())
+                    total, count = value.sum, value.count
+                for bound, cumulative in buckets:
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append('%s_bucket{le="%s"} %d' % (name, le, cumulative))
+                lines.append("%s_sum %s" % (name, repr(total)))
+                lines.append("%s_count %d" % (name, count))
+            else:
+                lines.append("%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = self.server.registry.render().encode()
+            contentType = "text/plain; version=0.0.4"
+            status = 200
+        elif self.path == "/health":
+            health = self.server.health()
+            body = json.dumps(health).encode()
+            contentType = "application/json"
+            status = 200 if health.get("status") == "ok" else 503
+        else:
+            self.send_error(404)
+            return
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(Thread):
+    def __init__(self, registry, port, health=None):
+        super().__init__(daemon=True)
+        self.httpd = HTTPServer((METRICS_HOST, port), MetricsRequestHandler)
+        self.httpd.registry = registry
+        self.httpd.health = health if health else (lambda: { "status": "ok" })
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def registerShareGauges(registry, server, xchgClient):
+    registry.gauge("sharing", "1 while the FTP server is running", lambda: int(server.isRunning()))
+    registry.gauge("share_size_bytes", "Total size of the shared files", lambda: server.index.totalSize)
+    registry.gauge("share_files", "Number of shared files", lambda: server.index.fileCount)
+    registry.gauge("exchange_heartbeat_ok", "1 if the last exchange heartbeat succeeded", lambda: int(xchgClient.heartbeatOk))
+    registry.gauge("exchange_heartbeat_timestamp_seconds", "Unix time of the last successful heartbeat", lambda: xchgClient.lastHeartbeat)
+
+
+def shareHealth(server, xchgClient, startTime):
+    sharing = server.isRunning()
+    exchange = "disabled"
+    if xchgClient.exchangeURI:
+        exchange = "ok" if xchgClient.heartbeatOk else "failing"
+    return {
+        "status": "ok" if sharing else "stopped",
+        "sharing": sharing,
+        "exchange": exchange,
+        "lastHeartbeat": xchgClient.lastHeartbeat,
+        "uptime": round(time() - startTime)
+    }
@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+
+# local addresses and listening sockets, without Qt
+# interfaces are read with getifaddrs(3) through ctypes where libc has it,
+# elsewhere we fall back on resolving our own host name and lose the
+# interface names
+
+import sys
+import socket
+import ctypes
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from customErrors import BindAddressError
+
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+CONNECT_TIMEOUT = 2 # seconds, for picking the fastest peer address
+
+_getifaddrs = None
+
+
+class sockaddr(ctypes.Structure):
+    if sys.platform == "darwin" or "bsd" in sys.platform:
+        _fields_ = [("sa_len", ctypes.c_uint8), ("sa_family", ctypes.c_uint8)]
+    else:
+        _fields_ = [("sa_family", ctypes.c_uint16)]
+
+
+class ifaddrs(ctypes.Structure):
+    pass
+
+ifaddrs._fields_ = [
+    ("ifa_next", ctypes.POINTER(ifaddrs)),
+    ("ifa_name", ctypes.c_char_p),
+    ("ifa_flags", ctypes.c_uint),
+    ("ifa_addr", ctypes.POINTER(sockaddr)),
+    ("ifa_netmask", ctypes.POINTER(sockaddr)),
+    ("ifa_ifu", ctypes.c_void_p),
+    ("ifa_data", ctypes.c_void_p)
+]
+
+
+def _loadGetifaddrs():
+    global _getifaddrs
+    if _getifaddrs is None:
+        # libc symbols from the process itself, see inotify.py
+        libc = ctypes.CDLL(None, use_errno=True) if sys.platform != "win32" else None
+        if libc is None or not hasattr(libc, "getifaddrs"):
+            raise OSError("getifaddrs is not available")
+        libc.getifaddrs.argtypes = [ctypes.POINTER(ctypes.POINTER(ifaddrs))]
+        libc.freeifaddrs.argtypes = [ctypes.POINTER(ifaddrs)]
+        _getifaddrs = libc
+    return _getifaddrs
+
+
+def _decodeAddress(addr):
+    # sockaddr_in: family, port, 4 address bytes at offset 4
+    # sockaddr_in6: family, port, flowinfo, 16 address bytes at offset 8
+    family = addr.contents.sa_family
+    raw = ctypes.string_at(addr, 24)
+    if family == socket.AF_INET:
+        return socket.inet_ntop(socket.AF_INET, raw[4:8])
+    if family == socket.AF_INET6:
+        return socket.inet_ntop(socket.AF_INET6, raw[8:24])
+    return None
+
+
+def interfaceAddresses():
+    # list of (interface name, address, is loopback) for interfaces that are up
+    try:
+        libc = _loadGetifaddrs()
+    except OSError:
+        result = []
+        for info in socket.getaddrinfo(socket.gethostname(), None):
+            address = info[4][0].split('%')[0]
+            if address not in [ entry[1] for entry in result ]:
+                result.append(("", address, ipaddress.ip_address(address).is_loopback))
+        return result
+    head = ctypes.POINTER(ifaddrs)()
+    if libc.getifaddrs(ctypes.byref(head)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, "getifaddrs failed")
+    result = []
+    try:
+        entry = head
+        while entry:
+            item = entry.contents
+            if item.ifa_addr and item.ifa_flags & IFF_UP:
+                address = _decodeAddress(item.ifa_addr)
+                if address is not None:
+                    result.append((item.ifa_name.decode(errors="replace"), address, bool(item.ifa_flags & IFF_LOOPBACK)))
+            entry = item.ifa_next
+    finally:
+        libc.freeifaddrs(head)
+    return result
+
+
+def isAdvertisable(address):
+    # anything a peer could reach us on: global and private (RFC1918, ULA)
+    # addresses; link-local ones need a scope the peer cannot know
+    ip = ipaddress.ip_address(address)
+    return not (ip.is_loopback or ip.is_link_local or ip.is_multicast or ip.is_unspecified)
+
+
+def resolveBindAddresses(selection):
+    # selection holds interface names and/or addresses, empty means all;
+    # returns the addresses to bind, empty for the dual-stack wildcard.
+    # A selection with nothing usable in it raises BindAddressError, it
+    # never widens to every address
+    if not selection:
+        return []
+    addresses = []
+    interfaces = interfaceAddresses()
+    for item in selection:
+        matches = [ address for name, address, loopback in interfaces if name == item ]
+        if not matches:
+            try:
+                ipaddress.ip_address(item)
+            except ValueError:
+                # an interface that is down or gone
+                print ("no address to listen on for", item)
+                continue
+            # an address, checked when binding
+            matches = [ item ]
+        for address in matches:
+            # link-local ones would need a scope id to bind
+            if ipaddress.ip_address(address).is_link_local:
+                continue
+            if address not in addresses:
+                addresses.append(address)
+    if not addresses:
+        raise BindAddressError("nothing to listen on in " + ", ".join(selection))
+    return addresses
+
+
+def advertisedAddresses(selection=()):
+    # addresses to publish for the given bind selection, best first:
+    # IPv4 then IPv6, private ranges before public ones
+    try:
+        bound = resolveBindAddresses(selection)
+    except BindAddressError:
+        return []
+    addresses = []
+    for name, address, loopback in interfaceAddresses():
+        if loopback or not isAdvertisable(address):
+            continue
+        if bound and address not in bound:
+            continue
+        if address not in addresses:
+            addresses.append(address)
+    def rank(address):
+        ip = ipaddress.ip_address(address)
+        return (ip.version, not ip.is_private)
+    return sorted(addresses, key=rank)
+
+
+def openListeners(selection, port, backlog):
+    # one listening socket per bound address; without a selection a single
+    # dual-stack socket, or plain IPv4 where the system has no IPv6.
+    # BindAddressError for a selection with nothing usable in it
+    addresses = resolveBindAddresses(selection)
+    if not addresses:
+        try:
+            sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        except (OSError, AttributeError):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            addresses = [ "0.0.0.0" ]
+        else:
+            addresses = [ "::" ]
+        socks = [ sock ]
+    else:
+        socks = []
+        for address in addresses:
+            family = socket.AF_INET6 if ipaddress.ip_address(address).version == 6 else socket.AF_INET
+            socks.append(socket.socket(family, socket.SOCK_STREAM))
+    try:
+        for sock, address in zip(socks, addresses):
+            if sock.family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, int(address != "::"))
+            if sys.platform != "win32":
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((address, port))
+            sock.listen(backlog)
+    except OSError:
+        for sock in socks:
+            sock.close()
+        raise
+    return socks
+
+
+def formatHost(address):
+    # for URLs, IPv6 addresses go in brackets
+    if ':' in address:
+        return '[' + address + ']'
+    return address
+
+
+def pickAddress(addresses, port, timeout=CONNECT_TIMEOUT):
+    # the address of a peer that answers first, None if none does
+    addresses = [ address for address in dict.fromkeys(addresses) if address ]
+    if len(addresses) < 2:
+        return addresses[0] if addresses else None
+    def attempt(address):
+        with socket.create_connection((address, port), timeout=timeout):
+            return address
+    executor = ThreadPoolExecutor(max_workers=len(addresses))
+    futures = [ executor.submit(attempt, address) for address in addresses ]
+    try:
+        for future in as_completed(futures):
+            try:
+                return future.result()
+            except OSError:
+                continue
+        return None
+    finally:
+        # slower attempts finish on their own
+        executor.shutdown(wait=False)
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+# how shared files are read for peers, so that one of them pulling a disk
+# image does not push the rest of the machine out of the page cache.
+# A file sent front to back is read ahead of the cursor (SEQUENTIAL and
+# WILLNEED), and once it is big enough the pages behind the cursor are
+# handed back (DONTNEED). Both work the same for sendfile() and read().
+# Files are never memory mapped: shared folders are live, and a file cut
+# short by its owner while mapped kills the server with SIGBUS.
+# posix_fadvise() is POSIX only, elsewhere the kernel is left alone.
+
+import os
+import mmap
+
+DEFAULT_DROP_BEHIND = 256 * 1048576 # bytes, files at least this big
+# bytes asked for ahead of the cursor; by default the kernel's own
+# read-ahead does it, SEQUENTIAL doubles it and costs the server nothing
+DEFAULT_READAHEAD = 0
+# pages behind the cursor are dropped in steps of this many bytes, those
+# less than DROP_LAG behind are left: sendfile() hands pages to the socket
+# rather than copies, and the kernel keeps pages still queued there
+DROP_STEP = 4 * 1048576
+DROP_LAG = 16 * 1048576
+PAGE_SIZE = mmap.PAGESIZE
+CAN_ADVISE = hasattr(os, "posix_fadvise")
+
+
+def advise(fd, offset, length, advice):
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        # not every filesystem takes advice, reads work all the same
+        pass
+
+
+class ReadPolicy:
+    # dropBehind and readahead in bytes, 0 turns each of them off
+    def __init__(self, dropBehind=DEFAULT_DROP_BEHIND, readahead=DEFAULT_READAHEAD):
+        self.dropBehind = dropBehind
+        self.readahead = readahead
+
+    def follow(self, file):
+        # a ReadCursor for a file about to be read from its current
+        # position to the end, None if there is nothing to do
+        if not CAN_ADVISE or not (self.dropBehind or self.readahead):
+            return None
+        try:
+            fd = file.fileno()
+            size = os.fstat(fd).st_size
+            offset = file.tell()
+        except (AttributeError, OSError, ValueError):
+            return None
+        return ReadCursor(self, fd, size, offset)
+
+
+class ReadCursor:
+    def __init__(self, policy, fd, size, offset):
+        self.fd = fd
+        self.readahead = policy.readahead
+        self.drop = bool(policy.dropBehind) and size >= policy.dropBehind
+        # advised up to ahead, dropped up to dropped
+        self.ahead = offset
+        self.dropped = offset - offset % PAGE_SIZE
+        self.position = offset
+        advise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        self.advance(offset)
+
+    def advance(self, position):
+        # the reader got to position
+        self.position = position
+        # asked for again half way through the window, the disk is kept
+        # busy while the peer takes what is cached
+        if self.readahead and position + self.readahead // 2 >= self.ahead:
+            start = max(self.ahead, position)
+            self.ahead = position + self.readahead
+            advise(self.fd, start, self.ahead - start, os.POSIX_FADV_WILLNEED)
+        if self.drop and position - self.dropped >= DROP_LAG + DROP_STEP:
+            end = position - DROP_LAG
+            end -= end % PAGE_SIZE
+            advise(self.fd, self.dropped, end - self.dropped, os.POSIX_FADV_DONTNEED)
+            self.dropped = end
+
+    def close(self):
+        # the transfer is over, finished or not: the rest of what was read
+        # goes, and so does what was read ahead but never sent
+        if self.drop:
+            advise(self.fd, self.dropped, 0, os.POSIX_FADV_DONTNEED)
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+# names of everything shared, for SITE SEARCH.
+# The lowercase names sit in one string with a "\n" before and after each,
+# so a query is a str.find() over the whole share instead of a walk:
+# substrings as given, "*.mp3" as ".mp3\n", "abc*" as "\nabc", and any
+# other glob by its rarest literal part, matching the names found against
+# the whole pattern.
+# Every process serving connections keeps its own copy, in step with the
+# manifest (manifest.py); changes since the last build collect in a small
+# overlay until the string is built again.
+#
+# wire format of a page, text, one JSON value per line:
+#   {"query": "*.mp3", "offset": 0, "more": true}
+#   ["/music/a.mp3", "f", 4096, 1500000000]
+
+import re
+import json
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import translate
+from itertools import accumulate, islice
+
+SEARCH_PAGE_SIZE = 200
+# the names are built again once the overlay holds this share of them
+REBUILD_RATIO = 0.05
+REBUILD_MIN = 1000
+GLOB_CHARS = set("*?[")
+# characters of the names sampled to tell which part of a glob is rarest
+RARITY_SAMPLE = 1 << 20
+
+
+def nameOf(path):
+    return path.rpartition("/")[2].lower()
+
+
+def parseQuery(query):
+    # (needles, test): results are the names holding every needle, those
+    # that pass test(name) if there is one; no needles means every name
+    query = query.lower()
+    if not GLOB_CHARS & set(query):
+        return [ query ], None
+    if query.startswith("*.") and not GLOB_CHARS & set(query[2:]):
+        return [ query[1:] + "\n" ], None
+    # [...] classes say nothing about the literal text of a name
+    parts = re.split(r"\[[^\]]*\]|[*?]", query)
+    needles = [ part for part in parts[1:-1] if part ]
+    if parts[0]:
+        needles.append("\n" + parts[0])
+    if parts[-1] and len(parts) > 1:
+        needles.append(parts[-1] + "\n")
+    match = re.compile(translate(query), re.DOTALL).match
+    return needles, lambda name: match(name) is not None
+
+
+class SearchIndex:
+    def __init__(self, manifest):
+        self.manifest = manifest
+        # manifest version the names are in step with, None before the
+        # first query
+        self.version = None
+        self.paths = []
+        self.names = "\n"
+        # where each name starts in self.names, and where one past the end
+        # would start
+        self.starts = array("q", [ 1 ])
+        self.known = set() # paths in self.names
+        self.added = {} # path -> name, not in self.names yet
+        self.removed = set() # paths in self.names that are gone
+        # one thread, searches never run concurrently with a sync
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, query, offset):
+        return self.executor.submit(self.page, query, offset)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def sync(self):
+        if self.version is not None and self.manifest.version() == self.version:
+            return
+        version, full, rows = self.manifest.changes(self.version or 0)
+        if full:
+            self.build([ row[0] for row in rows ])
+        else:
+            for path, type, size, mtime, deleted in rows:
+                if deleted:
+                    self.added.pop(path, None)
+                    if path in self.known:
+                        self.removed.add(path)
+                elif path in self.known:
+                    self.removed.discard(path)
+                else:
+                    self.added[path] = nameOf(path)
+            if len(self.added) + len(self.removed) > max(REBUILD_MIN, REBUILD_RATIO * len(self.paths)):
+                self.build([ path for path in self.paths if path not in self.removed ] + list(self.added))
+        self.version = version
+
+    def build(self, paths):
+        names = [ nameOf(path) for path in paths ]
+        self.paths = paths
+        self.names = "\n" + "\n".join(names) + "\n"
+        self.starts = array("q", accumulate((len(name) + 1 for name in names), initial=1))
+        self.known = set(paths)
+        self.added = {}
+        self.removed = set()
+
+    def matches(self, needles, test):
+        # paths whose names hold every needle and pass test, in index order
+        # and then the overlay
+        names, starts, paths, removed = self.names, self.starts, self.paths, self.removed
+        if needles:
+            # scan for the rarest, as far as a sample of the names tells
+            sample = names[:RARITY_SAMPLE]
+            needle = min(needles, key=sample.count) if len(needles) > 1 else needles[0]
+            others = [ other for other in needles if other != needle ]
+            if others:
+                test = self.prefilter(others, test)
+            # a needle starting at the "\n" before a name belongs to it
+            skip = 1 if needle.startswith("\n") else 0
+            pos = names.find(needle)
+            while pos >= 0:
+                i = bisect_right(starts, pos + skip) - 1
+                if paths[i] not in removed and (test is None or test(names[starts[i]:starts[i + 1] - 1])):
+                    yield paths[i]
+                pos = names.find(needle, starts[i + 1] - 1)
+        else:
+            for i, path in enumerate(paths):
+                if path not in removed and test(names[starts[i]:starts[i + 1] - 1]):
+                    yield path
+        for path, name in list(self.added.items()):
+            framed = "\n" + name + "\n"
+            if all(needle in framed for needle in needles) and (test is None or test(name)):
+                yield path
+
+    def prefilter(self, needles, test):
+        def check(name):
+            framed = "\n" + name + "\n"
+            return all(needle in framed for needle in needles) and (test is None or test(name))
+        return check
+
+    def page(self, query, offset):
+        # one page of results from offset, as SITE SEARCH sends it
+        self.sync()
+        needles, test = parseQuery(query)
+        found = list(islice(self.matches(needles, test), offset, offset + SEARCH_PAGE_SIZE + 1))
+        more = len(found) > SEARCH_PAGE_SIZE
+        found = found[:SEARCH_PAGE_SIZE]
+        entries = self.manifest.lookup(found)
+        lines = [ json.dumps({ "query": query, "offset": offset, "more": more }) ]
+        for path in found:
+            if path in entries:
+                lines.append(json.dumps([ path ] + list(entries[path])))
+        return ("\n".join(lines) + "\n").encode()
+
+
+def parseSearchPage(data):
+    # the client side of page(): (header, [(path, type, size, mtime)])
+    lines = data.decode().splitlines()
+    return json.loads(lines[0]), [ tuple(json.loads(line)) for line in lines[1:] ]
@@ -2,57 +2,674 @@
 
 # Using examples from https://pythonhosted.org/pyftpdlib/tutorial.html
 
-from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
-from pyftpdlib.servers import FTPServer
+from pyftpdlib.handlers import FTPHandler, DTPHandler, BufferedIteratorProducer, proto_cmds
+from pyftpdlib.filesystems import FilesystemError
+from pyftpdlib.servers import FTPServer, ThreadedFTPServer
 from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.ioloop import IOLoop
+from pyftpdlib.log import config_logging, is_logging_configured
 
 import socket
+import errno
+import sqlite3
+import signal
+import sys
+from os import cpu_count
+from urllib.parse import unquote
+from queue import Empty
+from multiprocessing import get_context, get_all_start_methods
 from os.path import exists as path_exists
-from os.path import getsize 
+from time import monotonic
+from threading import Thread, Semaphore, Event
 
+from bandwidth import TokenBucket, BandwidthGovernor, PACING_STEPS, MIN_CHUNK_SIZE
 from customErrors import PortUnavailableError
-from customSignals import ServerStatsUpdater
+from serverStats import ServerStatsUpdater, REJECT_CONNECTIONS, REJECT_PER_IP, REJECT_TRANSFERS
+from listingCache import ListingCache
+from hashCache import HashCache, ALGORITHMS, DEFAULT_ALGORITHM
+from manifest import Manifest
+from searchIndex import SearchIndex
+from deflate import DeflateProducer, isCompressed, DEFAULT_LEVEL
+from shareIndex import ShareIndex
+from httpServer import HttpServer
+from readPolicy import ReadPolicy
+from tarStream import TarProducer
+from transferMeter import SAMPLE_INTERVAL
+from network import openListeners
+from addressTable import AddressTable
 
-from PyQt5.QtCore import QThread
 
+def isPortAvailable(port, selection=()):
+    # bound and let go the way start() binds it, on the same interfaces
+    # and address families: taken on any one of them is taken
+    try:
+        socks = openListeners(selection, port, 1)
+    except OSError:
+        return False
+    for sock in socks:
+        sock.close()
+    return True
 
-def isPortAvailable(port):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    result = sock.connect_ex(('127.0.0.1',port))
-    return not (result == 0)
 
 
+# serving engines selectable from Settings
+ENGINE_SINGLE = "single"      # one ioloop in the server thread
+ENGINE_THREADED = "threaded"  # one thread per connection
+ENGINE_PREFORK = "prefork"    # worker processes sharing the listening socket
+ENGINES = (ENGINE_SINGLE, ENGINE_THREADED, ENGINE_PREFORK)
+POLL_INTERVAL = 0.5
+MIN_POLL_TIMEOUT = 0.001
+# admission control defaults, 0 means no limit / no timeout
+LISTEN_BACKLOG = 100
+MAX_CONNECTIONS = 256
+MAX_CONNECTIONS_PER_IP = 8
+MAX_TRANSFERS = 32
+CONTROL_TIMEOUT = 300 # seconds
+DATA_TIMEOUT = 300
+# commands answered over a data connection, timed for first-byte latency
+DATA_COMMANDS = {"RETR", "LIST", "NLST", "MLSD", "SITE MANIFEST", "SITE SEARCH", "SITE TAR"}
+LIST_COMMANDS = {"LIST", "NLST", "MLSD"}
+HASH_POLL_INTERVAL = 0.05 # seconds between checks on a background hash
+SEARCH_POLL_INTERVAL = 0.01
+LISTING_POLL_INTERVAL = 0.005
+# X* checksum commands and the algorithm each one answers with
+HASH_COMMANDS = {"XCRC": "CRC32", "XMD5": "MD5", "XSHA1": "SHA-1", "XSHA256": "SHA-256", "XSHA512": "SHA-512"}
+
+
+def makeProtoCmds():
+    cmds = proto_cmds.copy()
+    cmds["HASH"] = dict(perm='r', auth=True, arg=True,
+        help='Syntax: HASH <SP> file-name (get file checksum, see OPTS HASH).')
+    for cmd, algorithm in HASH_COMMANDS.items():
+        cmds[cmd] = dict(perm='r', auth=True, arg=True,
+            help='Syntax: %s <SP> file-name (get %s checksum of file).' % (cmd, algorithm))
+    cmds["SITE MANIFEST"] = dict(perm=None, auth=True, arg=None,
+        help='Syntax: SITE <SP> MANIFEST [<SP> version] (whole share listing, or changes since version).')
+    cmds["SITE SEARCH"] = dict(perm=None, auth=True, arg=True,
+        help='Syntax: SITE <SP> SEARCH <SP> offset <SP> query (names holding query or matching a glob, a page from offset).')
+    cmds["SITE TAR"] = dict(perm=None, auth=True, arg=True,
+        help='Syntax: SITE <SP> TAR <SP> after <SP> dir-name (folder as a tar stream, entries after the URL encoded name, - for all).')
+    return cmds
+
+
+def configureLogging():
+    # what ioloop.loop() does on its first run, pollIoloop() skips it
+    if not is_logging_configured():
+        config_logging()
+
+
+def pollIoloop(ioloop, timeout=POLL_INTERVAL):
+    # one pass over scheduled calls and sockets, waiting at most timeout;
+    # pyftpdlib's loop() turns a due call (soonest == 0) into poll(-1)
+    # and would wait for ever
+    soonest = ioloop.sched.poll()
+    if soonest is not None:
+        timeout = min(timeout, soonest)
+    ioloop.poll(max(timeout, MIN_POLL_TIMEOUT))
+
+
+class ThrottledSendfileDTPHandler(DTPHandler):
+    # unlike pyftpdlib's ThrottledDTPHandler this one keeps the sendfile()
+    # path, every chunk is charged to a token bucket and the channel is
+    # taken off the ioloop until the debt is paid back
+    # sends are paced by the server wide governor, receives per connection
+    read_limit = 0
+    governor = BandwidthGovernor()
+    readPolicy = ReadPolicy()
+
+    def __init__(self, sock, cmd_channel):
+        self._throttler = None
+        self._share = None
+        # ReadCursor of the file being sent
+        self._cursor = None
+        # live byte accounting, only CustomHandler carries stats
+        self._stats = getattr(cmd_channel, "stats", None)
+        self._firstByteSent = False
+        self._readBucket = TokenBucket(self.read_limit, self.read_limit // PACING_STEPS)
+        super().__init__(sock, cmd_channel)
+        if self.read_limit:
+            self.ac_in_buffer_size = self._chunkSize(self.ac_in_buffer_size, self.read_limit)
+        if not self._closed:
+            self._share = self.governor.register(cmd_channel.remote_ip)
+
+    def _chunkSize(self, size, limit):
+        return max(MIN_CHUNK_SIZE, min(size, limit // PACING_STEPS))
+
+    def _cancelThrottler(self):
+        if self._throttler is not None and not self._throttler.cancelled:
+            self._throttler.cancel()
+
+    def _throttled(self, bucket):
+        delay = bucket.delay()
+        if delay <= 0:
+            return False
+        def unsleep():
+            event = self.ioloop.READ if self.receive else self.ioloop.WRITE
+            self.add_channel(events=event)
+        self.del_channel()
+        self._cancelThrottler()
+        self._throttler = self.ioloop.call_later(delay, unsleep, _errback=self.handle_error)
+        return True
+
+    def push_with_producer(self, producer):
+        # file_obj is only set for files, listings are left alone
+        if self.file_obj is not None and not self.receive:
+            self._cursor = self.readPolicy.follow(self.file_obj)
+        super().push_with_producer(producer)
+
+    def initiate_sendfile(self):
+        # keep a reference, the channel may get closed while sending
+        share = self._share
+        if self._throttled(share):
+            return
+        # the share shrinks as clients join, so do the chunks
+        self.ac_out_buffer_size = share.chunkSize(DTPHandler.ac_out_buffer_size)
+        before = self.tot_bytes_sent
+        super().initiate_sendfile()
+        self._account(share, self.tot_bytes_sent - before)
+        if self._cursor is not None:
+            self._cursor.advance(self._offset)
+
+    def send(self, data):
+        share = self._share
+        if self._throttled(share):
+            return 0
+        self.ac_out_buffer_size = share.chunkSize(DTPHandler.ac_out_buffer_size)
+        sent = super().send(data)
+        self._account(share, sent)
+        if self._cursor is not None and not self.file_obj.closed:
+            self._cursor.advance(self.file_obj.tell())
+        return sent
+
+    def _account(self, share, sent):
+        share.charge(sent)
+        if sent and self._stats is not None:
+            self._stats.sent(sent)
+            if not self._firstByteSent:
+                self._firstByteSent = True
+                stamp = getattr(self.cmd_channel, "commandStamp", None)
+                if stamp is not None:
+                    self._stats.firstByte(monotonic() - stamp)
+
+    def recv(self, buffer_size):
+        chunk = super().recv(buffer_size)
+        self._readBucket.charge(len(chunk))
+        self._throttled(self._readBucket)
+        return chunk
+
+    def close(self):
+        self._cancelThrottler()
+        # before the file is closed
+        if self._cursor is not None:
+            self._cursor.close()
+            self._cursor = None
+        if self._share is not None:
+            self.governor.unregister(self._share)
+            self._share = None
+        super().close()
+
 
 class CustomHandler(FTPHandler):
     stats = ServerStatsUpdater()
+    proto_cmds = makeProtoCmds()
+    # set by Server for every process serving connections, None disables them
+    listingCache = None
+    hashCache = None
+    manifest = None
+    searchIndex = None
+    hashAlgorithm = DEFAULT_ALGORITHM
+    connectStamp = None
+    commandStamp = None
+    # Semaphore with a slot per concurrent data transfer, None for no limit
+    transferSlots = None
+    holdsSlot = False
+    maxConnections = 0
+    # deflate level for MODE Z transfers, 0 refuses MODE Z
+    compressionLevel = DEFAULT_LEVEL
+    modeZ = False
+    # prefork workers: connections per address counted across all of
+    # them in an AddressTable, None to leave it to the server's own ip_map
+    addressTable = None
+    maxConnectionsPerIP = 0
+    addressSlot = None
+
+    def handle(self):
+        # pyftpdlib's max_cons counts every socket of the ioloop, data
+        # connections included; this counts control connections only
+        if self.maxConnections and len(self.server.ip_map) > self.maxConnections:
+            self.handle_max_cons()
+            return
+        if self.addressTable is not None and self.maxConnectionsPerIP:
+            full, self.addressSlot = self.addressTable.add(self.remote_ip, self.maxConnectionsPerIP)
+            if full:
+                self.handle_max_cons_per_ip()
+                return
+        super().handle()
+
+    def handle_max_cons(self):
+        self.stats.rejected(REJECT_CONNECTIONS)
+        super().handle_max_cons()
+
+    def handle_max_cons_per_ip(self):
+        self.stats.rejected(REJECT_PER_IP)
+        super().handle_max_cons_per_ip()
+
+    def push_dtp_data(self, data, isproducer=False, file=None, cmd=None):
+        # a transfer takes its slot once its data connection is there, a
+        # client that never connects must not hold one; see
+        # _on_dtp_connection() for those queued until then
+        if self.data_channel is not None and not self.takeSlot(file):
+            return
+        if self.modeZ:
+            # listings included, everything on the data connection is deflated
+            if not isproducer:
+                data = BufferedIteratorProducer(iter([ data ]))
+            stored = file is not None and isCompressed(file.name)
+            data = DeflateProducer(data, self.compressionLevel, stored, self.stats.deflated)
+            isproducer = True
+        super().push_dtp_data(data, isproducer, file, cmd)
+
+    def takeSlot(self, file=None):
+        # a control connection holds at most one slot, its previous
+        # transfer is over once it asks for the next one
+        if self.transferSlots is None or self.holdsSlot:
+            return True
+        if not self.transferSlots.acquire(blocking=False):
+            if file is not None:
+                file.close()
+            self.stats.rejected(REJECT_TRANSFERS)
+            self.respond("425 Too many transfers in progress, try again later.")
+            return False
+        self.holdsSlot = True
+        return True
+
+    def _on_dtp_connection(self):
+        if self._out_dtp_queue is not None and not self.takeSlot(self._out_dtp_queue[2]):
+            # nothing to send after all, the data connection goes unused
+            self._out_dtp_queue = None
+            super()._on_dtp_connection()
+            if self.data_channel is not None:
+                self.data_channel.close()
+            return
+        super()._on_dtp_connection()
+
+    def releaseSlot(self):
+        if self.holdsSlot:
+            self.holdsSlot = False
+            self.transferSlots.release()
+
+    def _on_dtp_close(self):
+        super()._on_dtp_close()
+        self.releaseSlot()
+
+    def close(self):
+        super().close()
+        self.releaseSlot()
+        if self.addressSlot is not None:
+            self.addressTable.remove(self.addressSlot)
+            self.addressSlot = None
+
     def on_connect(self):
+        self.connectStamp = monotonic()
         self.stats.connected()
 
+    def on_login(self, username):
+        if self.connectStamp is not None:
+            self.stats.loggedIn(monotonic() - self.connectStamp)
+
+    def process_command(self, cmd, *args, **kwargs):
+        if cmd in DATA_COMMANDS:
+            self.commandStamp = monotonic()
+            if cmd in LIST_COMMANDS:
+                self.stats.listed()
+        super().process_command(cmd, *args, **kwargs)
+
+    def ftp_LIST(self, path):
+        if self.listingCache is None or not self.fs.isdir(path):
+            return super().ftp_LIST(path)
+        def build():
+            return b''.join(self.run_as_current_user(self.fs.get_list_dir, path))
+        return self.pushCachedListing(path, "LIST", "LIST", build)
+
+    def ftp_MLSD(self, path):
+        if self.listingCache is None or not self.fs.isdir(path):
+            return super().ftp_MLSD(path)
+        perms = self.authorizer.get_perms(self.username)
+        # the facts asked for with OPTS MLST change the output
+        facts = list(self._current_facts)
+        def build():
+            listing = self.run_as_current_user(self.fs.listdir, path)
+            return b''.join(self.fs.format_mlsx(path, listing, perms, facts))
+        kind = ("MLSD", perms, tuple(facts))
+        return self.pushCachedListing(path, "MLSD", kind, build)
+
+    def pushCachedListing(self, path, cmd, kind, build):
+        # a cached listing goes out right away; a missing one is built on
+        # the cache's threads and sent once done, the ioloop keeps serving
+        try:
+            mtime, data = self.listingCache.lookup(path, kind)
+        except OSError as err:
+            self.respond('550 %s.' % (err.strerror or err))
+            return
+        if data is not None:
+            self.push_dtp_data(data, cmd=cmd)
+            return path
+        future = self.listingCache.submit(path, kind, mtime, build)
+        def check():
+            if self._closed:
+                return
+            if not future.done():
+                self.call_later(LISTING_POLL_INTERVAL, check)
+                return
+            try:
+                data = future.result()
+            except Exception as err:
+                self.respond('550 %s.' % (getattr(err, "strerror", None) or err))
+                return
+            self.push_dtp_data(data, cmd=cmd)
+        check()
+        return path
+
+    def ftp_MODE(self, line):
+        mode = line.upper()
+        if mode == 'Z' and self.compressionLevel:
+            self.modeZ = True
+            self.respond('200 Transfer mode set to: Z')
+            return
+        if mode == 'S':
+            self.modeZ = False
+        super().ftp_MODE(line)
+
+    def ftp_FEAT(self, line):
+        if self.compressionLevel and 'MODE Z' not in self._extra_feats:
+            self._extra_feats = self._extra_feats + ['MODE Z']
+        if self.hashCache is not None:
+            algorithms = ''
+            for algorithm in sorted(ALGORITHMS):
+                algorithms += algorithm + ('*;' if algorithm == self.hashAlgorithm else ';')
+            # the starred algorithm follows OPTS HASH, drop the old line
+            feats = [ feat for feat in self._extra_feats if not feat.startswith('HASH ') ]
+            self._extra_feats = feats + ['HASH ' + algorithms] + sorted(HASH_COMMANDS)
+        super().ftp_FEAT(line)
+
+    def ftp_OPTS(self, line):
+        cmd, _, arg = line.partition(' ')
+        if cmd.upper() != 'HASH':
+            return super().ftp_OPTS(line)
+        if self.hashCache is None:
+            self.respond('501 Unsupported command "HASH".')
+        elif not arg:
+            self.respond('200 ' + self.hashAlgorithm)
+        elif arg.upper() not in ALGORITHMS:
+            self.respond('501 Unknown algorithm, current selection not changed.')
+        else:
+            self.hashAlgorithm = arg.upper()
+            self.respond('200 ' + self.hashAlgorithm)
+
+    def ftp_HASH(self, path):
+        def reply(digest):
+            size = self.fs.getsize(path)
+            return '213 %s 0-%d %s %s' % (self.hashAlgorithm, size, digest, self.fs.fs2ftp(path))
+        self.answerHash(path, self.hashAlgorithm, reply)
+
+    def ftp_XCRC(self, path):
+        self.answerHash(path, HASH_COMMANDS["XCRC"], lambda digest: '250 ' + digest)
+
+    def ftp_XMD5(self, path):
+        self.answerHash(path, HASH_COMMANDS["XMD5"], lambda digest: '250 ' + digest)
+
+    def ftp_XSHA1(self, path):
+        self.answerHash(path, HASH_COMMANDS["XSHA1"], lambda digest: '250 ' + digest)
+
+    def ftp_XSHA256(self, path):
+        self.answerHash(path, HASH_COMMANDS["XSHA256"], lambda digest: '250 ' + digest)
+
+    def ftp_XSHA512(self, path):
+        self.answerHash(path, HASH_COMMANDS["XSHA512"], lambda digest: '250 ' + digest)
+
+    def answerHash(self, path, algorithm, reply):
+        # a cached digest is answered right away, anything else is hashed
+        # in the background and answered once done, the ioloop keeps
+        # serving everybody in between
+        if self.hashCache is None:
+            self.respond('502 Command not implemented.')
+            return
+        try:
+            digest = self.hashCache.lookup(path, algorithm)
+            if digest is not None:
+                self.respond(reply(digest))
+                return
+            future = self.hashCache.submit(path, algorithm)
+        except OSError as err:
+            self.respond('550 %s.' % (err.strerror or err))
+            return
+        def check():
+            if self._closed:
+                return
+            if not future.done():
+                self.call_later(HASH_POLL_INTERVAL, check)
+                return
+            try:
+                self.respond(reply(future.result()))
+            except Exception as err:
+                self.respond('550 %s.' % (getattr(err, "strerror", None) or err))
+        check()
+
+    def ftp_SITE_MANIFEST(self, line):
+        if self.manifest is None:
+            self.respond('502 Command not implemented.')
+            return
+        try:
+            since = int(line) if line else 0
+        except ValueError:
+            self.respond('501 Syntax error: version must be a number.')
+            return
+        # a full dump of a big share takes a while, it is built on the
+        # manifest's thread and sent once done, the ioloop keeps serving
+        future = self.manifest.submit(since)
+        def check():
+            if self._closed:
+                return
+            if not future.done():
+                self.call_later(SEARCH_POLL_INTERVAL, check)
+                return
+            try:
+                data = future.result()
+            except sqlite3.Error as err:
+                self.respond('451 Manifest unavailable: %s.' % err)
+                return
+            if data is None:
+                # peers crawl the share meanwhile
+                self.respond('450 Manifest not ready, the share is still being read.')
+                return
+            self.push_dtp_data(data, cmd="SITE MANIFEST")
+        check()
+
+    def ftp_SITE_SEARCH(self, line):
+        # searched in the background like hashes, the ioloop keeps serving
+        if self.searchIndex is None:
+            self.respond('502 Command not implemented.')
+            return
+        offset, _, query = line.partition(' ')
+        try:
+            offset = int(offset)
+            if offset < 0:
+                raise ValueError
+        except ValueError:
+            self.respond('501 Syntax error: offset must be a number.')
+            return
+        if not query.strip():
+            self.respond('501 Syntax error: nothing to search for.')
+            return
+        future = self.searchIndex.submit(query, offset)
+        def check():
+            if self._closed:
+                return
+            if not future.done():
+                self.call_later(SEARCH_POLL_INTERVAL, check)
+                return
+            try:
+                data = future.result()
+            except sqlite3.Error as err:
+                self.respond('451 Search unavailable: %s.' % err)
+                return
+            self.push_dtp_data(data, cmd="SITE SEARCH")
+        check()
+
+    def ftp_SITE_TAR(self, line):
+        after, _, path = line.partition(' ')
+        if not path:
+            self.respond('501 Syntax error: folder missing.')
+            return
+        after = None if after == '-' else unquote(after, errors='surrogateescape')
+        path = self.fs.ftp2fs(path)
+        if not self.fs.validpath(path) or not self.authorizer.has_perm(self.username, 'r', path):
+            self.respond('550 Not enough privileges.')
+            return
+        if not self.fs.isdir(path):
+            self.respond('550 Not a directory.')
+            return
+        self.push_dtp_data(TarProducer(path, self.fs.root, after), isproducer=True, cmd="SITE TAR")
+
     def on_disconnect(self):
-        self.stats.disconnected()
+        # connections turned away by the limits were never counted
+        if self.connectStamp is not None:
+            self.stats.disconnected()
 
     def on_file_sent(self, file):
-        self.stats.transferred(getsize(file))
+        # called while the data channel is closing, so it is still ours;
+        # an aborted transfer is not a file sent, its bytes are already
+        # counted chunk by chunk
+        if self.data_channel is not None:
+            self.stats.transferred(self.data_channel.get_transmitted_bytes())
+
+
+class WorkerStatsForwarder:
+    # stands in for ServerStatsUpdater inside prefork workers, whose
+    # signals would never reach the parent process
+    def __init__(self, queue, worker):
+        self.queue = queue
+        self.worker = worker
+        self.pending = 0
+
+    def connected(self):
+        self.queue.put((self.worker, "connected", ()))
+
+    def disconnected(self):
+        self.queue.put((self.worker, "disconnected", ()))
+
+    def transferred(self, filesize):
+        self.queue.put((self.worker, "transferred", (filesize,)))
+
+    def listed(self):
+        self.queue.put((self.worker, "listed", ()))
+
+    def loggedIn(self, latency):
+        self.queue.put((self.worker, "loggedIn", (latency,)))
 
-    def on_incomplete_file_sent(self, file):
-        self.stats.transferred(getsize(file))
+    def firstByte(self, latency):
+        self.queue.put((self.worker, "firstByte", (latency,)))
 
+    def rejected(self, reason):
+        self.queue.put((self.worker, "rejected", (reason,)))
 
-class Server(QThread):
+    def deflated(self, bytesIn, bytesOut):
+        self.queue.put((self.worker, "deflated", (bytesIn, bytesOut)))
+
+    def sent(self, amount):
+        # batched, flush() is called every SAMPLE_INTERVAL
+        self.pending += amount
+
+    def flush(self):
+        if self.pending:
+            self.queue.put((self.worker, "sent", (self.pending,)))
+            self.pending = 0
+
+
+def preforkWorker(parent, socks, queue, worker):
+    # runs in the forked child, parent is our copy of the Server
+    handler = parent.ftp_handler
+    sharedLimit = parent.sharedLimit
+    workers = parent.workers
+    shares = parent.limitShares
+    stats = handler.stats = WorkerStatsForwarder(queue, worker)
+    # cache threads and database handles would not survive fork(), build our own
+    parent.openCaches()
+    # the kernel spreads connections over the workers, each one enforces
+    # its part of the limits; but for the one per address, counted by all
+    # of them together, a client's connections may all land on one worker
+    handler.transferSlots = parent.makeTransferSlots(workers)
+    handler.addressTable = parent.addressTable
+    handler.maxConnectionsPerIP = parent.maxConnectionsPerIP
+    # terminate() from the parent ends the loop below instead of killing us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    # every worker paces its own clients with an equal part of the limit,
+    # the parent keeps sharedLimit current when the slider moves
+    governor = BandwidthGovernor(sharedLimit.value // shares)
+    handler.dtp_handler.governor = governor
+    def syncLimit():
+        if governor.rate != sharedLimit.value // shares:
+            governor.setRate(sharedLimit.value // shares)
+    # a fresh ioloop, the parent's one must not be shared across fork()
+    ioloop = IOLoop()
+    ioloop.call_every(POLL_INTERVAL, syncLimit)
+    ioloop.call_every(SAMPLE_INTERVAL, stats.flush)
+    servers = parent.makeServers(FTPServer, socks, ioloop, workers)
+    configureLogging()
+    try:
+        while True:
+            pollIoloop(ioloop)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    ioloop.close()
+    stats.flush()
+    parent.closeCaches()
+
+
+class Server:
     def __init__(self):
-        super().__init__()
         self.port = 2121
         self.sharedDir = ""
-        self.dtp_handler = ThrottledDTPHandler
+        self.dtp_handler = ThrottledSendfileDTPHandler
         self.ftp_handler = CustomHandler
+        self.ftp_handler.dtp_handler = self.dtp_handler
+        self.sharedLimit = None
+        # connections per address, counted by all prefork workers
+        self.addressTable = None
+        # bytes per second for the whole server, and the number of
+        # processes or servers pacing their clients with a part of it
+        self.bandwidth = 0
+        self.limitShares = 1
+        self.listingCacheSize = 0
+        self.hashCacheFile = ""
+        self.manifestFile = ""
+        self.manifestStopped = None
+        self.indexFile = ""
+        # everything shared, kept current while the server runs
+        self.index = None
+        # HTTP next to FTP, 0 for none
+        self.httpPort = 0
+        self.http = None
         self.ftp_handler.banner = "21Lane ready"
         self.connected = 0
         self.bytesTransferred = 0
         self.filesTransferred = 0
-        self.setTerminationEnabled(True)
+        self.engine = ENGINE_SINGLE
+        self.workers = cpu_count()
+        self.backlog = LISTEN_BACKLOG
+        self.maxConnections = MAX_CONNECTIONS
+        self.maxConnectionsPerIP = MAX_CONNECTIONS_PER_IP
+        self.maxTransfers = MAX_TRANSFERS
+        self.running = False
+        self.servers = []
+        self.socks = []
+        # interface names or addresses to listen on, empty for all
+        self.bindAddresses = []
+        self.nextSample = 0
+        self.thread = None
 
     def setPort(self, port):
-        if isPortAvailable(port):
+        if isPortAvailable(port, self.bindAddresses):
             self.port = port    
         else:
             raise PortUnavailableError
@@ -62,21 +679,311 @@ class Server(QThread):
             raise FileNotFoundError
         self.authorizer = DummyAuthorizer()
         self.authorizer.add_anonymous(path)
+        self.sharedDir = path
         self.ftp_handler.authorizer = self.authorizer
 
+    def setBindAddresses(self, selection):
+        # interface names (eth0) and/or addresses, empty listens on every
+        # address, IPv4 and IPv6
+        self.bindAddresses = list(selection)
+
     def setBandwidth(self, netSpeed):
-        self.dtp_handler.read_limit = netSpeed
-        self.ftp_handler.dtp_handler = self.dtp_handler
+        # netSpeed is in bytes per second for the whole server, 0 for no
+        # limit; running transfers pick it up immediately
+        self.bandwidth = netSpeed
+        self.dtp_handler.governor.setRate(netSpeed // self.limitShares)
+        if self.sharedLimit is not None:
+            self.sharedLimit.value = netSpeed
+
+    def setEngine(self, engine, workers=0):
+        if engine not in ENGINES:
+            engine = ENGINE_SINGLE
+        # pre-forking needs fork(), fall back to threads elsewhere
+        if engine == ENGINE_PREFORK and "fork" not in get_all_start_methods():
+            engine = ENGINE_THREADED
+        self.engine = engine
+        self.workers = workers if workers > 0 else cpu_count()
+
+    def setHttpPort(self, port):
+        # serve the share over HTTP too, on the same addresses; 0 for FTP only
+        self.httpPort = port
+
+    def setReadPolicy(self, dropBehind, readahead):
+        # bytes: files at least dropBehind big leave the page cache as they
+        # are sent, readahead is read ahead of peers; 0 turns each off
+        self.dtp_handler.readPolicy = ReadPolicy(dropBehind, readahead)
+
+    def setListingCacheSize(self, size):
+        # bytes of formatted directory listings kept in memory, 0 disables
+        self.listingCacheSize = size
+
+    def setCompressionLevel(self, level):
+        # deflate level 1-9 for MODE Z transfers, 0 refuses MODE Z
+        self.ftp_handler.compressionLevel = max(0, min(9, level))
+
+    def setHashCacheFile(self, filename):
+        # sqlite database with file checksums, empty disables HASH and co.
+        self.hashCacheFile = filename
+
+    def setManifestFile(self, filename):
+        # sqlite database behind SITE MANIFEST, empty disables it
+        self.manifestFile = filename
+
+    def setIndexFile(self, filename):
+        # where the share index is saved between runs, empty walks the
+        # whole share on every start
+        self.indexFile = filename
+
+    def openCaches(self):
+        # once for every process serving connections
+        if self.manifestFile:
+            try:
+                self.ftp_handler.manifest = Manifest(self.manifestFile, self.sharedDir)
+                self.ftp_handler.searchIndex = SearchIndex(self.ftp_handler.manifest)
+            except Exception as e:
+                print ("manifest unavailable", e)
+        if self.listingCacheSize:
+            self.ftp_handler.listingCache = ListingCache(self.listingCacheSize)
+        if self.hashCacheFile:
+            try:
+                self.ftp_handler.hashCache = HashCache(self.hashCacheFile)
+            except Exception as e:
+                print ("hash cache unavailable", e)
+
+    def closeCaches(self):
+        if self.ftp_handler.searchIndex is not None:
+            self.ftp_handler.searchIndex.close()
+            self.ftp_handler.searchIndex = None
+        if self.ftp_handler.manifest is not None:
+            self.ftp_handler.manifest.close()
+            self.ftp_handler.manifest = None
+        if self.ftp_handler.listingCache is not None:
+            self.ftp_handler.listingCache.close()
+            self.ftp_handler.listingCache = None
+        if self.ftp_handler.hashCache is not None:
+            self.ftp_handler.hashCache.close()
+            self.ftp_handler.hashCache = None
+
+    def setLimits(self, maxConnections, maxConnectionsPerIP, maxTransfers, backlog=LISTEN_BACKLOG):
+        # 0 for no limit, applied when the server (re)starts
+        self.maxConnections = maxConnections
+        self.maxConnectionsPerIP = maxConnectionsPerIP
+        self.maxTransfers = maxTransfers
+        self.backlog = backlog if backlog > 0 else LISTEN_BACKLOG
+
+    def setTimeouts(self, control, data):
+        # seconds a control / data connection may stay idle, 0 for ever
+        self.ftp_handler.timeout = control
+        self.dtp_handler.timeout = data
+
+    def applyLimits(self, server, share=1):
+        # share is the number of processes splitting the limits
+        maxConnections = -(-self.maxConnections // share)
+        self.ftp_handler.maxConnections = maxConnections
+        # the socket budget: a control and a data connection per client
+        # plus the listener, refused before the handler is even set up
+        server.max_cons = 2 * maxConnections + 1 if maxConnections else 0
+        # split across processes, the per address limit is checked on
+        # counters they share instead, see CustomHandler.handle()
+        server.max_cons_per_ip = self.maxConnectionsPerIP if share == 1 else 0
+
+    def makeServers(self, serverClass, socks, ioloop, share=1):
+        # one server per listening socket, all on one ioloop; they share
+        # the per address bookkeeping so the limits span every listener
+        servers = []
+        for sock in socks:
+            server = serverClass(sock, self.ftp_handler, ioloop=ioloop)
+            if servers:
+                server.ip_map = servers[0].ip_map
+            self.applyLimits(server, share)
+            servers.append(server)
+        return servers
+
+    def makeTransferSlots(self, share=1):
+        if not self.maxTransfers:
+            return None
+        return Semaphore(-(-self.maxTransfers // share))
+
+    def applySettings(self, configDic):
+        # the Settings keys that are not on the form
+        self.setEngine(configDic["serverEngine"], configDic["serverWorkers"])
+        self.setLimits(configDic["maxConnections"], configDic["maxConnectionsPerIP"], \
+            configDic["maxTransfers"], configDic["listenBacklog"])
+        self.setTimeouts(configDic["controlTimeout"], configDic["dataTimeout"])
+        self.setBindAddresses(configDic["bindAddresses"])
+        self.setHttpPort(configDic["httpPort"])
+        self.setManifestFile(configDic["manifestFile"])
+        self.setIndexFile(configDic["indexFile"])
+        self.setListingCacheSize(configDic["listingCacheMB"] * 1048576)
+        self.setHashCacheFile(configDic["hashCacheFile"])
+        self.setCompressionLevel(configDic["compressionLevel"])
+        self.setReadPolicy(configDic["dropBehindMB"] * 1048576, configDic["readaheadMB"] * 1048576)
+
+    def start(self):
+        # bound here, so that an address in use is the caller's error
+        httpSocks = []
+        try:
+            self.socks = openListeners(self.bindAddresses, self.port, self.backlog)
+            if self.httpPort:
+                try:
+                    httpSocks = openListeners(self.bindAddresses, self.httpPort, self.backlog)
+                except OSError:
+                    for sock in self.socks:
+                        sock.close()
+                    self.socks = []
+                    raise
+        except OSError as e:
+            if e.errno == errno.EADDRINUSE:
+                raise PortUnavailableError
+            raise
+        self.index = ShareIndex(self.sharedDir, self.indexFile)
+        self.index.start()
+        if httpSocks:
+            # before the serving thread, prefork hands the HTTP server a
+            # share of the speed limit
+            self.http = self.makeHttpServer()
+            self.http.start(httpSocks)
+        manifest = None
+        if self.manifestFile:
+            # made before the serving processes open it too: a new database
+            # turned to WAL while they do is locked to them
+            try:
+                manifest = Manifest(self.manifestFile, self.sharedDir)
+            except Exception as e:
+                print ("manifest unavailable", e)
+        self.running = True
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        if manifest is not None:
+            self.manifestStopped = Event()
+            Thread(target=self.updateManifest, args=(manifest, self.index, self.manifestStopped), daemon=True).start()
+
+    def makeHttpServer(self):
+        # the same governor and stats as the FTP side, its own share of
+        # the connection and transfer limits
+        http = HttpServer(self.sharedDir, self.dtp_handler.governor, self.ftp_handler.stats)
+        http.timeout = self.ftp_handler.timeout
+        http.dataTimeout = self.dtp_handler.timeout
+        http.maxConnections = self.maxConnections
+        http.maxConnectionsPerIP = self.maxConnectionsPerIP
+        http.transferSlots = self.makeTransferSlots()
+        http.readPolicy = self.dtp_handler.readPolicy
+        return http
+
+    def updateManifest(self, manifest, index, stopped):
+        # the only writer, serving processes read through their own handle;
+        # once the index has walked the share, every change it sees goes
+        # straight into the manifest
+        while not index.ready.wait(POLL_INTERVAL):
+            if stopped.is_set():
+                manifest.close()
+                return
+        try:
+            index.follow(manifest.refresh, manifest.update)
+        except Exception as e:
+            print ("manifest refresh failed", e)
+        stopped.wait()
+        index.unfollow(manifest.update)
+        manifest.close()
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def wait(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+        return not self.isRunning()
 
     def stopServer(self):
+        if self.http is not None:
+            self.http.stop()
+            self.http = None
+        if self.manifestStopped is not None:
+            self.manifestStopped.set()
+            self.manifestStopped = None
+        if self.index is not None:
+            self.index.close()
+            self.index = None
         if self.isRunning():
-            self.server.close_all
-            self.quit()
-            if not self.wait(1000):
-                self.terminate()
+            self.running = False
+            if not self.wait(POLL_INTERVAL + 1):
+                print ("server did not stop in time")
 
     def run(self):
-        self.server = FTPServer(('', self.port), self.ftp_handler)
-        self.finished.connect(self.server.close_all)
-        self.server.serve_forever()
-        self.server = None 
+        self.nextSample = 0
+        self.ftp_handler.stats.resetWorkers()
+        if self.engine == ENGINE_PREFORK:
+            self.runPrefork()
+            return
+        socks, self.socks = self.socks, []
+        self.openCaches()
+        self.ftp_handler.transferSlots = self.makeTransferSlots()
+        ioloop = IOLoop()
+        serverClass = ThreadedFTPServer if self.engine == ENGINE_THREADED else FTPServer
+        if self.engine == ENGINE_THREADED:
+            # a class wide Event, set by close_all() of the last run and
+            # cleared only by serve_forever(), which we do not call;
+            # handler threads end as soon as they see it set
+            serverClass._exit.clear()
+        self.servers = self.makeServers(serverClass, socks, ioloop)
+        configureLogging()
+        # poll in slices so that stopServer() can end the loop cleanly
+        while self.running:
+            pollIoloop(ioloop)
+            self.sampleStats()
+        # threaded servers also stop their handler threads here
+        for server in self.servers:
+            server.close_all()
+        self.servers = []
+        self.closeCaches()
+
+    def sampleStats(self):
+        now = monotonic()
+        if now >= self.nextSample:
+            self.nextSample = now + SAMPLE_INTERVAL
+            self.ftp_handler.stats.sample()
+
+    def runPrefork(self):
+        context = get_context("fork")
+        socks, self.socks = self.socks, []
+        queue = context.Queue()
+        # the workers, and the HTTP server if there is one, pace their
+        # clients with an equal part of the limit each
+        self.limitShares = self.workers + (1 if self.http is not None else 0)
+        self.dtp_handler.governor.setRate(self.bandwidth // self.limitShares)
+        self.sharedLimit = context.Value('q', self.bandwidth, lock=False)
+        self.addressTable = AddressTable(context)
+        workers = []
+        for worker in range(self.workers):
+            proc = context.Process(target=preforkWorker, args=(self, socks, queue, worker), daemon=True)
+            proc.start()
+            workers.append(proc)
+        # the workers own the listening sockets from here on
+        for sock in socks:
+            sock.close()
+        stats = self.ftp_handler.stats
+        while self.running:
+            self.sampleStats()
+            try:
+                worker, event, args = queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                continue
+            getattr(stats, event)(*args, worker=worker)
+        for proc in workers:
+            proc.terminate()
+        for proc in workers:
+            proc.join(1)
+        # pick up what the workers flushed on their way out
+        while True:
+            try:
+                worker, event, args = queue.get(timeout=0.1)
+            except Empty:
+                break
+            getattr(stats, event)(*args, worker=worker)
+        self.nextSample = 0
+        self.sampleStats()
+        queue.close()
+        self.sharedLimit = None
+        self.addressTable = None
+        self.limitShares = 1
+        self.dtp_handler.governor.setRate(self.bandwidth)
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+# counters and signals fed by the FTP server, free of Qt so that the
+# headless daemon can use them too
+
+from threading import Lock
+
+from events import Signal
+from transferMeter import TransferMeter
+from metrics import MetricsRegistry
+
+# why the server turned something away
+REJECT_CONNECTIONS = "connections" # total connection limit
+REJECT_PER_IP = "perIP"            # connections from one address
+REJECT_TRANSFERS = "transfers"     # concurrent data transfers
+REJECT_METRICS = {
+    REJECT_CONNECTIONS: "ftp_rejected_connections_total",
+    REJECT_PER_IP: "ftp_rejected_per_ip_total",
+    REJECT_TRANSFERS: "ftp_rejected_transfers_total"
+}
+
+
+class ServerStatsUpdater:
+    def __init__(self):
+        self.clientConnect = Signal()
+        self.clientDisconnect = Signal()
+        # bytes actually sent for the completed file
+        self.fileTransfer = Signal()
+        # worker, active connections, bytes sent
+        self.workerUpdate = Signal()
+        # total bytes sent, bytes per second
+        self.throughput = Signal()
+        # reason, rejections for that reason so far
+        self.rejection = Signal()
+        self.workers = {}
+        self.rejections = dict.fromkeys(REJECT_METRICS, 0)
+        self.lock = Lock()
+        self.meter = TransferMeter()
+        self.metrics = MetricsRegistry()
+        self.metrics.gauge("ftp_connections_active", "Connected FTP clients")
+        self.metrics.counter("ftp_connections_total", "FTP connections accepted")
+        self.metrics.counter("ftp_bytes_sent_total", "Bytes sent on data connections", lambda: self.meter.totalBytes)
+        self.metrics.counter("ftp_files_sent_total", "Files sent completely")
+        self.metrics.counter("ftp_list_requests_total", "LIST, NLST and MLSD requests")
+        self.metrics.counter(REJECT_METRICS[REJECT_CONNECTIONS], "Connections refused, server full")
+        self.metrics.counter(REJECT_METRICS[REJECT_PER_IP], "Connections refused, too many from one address")
+        self.metrics.counter(REJECT_METRICS[REJECT_TRANSFERS], "Transfers refused, too many in progress")
+        self.metrics.counter("ftp_deflate_in_bytes_total", "Bytes compressed for MODE Z transfers")
+        self.metrics.counter("ftp_deflate_out_bytes_total", "Bytes MODE Z transfers were compressed to")
+        self.metrics.gauge("http_connections_active", "Connected HTTP clients")
+        self.metrics.counter("http_requests_total", "HTTP requests answered")
+        self.metrics.counter("http_errors_total", "HTTP requests answered with an error status")
+        self.metrics.histogram("ftp_connect_seconds", "Time from accepting a connection to login")
+        self.metrics.histogram("ftp_first_byte_seconds", "Time from a RETR or listing command to its first data byte")
+
+    def resetWorkers(self):
+        with self.lock:
+            self.workers.clear()
+
+    def updateWorker(self, worker, connections, filesize):
+        with self.lock:
+            counters = self.workers.setdefault(worker, [0, 0])
+            counters[0] += connections
+            counters[1] += filesize
+            connections, filesize = counters
+        self.workerUpdate.emit(worker, connections, filesize)
+
+    def sent(self, amount, worker=0):
+        # called for every chunk, signals are left to sample()
+        with self.lock:
+            self.workers.setdefault(worker, [0, 0])[1] += amount
+        self.meter.add(amount)
+
+    def sample(self):
+        totalBytes, rate = self.meter.sample()
+        self.throughput.emit(totalBytes, rate)
+        with self.lock:
+            workers = [ (worker, counters[0], counters[1]) for worker, counters in self.workers.items() ]
+        for worker, connections, bytesSent in workers:
+            self.workerUpdate.emit(worker, connections, bytesSent)
+
+    def connected(self, worker=0):
+        self.metrics.inc("ftp_connections_active")
+        self.metrics.inc("ftp_connections_total")
+        self.clientConnect.emit()
+        self.updateWorker(worker, 1, 0)
+
+    def disconnected(self, worker=0):
+        self.metrics.inc("ftp_connections_active", -1)
+        self.clientDisconnect.emit()
+        self.updateWorker(worker, -1, 0)
+
+    def transferred(self, filesize, worker=0):
+        # the bytes were already counted by sent()
+        self.metrics.inc("ftp_files_sent_total")
+        self.fileTransfer.emit(filesize)
+
+    def listed(self, worker=0):
+        self.metrics.inc("ftp_list_requests_total")
+
+    def loggedIn(self, latency, worker=0):
+        self.metrics.observe("ftp_connect_seconds", latency)
+
+    def firstByte(self, latency, worker=0):
+        self.metrics.observe("ftp_first_byte_seconds", latency)
+
+    def deflated(self, bytesIn, bytesOut, worker=0):
+        # a MODE Z transfer completed, bytesOut were sent for bytesIn
+        self.metrics.inc("ftp_deflate_in_bytes_total", bytesIn)
+        self.metrics.inc("ftp_deflate_out_bytes_total", bytesOut)
+
+    def httpConnected(self, worker=0):
+        self.metrics.inc("http_connections_active")
+
+    def httpDisconnected(self, worker=0):
+        self.metrics.inc("http_connections_active", -1)
+
+    def served(self, status, worker=0):
+        # an HTTP response went out, its body bytes go through sent()
+        self.metrics.inc("http_requests_total")
+        if status >= 400:
+            self.metrics.inc("http_errors_total")
+
+    def rejected(self, reason, worker=0):
+        self.metrics.inc(REJECT_METRICS[reason])
+        with self.lock:
+            self.rejections[reason] += 1
+            count = self.rejections[reason]
+        self.rejection.emit(reason, count)
@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+
+# logged in FTP sessions kept per peer, so that browsing does not pay for a
+# connection and a login on every click. Runs on the engine's loop.
+# A session that sat idle is checked before it is lent again, kept alive
+# with NOOPs for a while and then let go; one that broke while in use is
+# dropped, and the work it was doing tried once more on a fresh one.
+
+import asyncio
+from time import monotonic
+from ftplib import error_perm, error_temp
+
+from ftpClient import AsyncFTP
+
+# a peer takes 8 connections per address by default, downloads use 4
+MAX_SESSIONS_PER_HOST = 3
+KEEPALIVE_INTERVAL = 60 # seconds between NOOPs of an idle session
+IDLE_TIMEOUT = 180 # seconds a session is kept unused
+# idle for longer than this, a session is asked for a NOOP before it is lent
+HEALTH_CHECK_AFTER = 30
+# the reply of a server hanging up on us, idle timeout and the like
+CLOSING = "421"
+
+
+class PooledSession:
+    def __init__(self, ftp):
+        self.ftp = ftp
+        self.lastUsed = monotonic()
+        self.lastNoop = self.lastUsed
+
+    def alive(self):
+        # what the loop already knows, without a round trip
+        reader, writer = self.ftp.reader, self.ftp.writer
+        return reader is not None and not reader.at_eof() and not writer.is_closing()
+
+
+class SessionPool:
+    def __init__(self, maxPerHost=MAX_SESSIONS_PER_HOST, idleTimeout=IDLE_TIMEOUT, setup=None):
+        self.maxPerHost = maxPerHost
+        # coroutine function run with every new session once logged in
+        self.setup = setup
+        self.idleTimeout = idleTimeout
+        # (host, port) -> [PooledSession], the most recently used last
+        self.idle = {}
+        # (host, port) -> Semaphore, sessions lent out or being opened
+        self.slots = {}
+        self.maintainer = None
+
+    async def open(self, host, port):
+        ftp = AsyncFTP()
+        try:
+            await ftp.connect(host, port)
+            await ftp.login()
+            if self.setup is not None:
+                await self.setup(ftp)
+        except BaseException:
+            ftp.close()
+            raise
+        return PooledSession(ftp)
+
+    async def healthy(self, session):
+        if not session.alive():
+            return False
+        if monotonic() - session.lastNoop < HEALTH_CHECK_AFTER:
+            return True
+        try:
+            await session.ftp.voidcmd("NOOP")
+        except Exception:
+            return False
+        session.lastNoop = monotonic()
+        return True
+
+    async def acquire(self, host, port):
+        # (PooledSession, whether it was reused)
+        key = (host, port)
+        if key not in self.slots:
+            self.slots[key] = asyncio.Semaphore(self.maxPerHost)
+        await self.slots[key].acquire()
+        try:
+            idle = self.idle.get(key, [])
+            while idle:
+                session = idle.pop()
+                if await self.healthy(session):
+                    return session, True
+                session.ftp.close()
+            return await self.open(host, port), False
+        except BaseException:
+            self.slots[key].release()
+            raise
+
+    def release(self, host, port, session, broken=False):
+        key = (host, port)
+        if broken:
+            session.ftp.close()
+        else:
+            session.lastUsed = monotonic()
+            self.idle.setdefault(key, []).append(session)
+            if self.maintainer is None or self.maintainer.done():
+                self.maintainer = asyncio.get_running_loop().create_task(self.maintain())
+        self.slots[key].release()
+
+    async def call(self, host, port, operation):
+        # await operation(ftp) on a session of the peer; an error reply
+        # leaves the session as it is, a 421 or a broken connection drops
+        # it, and a reused one that failed like that gets another go on a
+        # new one, so operation must start from scratch every time
+        while True:
+            session, reused = await self.acquire(host, port)
+            try:
+                result = await operation(session.ftp)
+            except (error_perm, error_temp) as e:
+                if not str(e).startswith(CLOSING):
+                    self.release(host, port, session)
+                    raise
+                broken = e
+            except (OSError, EOFError, asyncio.TimeoutError) as e:
+                broken = e
+            except BaseException:
+                self.release(host, port, session, broken=True)
+                raise
+            else:
+                self.release(host, port, session)
+                return result
+            self.release(host, port, session, broken=True)
+            if not reused:
+                raise broken
+            print ("pooled session to", host, "broke, retrying:", broken)
+
+    async def maintain(self):
+        # NOOPs for idle sessions, and goodbye to those idle for too long
+        while self.idle:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            now = monotonic()
+            for key, sessions in list(self.idle.items()):
+                for session in list(sessions):
+                    if session not in sessions:
+                        # lent out while we were talking to another one
+                        continue
+                    if now - session.lastUsed >= self.idleTimeout or not session.alive():
+                        sessions.remove(session)
+                        await self.quit(session)
+                    elif now - session.lastNoop >= KEEPALIVE_INTERVAL:
+                        # taken out while it talks, nobody borrows it midway
+                        sessions.remove(session)
+                        try:
+                            await session.ftp.voidcmd("NOOP")
+                            session.lastNoop = monotonic()
+                            sessions.append(session)
+                        except Exception:
+                            session.ftp.close()
+                if not sessions and self.idle.get(key) is sessions:
+                    del self.idle[key]
+
+    async def quit(self, session):
+        try:
+            await session.ftp.quit()
+        except Exception:
+            session.ftp.close()
+
+    async def close(self):
+        if self.maintainer is not None:
+            self.maintainer.cancel()
+            self.maintainer = None
+        idle, self.idle = self.idle, {}
+        for sessions in idle.values():
+            for session in sessions:
+                await self.quit(session)
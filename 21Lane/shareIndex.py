@@ -0,0 +1,480 @@
+#!/usr/bin/python3
+
+# every file and folder of the share kept in memory, built by one walk and
+# then kept current from inotify events, so the total size and file count
+# are always at hand without touching the disk again.
+# Paths look like they do to FTP clients ("/music/a.mp3"), entries are
+# (type, size, mtime) as in manifest.py. Without inotify, or once the
+# kernel runs out of watches, the share is rescanned every RESCAN_INTERVAL.
+# Linked folders are followed as the FTP server follows them, except for
+# links back to a folder above them, told apart by (device, inode).
+#
+# With a filename the index is saved there on close, by the index thread
+# on its way out. The next start reads back only the folders whose mtime
+# moved since, and then checks the files of the other folders in the
+# background for changes made in place.
+
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from select import select
+from stat import S_ISREG, S_ISDIR
+from threading import Thread, Lock, Event
+from time import monotonic, time_ns
+
+from events import Signal
+from inotify import Inotify, IN_DIR_CHANGES, IN_CLOSE_WRITE, IN_ONLYDIR, IN_IGNORED, IN_Q_OVERFLOW
+from manifest import TYPE_FILE, TYPE_DIR
+
+RESCAN_INTERVAL = 900 # seconds, only when inotify cannot cover the share
+WATCH_POLL_INTERVAL = 1
+WATCH_MASK = IN_DIR_CHANGES | IN_CLOSE_WRITE | IN_ONLYDIR
+SCAN_WORKERS = 16 # folders read or files stat'ed at once
+# a folder changed this shortly before it was read may change again within
+# the same timestamp tick, it is read again on the next start
+STAMP_SLACK = 2 * 10**9 # nanoseconds
+# how long close() waits for the index thread to save and stop; a save cut
+# short by the process exiting leaves the previous one in place
+CLOSE_TIMEOUT = 1 # seconds
+
+
+def entryFor(st):
+    # (type, size, mtime) for a stat result, None for anything that is
+    # neither a regular file nor a folder
+    if S_ISDIR(st.st_mode):
+        return (TYPE_DIR, 0, int(st.st_mtime))
+    if S_ISREG(st.st_mode):
+        return (TYPE_FILE, st.st_size, int(st.st_mtime))
+    return None
+
+
+def ancestors(path):
+    # "/a/b/c" -> "/a/b", "/a", ""
+    while path:
+        path = path.rpartition("/")[0]
+        yield path
+
+
+class ShareIndex:
+    def __init__(self, root, filename="", useInotify=True):
+        self.root = root
+        self.filename = filename
+        self.lock = Lock()
+        # held while a batch of changes is applied and announced, see follow()
+        self.batchLock = Lock()
+        self.entries = {}
+        # folder path -> names of its entries, "" is the share itself
+        self.children = {}
+        # folder path -> (st_dev, st_ino), for telling link loops apart
+        self.keys = {}
+        # folder path -> st_mtime_ns when it was last read, 0 if unsure
+        self.stamps = {}
+        self.totalSize = 0
+        self.fileCount = 0
+        # path -> (type, size, mtime), None for removed paths; emitted on
+        # the index thread once per batch
+        self.changed = Signal()
+        self.ready = Event()
+        self.stopped = Event()
+        self.thread = None
+        # written to by close(), wakes up the watch loop
+        self.wakeup = None
+        self.watcher = None
+        self.watches = {} # folder path -> wd
+        self.watchPaths = {} # wd -> folder path
+        # False once a folder could not be watched, rescans take over
+        self.complete = True
+        if useInotify:
+            try:
+                self.watcher = Inotify()
+            except OSError as e:
+                print ("share index: no inotify, rescanning every", RESCAN_INTERVAL, "seconds", e)
+            else:
+                self.wakeup = os.pipe()
+        if self.watcher is None:
+            self.complete = False
+
+    def start(self):
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        # stop following the share; a rescan still running and the save
+        # after it finish on the index thread, the caller does not wait
+        # for them past timeout
+        with self.lock:
+            self.stopped.set()
+            if self.wakeup is not None:
+                os.write(self.wakeup[1], b"x")
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.entries)
+
+    def follow(self, initial, callback):
+        # initial(snapshot) and then callback(changes) for every later batch,
+        # with no change slipping in between the two
+        with self.batchLock:
+            initial(self.snapshot())
+            self.changed.connect(callback)
+
+    def unfollow(self, callback):
+        self.changed.disconnect(callback)
+
+    def run(self):
+        with self.batchLock:
+            clean = self.load()
+            if clean is None:
+                self.scan([ "" ], {})
+        if self.stopped.is_set():
+            # a half built index is not worth saving
+            self.closeWatcher()
+            return
+        self.ready.set()
+        if clean:
+            self.verify(clean)
+        if self.watcher is not None:
+            self.watch()
+        else:
+            while not self.stopped.wait(RESCAN_INTERVAL):
+                self.rescan()
+        if self.filename:
+            with self.batchLock:
+                try:
+                    self.save()
+                except sqlite3.Error as e:
+                    print ("share index not saved", e)
+
+    def realPath(self, path):
+        return self.root + path
+
+    def setEntry(self, path, entry, changes):
+        # callers hold batchLock
+        with self.lock:
+            old = self.entries.get(path)
+            if old == entry:
+                return
+            if old is not None and old[0] == TYPE_FILE:
+                self.totalSize -= old[1]
+                self.fileCount -= 1
+            if entry is None:
+                self.entries.pop(path, None)
+            else:
+                self.entries[path] = entry
+                if entry[0] == TYPE_FILE:
+                    self.totalSize += entry[1]
+                    self.fileCount += 1
+            parent, _, name = path.rpartition("/")
+            if entry is None:
+                if parent in self.children:
+                    self.children[parent].discard(name)
+            else:
+                self.children.setdefault(parent, set()).add(name)
+        changes[path] = entry
+
+    def chain(self, folder):
+        # keys of folder and the folders above it
+        with self.lock:
+            return { self.keys[path] for path in (folder,) + tuple(ancestors(folder)) if path in self.keys }
+
+    def readFolder(self, folder):
+        # (stat of folder, [(name, stat)]), runs on the scan pool; watched
+        # and stat'ed before listing, so later changes are either seen by
+        # inotify or leave the folder with a newer mtime
+        self.addWatch(folder)
+        realPath = self.realPath(folder)
+        st = os.stat(realPath)
+        items = []
+        with os.scandir(realPath) as it:
+            for item in it:
+                try:
+                    items.append((item.name, item.stat()))
+                except OSError:
+                    continue
+        return st, items
+
+    def scan(self, folders, changes):
+        # read folders on the scan pool, and every folder below them that
+        # the index does not know yet; callers hold batchLock
+        with ThreadPoolExecutor(SCAN_WORKERS) as pool:
+            pending = { pool.submit(self.readFolder, folder): folder for folder in folders }
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    folder = pending.pop(future)
+                    if self.stopped.is_set() or folder and folder not in self.entries:
+                        continue
+                    try:
+                        st, items = future.result()
+                    except OSError:
+                        with self.lock:
+                            self.children.setdefault(folder, set())
+                        continue
+                    for path in self.merge(folder, st, items, changes):
+                        pending[pool.submit(self.readFolder, path)] = path
+
+    def merge(self, folder, st, items, changes):
+        # bring the entries of folder in line with a fresh read of it,
+        # returns the folders found in it that still need reading
+        stamp = st.st_mtime_ns if time_ns() - st.st_mtime_ns > STAMP_SLACK else 0
+        with self.lock:
+            gone = set(self.children.setdefault(folder, set()))
+            self.keys[folder] = (st.st_dev, st.st_ino)
+            self.stamps[folder] = stamp
+        if folder:
+            # its parent may not have been read along with it
+            self.setEntry(folder, entryFor(st), changes)
+        chain = self.chain(folder)
+        pending = []
+        for name, itemSt in items:
+            path = folder + "/" + name
+            gone.discard(name)
+            entry = entryFor(itemSt)
+            key = (itemSt.st_dev, itemSt.st_ino)
+            if entry is not None and entry[0] == TYPE_DIR and key in chain:
+                print ("share index: not following link loop", path)
+                entry = None
+            self.replace(path, entry, key, changes)
+            if entry is not None and entry[0] == TYPE_DIR and path not in self.children:
+                pending.append(path)
+        for name in gone:
+            self.remove(folder + "/" + name, changes)
+        return pending
+
+    def replace(self, path, entry, key, changes):
+        # path now has entry, folders below it go if something else took
+        # its place; key is (st_dev, st_ino) of path
+        old = self.entries.get(path)
+        if old is not None and (entry is None or old[0] != entry[0] or \
+                old[0] == TYPE_DIR and self.keys.get(path, key) != key):
+            self.remove(path, changes)
+        if entry is not None:
+            self.setEntry(path, entry, changes)
+
+    def remove(self, path, changes):
+        # path and, for a folder, everything below it
+        with self.lock:
+            names = list(self.children.get(path, ()))
+        for name in names:
+            self.remove(path + "/" + name, changes)
+        with self.lock:
+            self.children.pop(path, None)
+            self.keys.pop(path, None)
+            self.stamps.pop(path, None)
+        self.dropWatch(path)
+        self.setEntry(path, None, changes)
+
+    def refresh(self, path, changes):
+        # bring path in line with the disk after an event about it
+        try:
+            st = os.stat(self.realPath(path))
+        except OSError:
+            entry, key = None, None
+        else:
+            entry, key = entryFor(st), (st.st_dev, st.st_ino)
+            if entry is not None and entry[0] == TYPE_DIR and key in self.chain(path.rpartition("/")[0]):
+                entry = None
+        self.replace(path, entry, key, changes)
+        if entry is not None and entry[0] == TYPE_DIR and path not in self.children:
+            self.scan([ path ], changes)
+
+    def rescan(self):
+        # walk everything again and keep what changed, after a queue
+        # overflow or as the periodic fallback
+        with self.batchLock:
+            changes = {}
+            previous = self.snapshot()
+            seen = ShareIndex(self.root, useInotify=False)
+            seen.scan([ "" ], {})
+            current = seen.entries
+            for path in previous.keys() - current.keys():
+                if path in self.entries:
+                    self.remove(path, changes)
+            for path in sorted(current):
+                if path not in self.entries or self.entries[path] != current[path]:
+                    self.refresh(path, changes)
+            if self.watcher is not None:
+                with self.lock:
+                    folders = list(self.children)
+                for folder in folders:
+                    self.addWatch(folder)
+            self.announce(changes)
+
+    def verify(self, folders):
+        # files of folders that looked unchanged since the save may still
+        # have been rewritten in place
+        with self.lock:
+            paths = [ folder + "/" + name for folder in folders for name in self.children.get(folder, ()) ]
+            paths = [ path for path in paths if self.entries.get(path, (None,))[0] == TYPE_FILE ]
+        def check(path):
+            try:
+                return entryFor(os.stat(self.realPath(path)))
+            except OSError:
+                return None
+        with ThreadPoolExecutor(SCAN_WORKERS) as pool:
+            found = list(pool.map(check, paths))
+        with self.batchLock:
+            changes = {}
+            for path, entry in zip(paths, found):
+                if self.entries.get(path) != entry:
+                    self.refresh(path, changes)
+            self.announce(changes)
+
+    def load(self):
+        # the saved index brought up to date: folders that moved since are
+        # read again, returns the folders that did not, None without a
+        # usable save; callers hold batchLock
+        if not self.filename or not os.path.exists(self.filename):
+            return None
+        try:
+            db = sqlite3.connect(self.filename)
+            try:
+                root = db.execute("SELECT value FROM meta WHERE key='root'").fetchone()
+                if root is None or root[0] != self.root:
+                    return None
+                rows = db.execute("SELECT path, type, size, mtime FROM entries").fetchall()
+                stamps = dict(db.execute("SELECT path, stamp FROM folders").fetchall())
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            print ("share index: no saved index", e)
+            return None
+        with self.lock:
+            self.children[""] = set()
+            for path, type, size, mtime in rows:
+                self.entries[path] = (type, size, mtime)
+                parent, _, name = path.rpartition("/")
+                self.children.setdefault(parent, set()).add(name)
+                if type == TYPE_DIR:
+                    self.children.setdefault(path, set())
+                else:
+                    self.totalSize += size
+                    self.fileCount += 1
+            folders = list(self.children)
+        def check(folder):
+            self.addWatch(folder)
+            try:
+                return os.stat(self.realPath(folder))
+            except OSError:
+                return None
+        with ThreadPoolExecutor(SCAN_WORKERS) as pool:
+            found = list(pool.map(check, folders))
+        changes = {}
+        clean, dirty = [], []
+        for folder, st in zip(folders, found):
+            if st is None or not S_ISDIR(st.st_mode):
+                if folder == "":
+                    return None
+                if folder in self.entries:
+                    self.remove(folder, changes)
+                continue
+            with self.lock:
+                self.keys[folder] = (st.st_dev, st.st_ino)
+            if stamps.get(folder) == st.st_mtime_ns:
+                with self.lock:
+                    self.stamps[folder] = st.st_mtime_ns
+                clean.append(folder)
+            else:
+                dirty.append(folder)
+        self.scan([ folder for folder in dirty if folder in self.children ], changes)
+        return [ folder for folder in clean if folder in self.children ]
+
+    def save(self):
+        # callers hold batchLock
+        with self.lock:
+            rows = [ (path,) + entry for path, entry in self.entries.items() ]
+            stamps = list(self.stamps.items())
+        db = sqlite3.connect(self.filename)
+        try:
+            with db:
+                db.execute("CREATE TABLE IF NOT EXISTS entries (path TEXT, type TEXT, size INTEGER, mtime INTEGER)")
+                db.execute("CREATE TABLE IF NOT EXISTS folders (path TEXT, stamp INTEGER)")
+                db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+                db.execute("DELETE FROM entries")
+                db.execute("DELETE FROM folders")
+                db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?)", rows)
+                db.executemany("INSERT INTO folders VALUES (?, ?)", stamps)
+                db.execute("INSERT OR REPLACE INTO meta VALUES ('root', ?)", (self.root,))
+        finally:
+            db.close()
+
+    def announce(self, changes):
+        # callers hold batchLock
+        if changes:
+            self.changed.emit(changes)
+
+    def addWatch(self, folder):
+        if self.watcher is None or folder in self.watches:
+            return
+        try:
+            wd = self.watcher.addWatch(self.realPath(folder), WATCH_MASK)
+        except OSError as e:
+            if self.complete:
+                print ("share index: cannot watch", folder, e)
+            self.complete = False
+            return
+        with self.lock:
+            if self.watchPaths.get(wd, folder) != folder:
+                # one folder linked in twice, its events name only one path
+                self.complete = False
+                return
+            self.watches[folder] = wd
+            self.watchPaths[wd] = folder
+
+    def dropWatch(self, folder):
+        with self.lock:
+            wd = self.watches.pop(folder, None)
+            if wd is not None:
+                del self.watchPaths[wd]
+        if wd is not None:
+            self.watcher.removeWatch(wd)
+
+    def watch(self):
+        lastRescan = monotonic()
+        while not self.stopped.is_set():
+            if not self.complete and monotonic() - lastRescan >= RESCAN_INTERVAL:
+                # folders we could not watch are only seen by walking them
+                self.complete = True
+                self.rescan()
+                lastRescan = monotonic()
+            ready, _, _ = select([self.watcher, self.wakeup[0]], [], [], WATCH_POLL_INTERVAL)
+            if self.watcher not in ready:
+                continue
+            events = self.watcher.readEvents()
+            if any(mask & IN_Q_OVERFLOW for wd, mask, cookie, name in events):
+                self.rescan()
+                continue
+            # coalesce a batch into one refresh per path
+            paths = []
+            for wd, mask, cookie, name in events:
+                folder = self.watchPaths.get(wd)
+                if folder is None:
+                    continue
+                if mask & IN_IGNORED:
+                    with self.lock:
+                        self.watches.pop(folder, None)
+                        self.watchPaths.pop(wd, None)
+                    continue
+                if name:
+                    paths.append(folder + "/" + name)
+                if folder:
+                    # the folder's own mtime moves with its contents
+                    paths.append(folder)
+            with self.batchLock:
+                changes = {}
+                for path in dict.fromkeys(paths):
+                    self.refresh(path, changes)
+                self.announce(changes)
+        self.closeWatcher()
+
+    def closeWatcher(self):
+        if self.watcher is None:
+            return
+        # under the lock close() writes to wakeup with, once stopped is set
+        with self.lock:
+            self.watcher.close()
+            os.close(self.wakeup[0])
+            os.close(self.wakeup[1])
+            self.wakeup = None
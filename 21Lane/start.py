@@ -1,14 +1,19 @@
-#!/usr/bin/python3 
+#!/usr/bin/python3
 
-from PyQt5.QtWidgets import QApplication, QWidget
-import resources_rc
-import app, sys
+import sys
 
 if __name__=="__main__":
     if not ((sys.version_info.major == 3) and \
         (sys.version_info.minor >= 5)):
         print ("Sorry. PyQt5 requires at least Python3.5")
         sys.exit()
+    # headless mode must not import Qt at all
+    if sys.argv[1:2] == ["serve"]:
+        import daemon
+        sys.exit(daemon.main(sys.argv[2:]))
+    from PyQt5.QtWidgets import QApplication, QWidget
+    import resources_rc
+    import app
     q = QApplication(sys.argv)
     window = QWidget()
     print (QApplication.style())
@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+
+# a shared folder as one tar stream, for SITE TAR: a peer fetching a folder
+# of many small files gets all of them over one data connection instead of
+# a RETR, and a new data connection, per file. Compressed when the peer
+# asked for MODE Z, like everything else on the data connection.
+# Entries come in a fixed order, folders before what is in them and names
+# sorted, so a peer that lost the connection asks for the entries after
+# the last file it got and receives the rest, even if the folder changed.
+# TarReader unpacks such a stream on the engine's loop, as it comes in.
+
+import os
+import tarfile
+from stat import S_ISDIR, S_ISREG
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+CHUNK_SIZE = 65536 # bytes returned by more() at a time, about
+END_OF_ARCHIVE = b"\0" * (2 * BLOCK_SIZE)
+
+
+def memberKey(name):
+    # the order entries are sent in, and resumed from
+    return tuple(name.split("/"))
+
+
+class TarProducer:
+    # more() returns the tar of folder piece by piece, entries named
+    # "<folder name>/..."; after is the name of the last entry the peer
+    # has, None for all of them. Links are followed as long as they stay
+    # inside root.
+    def __init__(self, folder, root, after=None):
+        self.root = os.path.realpath(root)
+        self.after = memberKey(after) if after else None
+        name = os.path.basename(folder.rstrip(os.sep)) or "share"
+        self.entries = self.walk(folder, name, self.ancestors(folder))
+        # the member being sent and how much of it is left
+        self.file = None
+        self.remaining = 0
+        self.padding = 0
+        self.finished = False
+
+    def inside(self, path):
+        real = os.path.realpath(path)
+        return real == self.root or real.startswith(self.root.rstrip(os.sep) + os.sep)
+
+    def ancestors(self, folder):
+        # (dev, ino) of the folders above, up to root; a link to one of
+        # them is a loop as much as a link within the folder sent
+        keys = []
+        path = os.path.dirname(os.path.realpath(folder))
+        while self.inside(path):
+            try:
+                st = os.stat(path)
+            except OSError:
+                break
+            keys.append((st.st_dev, st.st_ino))
+            if path == self.root:
+                break
+            path = os.path.dirname(path)
+        return tuple(keys)
+
+    def walk(self, folder, name, parents=()):
+        # (path, name, stat) of every folder and file, in memberKey order
+        try:
+            st = os.stat(folder)
+        except OSError:
+            return
+        key = (st.st_dev, st.st_ino)
+        if key in parents:
+            # a link back up the tree
+            return
+        memberName = memberKey(name)
+        # folders holding the entry to resume after are walked, not sent
+        if self.after is None or memberName > self.after:
+            yield folder, name, st
+        elif memberName != self.after[:len(memberName)]:
+            return
+        try:
+            with os.scandir(folder) as entries:
+                children = sorted(entries, key=lambda entry: entry.name)
+        except OSError:
+            return
+        for entry in children:
+            childName = name + "/" + entry.name
+            if entry.is_symlink() and not self.inside(entry.path):
+                continue
+            try:
+                isDir = entry.is_dir()
+            except OSError:
+                continue
+            if isDir:
+                yield from self.walk(entry.path, childName, parents + (key,))
+            elif self.after is None or memberKey(childName) > self.after:
+                try:
+                    childStat = entry.stat()
+                except OSError:
+                    continue
+                if S_ISREG(childStat.st_mode):
+                    yield entry.path, childName, childStat
+
+    def header(self, name, st, isDir):
+        info = tarfile.TarInfo(name)
+        info.mtime = int(st.st_mtime)
+        info.mode = st.st_mode & 0o777
+        if isDir:
+            info.type = tarfile.DIRTYPE
+        else:
+            info.size = st.st_size
+        return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+    def nextMember(self, out):
+        # header of the next entry into out, False once there is none
+        for path, name, st in self.entries:
+            if S_ISDIR(st.st_mode):
+                out.append(self.header(name, st, True))
+                return True
+            try:
+                file = open(path, "rb")
+                # the size the header promises is what gets sent
+                st = os.fstat(file.fileno())
+            except OSError:
+                continue
+            out.append(self.header(name, st, False))
+            self.file = file
+            self.remaining = st.st_size
+            self.padding = -st.st_size % BLOCK_SIZE
+            return True
+        return False
+
+    def more(self):
+        if self.finished:
+            return b""
+        out = []
+        size = 0
+        while size < CHUNK_SIZE:
+            if self.file is None:
+                if not self.nextMember(out):
+                    out.append(END_OF_ARCHIVE)
+                    self.finished = True
+                    break
+                size += len(out[-1])
+                continue
+            try:
+                data = self.file.read(min(CHUNK_SIZE, self.remaining))
+            except OSError:
+                data = b""
+            if not data:
+                # the file shrank or went away, zeros keep the stream whole
+                data = b"\0" * min(CHUNK_SIZE, self.remaining)
+            out.append(data)
+            size += len(data)
+            self.remaining -= len(data)
+            if not self.remaining:
+                out.append(b"\0" * self.padding)
+                self.file.close()
+                self.file = None
+        return b"".join(out)
+
+
+def parsePax(data):
+    # {keyword: value} of a PAX extended header, "<length> <key>=<value>\n"
+    records = {}
+    position = 0
+    while position < len(data) and data[position]:
+        space = data.index(b" ", position)
+        length = int(data[position:space])
+        key, _, value = data[space + 1:position + length - 1].partition(b"=")
+        records[key.decode("utf-8")] = value.decode("utf-8", "surrogateescape")
+        position += length
+    return records
+
+
+class TarReader:
+    # the other end of TarProducer: read(n) is a coroutine returning
+    # exactly n bytes of the stream. next() gives the TarInfo of each
+    # entry, None after the last, and readData() the file in it
+    def __init__(self, read):
+        self.read = read
+        self.remaining = 0
+        self.padding = 0
+        self.finished = False
+
+    async def skip(self):
+        while self.remaining:
+            await self.readData()
+        if self.padding:
+            await self.read(self.padding)
+            self.padding = 0
+
+    async def next(self):
+        await self.skip()
+        pax = {}
+        while not self.finished:
+            block = await self.read(BLOCK_SIZE)
+            if not block.strip(b"\0"):
+                self.finished = True
+                break
+            info = tarfile.TarInfo.frombuf(block, "utf-8", "surrogateescape")
+            if info.type in (tarfile.XHDTYPE, tarfile.XGLTYPE):
+                data = await self.read(info.size + -info.size % BLOCK_SIZE)
+                if info.type == tarfile.XHDTYPE:
+                    pax = parsePax(data[:info.size])
+                continue
+            if "path" in pax:
+                info.name = pax["path"].rstrip("/")
+            if "size" in pax:
+                info.size = int(pax["size"])
+            if "mtime" in pax:
+                info.mtime = float(pax["mtime"])
+            self.remaining = info.size if info.isreg() else 0
+            self.padding = -self.remaining % BLOCK_SIZE
+            return info
+        return None
+
+    async def readData(self, size=CHUNK_SIZE):
+        # the next piece of the current file, b"" once it is all read
+        if not self.remaining:
+            return b""
+        data = await self.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
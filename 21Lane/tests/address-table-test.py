@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+
+# connects and disconnects random addresses against an AddressTable and a
+# plain dict, the table must never count two addresses together nor let
+# one past its limit; a small table makes them collide often
+# run from the 21Lane directory: python3 tests/address-table-test.py
+
+import sys
+sys.path.insert(0, '.')
+
+import random
+from multiprocessing import get_context
+from addressTable import AddressTable
+
+LIMIT = 3
+addresses = [ "10.0.0.%d" % i for i in range(40) ] + [ "fe80::%x%%eth0" % i for i in range(10) ]
+
+failed = False
+for slots in (16, 4096):
+    table = AddressTable(get_context("fork"), slots)
+    counts = {}
+    held = []
+    for step in range(20000):
+        if held and random.random() < 0.5:
+            address, slot = held.pop(random.randrange(len(held)))
+            if slot is not None:
+                table.remove(slot)
+                counts[address] -= 1
+            continue
+        address = random.choice(addresses)
+        full, slot = table.add(address, LIMIT)
+        if full != (counts.get(address, 0) >= LIMIT):
+            print (slots, "slots: wrong answer for", address, "counted", counts.get(address, 0))
+            failed = True
+            break
+        if slot is not None:
+            counts[address] = counts.get(address, 0) + 1
+        if not full:
+            held.append((address, slot))
+    for address, slot in held:
+        if slot is not None:
+            table.remove(slot)
+    print (slots, "slots, left counted:", sum(table.counts[:]))
+    failed = failed or sum(table.counts[:]) != 0
+
+print ("FAILED" if failed else "ok")
+sys.exit(1 if failed else 0)
@@ -0,0 +1,365 @@
+#!/usr/bin/python3
+
+# loopback load test: Server in a process of its own on a synthetic tree,
+# driven by many concurrent clients doing LIST, RETR of small and large
+# files, and connections that only sit there. Prints one JSON document,
+# for comparing one version or engine against another:
+#   throughput, p50/p99 latency of connect (up to the greeting), LIST (to
+#   the end of the listing) and RETR first byte (from PASV on), and CPU
+#   seconds and RSS of every server process, prefork workers included
+# run from the 21Lane directory:
+#   python3 tests/load-bench.py --engine prefork --clients 200 --duration 20 > prefork.json
+# CPU and RSS come from /proc, on other systems only the totals are given
+
+import sys
+sys.path.insert(0, '.')
+
+from server import Server
+from config import Settings
+from ftpClient import AsyncFTP
+
+import os
+import json
+import socket
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+from multiprocessing import get_context
+from resource import getrusage, RUSAGE_CHILDREN
+from tempfile import mkdtemp
+from time import monotonic, time
+from shutil import rmtree
+
+MB = 1048576
+GB = 1073741824
+CHUNK_SIZE = 65536
+OPS_PER_SESSION = 10 # a client reconnects after this many operations
+IDLE_NOOP = 30 # seconds between the NOOPs of an idle connection
+SMALL_MIN = 1024
+STOP_TIMEOUT = 10
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(prog="load-bench", description="Load test the share server on loopback.")
+    parser.add_argument("--engine", default="single", help="serverEngine: single, threaded or prefork")
+    parser.add_argument("--workers", type=int, default=0, help="prefork workers, 0 for one per CPU")
+    parser.add_argument("--clients", type=int, default=50, help="busy clients")
+    parser.add_argument("--idle", type=int, default=50, help="connections that only send NOOP")
+    parser.add_argument("--client-procs", dest="clientProcs", type=int, default=min(4, os.cpu_count() or 1), \
+        help="processes the clients are spread over, so that they are not what is measured; default %(default)s")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--mix", default="4:5:1", help="weights of LIST:small RETR:large RETR, default %(default)s")
+    parser.add_argument("--folders", type=int, default=20, help="folders in the tree")
+    parser.add_argument("--files", type=int, default=50, help="small files per folder")
+    parser.add_argument("--small-kb", dest="smallKB", type=int, default=64, help="biggest small file")
+    parser.add_argument("--large", type=int, default=4, help="large files")
+    parser.add_argument("--large-mb", dest="largeMB", type=int, default=64, help="size of a large file")
+    parser.add_argument("--seed", type=int, default=21, help="same seed, same tree and same requests")
+    parser.add_argument("--label", default="", help="copied into the output, to tell runs apart")
+    parser.add_argument("--output", help="file to write the JSON to, default stdout")
+    return parser.parse_args(argv)
+
+
+def makeTree(root, args, rng):
+    # (folders, small files, large files) as paths on the server
+    folders, small, large = [], [], []
+    for i in range(args.folders):
+        folder = "/dir%03d" % i
+        os.mkdir(root + folder)
+        folders.append(folder)
+        for j in range(args.files):
+            name = "%s/file%04d" % (folder, j)
+            with open(root + name, "wb") as file:
+                file.write(os.urandom(rng.randint(SMALL_MIN, args.smallKB * 1024)))
+            small.append(name)
+    chunk = os.urandom(MB)
+    for i in range(args.large):
+        name = "/large%d" % i
+        with open(root + name, "wb") as file:
+            for j in range(args.largeMB):
+                file.write(chunk)
+        large.append(name)
+    return folders, small, large
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(sharedDir, port, args, ready, stopped):
+    # the server process: the bench measures the server, not its limits;
+    # what it prints must not end up in the JSON
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    server = Server()
+    server.setPort(port)
+    server.setSharedDirectory(sharedDir)
+    server.applySettings(dict(Settings.configDic, serverEngine=args.engine, serverWorkers=args.workers, \
+        maxConnections=0, maxConnectionsPerIP=0, maxTransfers=0, listenBacklog=1024, bindAddresses=["127.0.0.1"], \
+        manifestFile="", indexFile="", hashCacheFile="", httpPort=0))
+    server.setBandwidth(0)
+    server.start()
+    ready.set()
+    stopped.wait()
+    server.stopServer()
+
+
+def processes(pid):
+    # the server process and its children, {pid: role}
+    found = { pid: "main" }
+    try:
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                with open("/proc/%s/stat" % entry) as file:
+                    # the name may hold spaces, the fields after it do not
+                    fields = file.read().rsplit(")", 1)[1].split()
+                if int(fields[1]) == pid:
+                    found[int(entry)] = "worker"
+    except OSError:
+        pass
+    return found
+
+
+def usage(pid):
+    # (CPU seconds, RSS MB, peak RSS MB) of a process, None if unknown
+    try:
+        with open("/proc/%d/stat" % pid) as file:
+            fields = file.read().rsplit(")", 1)[1].split()
+        rss = peak = 0
+        with open("/proc/%d/status" % pid) as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) / 1024
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    # utime and stime
+    return (int(fields[11]) + int(fields[12])) / ticks, rss, peak
+
+
+def percentiles(samples):
+    if not samples:
+        return { "count": 0, "p50": None, "p99": None, "max": None }
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return { "count": len(samples), "p50": round(pick(0.5) * 1000, 3), \
+        "p99": round(pick(0.99) * 1000, 3), "max": round(samples[-1] * 1000, 3) }
+
+
+class Load:
+    def __init__(self, port, tree, args):
+        self.port = port
+        self.folders, self.small, self.large = tree
+        self.weights = [ int(weight) for weight in args.mix.split(":") ]
+        self.args = args
+        self.latency = { "connect": [], "list": [], "firstByte": [] }
+        self.ops = { "list": 0, "small": 0, "large": 0 }
+        self.errors = {}
+        self.bytes = 0
+        self.deadline = 0
+
+    def error(self, e):
+        name = e.__class__.__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    async def connect(self):
+        ftp = AsyncFTP()
+        start = monotonic()
+        await ftp.connect("127.0.0.1", self.port)
+        self.latency["connect"].append(monotonic() - start)
+        await ftp.login()
+        return ftp
+
+    async def probe(self):
+        ftp = await self.connect()
+        await ftp.quit()
+        self.latency["connect"].clear()
+
+    async def list(self, ftp, rng):
+        received = []
+        start = monotonic()
+        await ftp.retrlines("LIST " + rng.choice(self.folders), received.append)
+        self.latency["list"].append(monotonic() - start)
+        self.bytes += sum(len(line) + 2 for line in received)
+        # LIST went in ASCII, files are fetched in binary
+        await ftp.setType("I")
+
+    async def retrieve(self, ftp, path):
+        start = monotonic()
+        reader, writer = await ftp.transfercmd("RETR " + path)
+        try:
+            first = True
+            while True:
+                data = await ftp.wait(reader.read(CHUNK_SIZE))
+                if not data:
+                    break
+                if first:
+                    self.latency["firstByte"].append(monotonic() - start)
+                    first = False
+                self.bytes += len(data)
+        finally:
+            writer.close()
+        await ftp.voidresp()
+
+    async def client(self, rng):
+        while monotonic() < self.deadline:
+            ftp = None
+            try:
+                ftp = await self.connect()
+                await ftp.setType("I")
+                for i in range(OPS_PER_SESSION):
+                    if monotonic() >= self.deadline:
+                        break
+                    op = rng.choices(("list", "small", "large"), self.weights)[0]
+                    if op == "list":
+                        await self.list(ftp, rng)
+                    else:
+                        await self.retrieve(ftp, rng.choice(self.small if op == "small" else self.large))
+                    self.ops[op] += 1
+                await ftp.quit()
+            except Exception as e:
+                self.error(e)
+                if ftp is not None:
+                    ftp.close()
+
+    async def idle(self):
+        ftp = None
+        try:
+            ftp = await self.connect()
+            while monotonic() < self.deadline:
+                await asyncio.sleep(min(IDLE_NOOP, self.deadline - monotonic()))
+                await ftp.voidcmd("NOOP")
+            await ftp.quit()
+        except Exception as e:
+            self.error(e)
+            if ftp is not None:
+                ftp.close()
+
+    async def run(self, clients, idle):
+        # clients is a range of client numbers, each has its own seed
+        self.deadline = monotonic() + self.args.duration
+        tasks = [ self.idle() for i in range(idle) ]
+        tasks += [ self.client(random.Random(self.args.seed + i)) for i in clients ]
+        await asyncio.gather(*tasks)
+
+
+def drive(port, tree, args, clients, idle, results):
+    # a client process, what it measured goes back through results
+    load = Load(port, tree, args)
+    start = monotonic()
+    asyncio.run(load.run(clients, idle))
+    results.put({ "seconds": monotonic() - start, "latency": load.latency, "ops": load.ops, \
+        "errors": load.errors, "bytes": load.bytes })
+
+
+def merge(measured):
+    total = { "seconds": 0, "latency": {}, "ops": {}, "errors": {}, "bytes": 0 }
+    for part in measured:
+        total["seconds"] = max(total["seconds"], part["seconds"])
+        total["bytes"] += part["bytes"]
+        for key in ("latency", "ops", "errors"):
+            for name, value in part[key].items():
+                total[key][name] = total[key].get(name, [] if key == "latency" else 0) + value
+    return total
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv):
+    args = parseArgs(argv)
+    rng = random.Random(args.seed)
+    sharedDir = mkdtemp()
+    context = get_context("fork")
+    ready, stopped = context.Event(), context.Event()
+    proc = None
+    try:
+        tree = makeTree(sharedDir, args, rng)
+        port = freePort()
+        # forked before the clients start their loop; not a daemon, prefork
+        # workers are its children
+        proc = context.Process(target=serve, args=(sharedDir, port, args, ready, stopped))
+        proc.start()
+        if not ready.wait(STOP_TIMEOUT):
+            print ("server did not start", file=sys.stderr)
+            return 1
+        # prefork workers are up once the port answers
+        asyncio.run(Load(port, tree, args).probe())
+        serverProcs = processes(proc.pid)
+        before = { pid: usage(pid) for pid in serverProcs }
+        results = context.Queue()
+        drivers = []
+        count = max(1, args.clientProcs)
+        for i in range(count):
+            clients = range(args.clients * i // count, args.clients * (i + 1) // count)
+            idle = args.idle * (i + 1) // count - args.idle * i // count
+            drivers.append(context.Process(target=drive, args=(port, tree, args, clients, idle, results)))
+        for driver in drivers:
+            driver.start()
+        measured = merge([ results.get() for driver in drivers ])
+        for driver in drivers:
+            driver.join()
+        clientUsage = getrusage(RUSAGE_CHILDREN)
+        elapsed = measured["seconds"]
+        perProcess = []
+        for pid, role in sorted(serverProcs.items()):
+            after = usage(pid)
+            if after is None or before[pid] is None:
+                continue
+            perProcess.append({ "pid": pid, "role": role, "cpuSeconds": round(after[0] - before[pid][0], 3), \
+                "rssMB": round(after[1], 1), "peakRssMB": round(after[2], 1) })
+        stopped.set()
+        proc.join(STOP_TIMEOUT)
+        serverCpu = sum(entry["cpuSeconds"] for entry in perProcess)
+        if not perProcess:
+            # no /proc: all the server did, start up included
+            children = getrusage(RUSAGE_CHILDREN)
+            serverCpu = children.ru_utime + children.ru_stime - clientUsage.ru_utime - clientUsage.ru_stime
+        result = {
+            "label": args.label,
+            "time": int(time()),
+            "version": { "commit": commit(), "python": platform.python_version(), "platform": platform.platform() },
+            "config": { "engine": args.engine, "workers": args.workers, "clients": args.clients, "idle": args.idle, \
+                "duration": args.duration, "mix": args.mix, "folders": args.folders, "files": args.files, \
+                "smallKB": args.smallKB, "large": args.large, "largeMB": args.largeMB, "seed": args.seed, \
+                "clientProcs": count },
+            "ops": dict(measured["ops"], errors=sum(measured["errors"].values())),
+            "errors": measured["errors"],
+            "throughput": { "seconds": round(elapsed, 3), "bytes": measured["bytes"], \
+                "MBps": round(measured["bytes"] / MB / elapsed, 2), \
+                "opsPerSecond": round(sum(measured["ops"].values()) / elapsed, 1) },
+            "latencyMs": { name: percentiles(samples) for name, samples in measured["latency"].items() },
+            "server": { "cpuSeconds": round(serverCpu, 3), \
+                "cpuSecondsPerGB": round(serverCpu / (measured["bytes"] / GB), 3) if measured["bytes"] else None, \
+                "processes": perProcess },
+            # a busy client side skews everything above: client CPU seconds
+            # close to clientProcs times the duration mean more client
+            # processes are needed
+            "client": { "cpuSeconds": round(clientUsage.ru_utime + clientUsage.ru_stime, 3) }
+        }
+        output = json.dumps(result, indent=1)
+        if args.output:
+            with open(args.output, "w") as file:
+                file.write(output + "\n")
+        else:
+            print (output)
+        return 0 if not measured["errors"] else 2
+    finally:
+        stopped.set()
+        if proc is not None and proc.is_alive():
+            proc.join(STOP_TIMEOUT)
+            proc.terminate()
+        rmtree(sharedDir)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
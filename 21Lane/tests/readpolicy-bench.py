@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+
+# loopback benchmark: what serving one big file does to the page cache,
+# with and without the read policy (readPolicy.py)
+# run from the 21Lane directory:
+#   python3 tests/readpolicy-bench.py [sizeMB] [workingSetMB]
+# for memory pressure make sizeMB bigger than the free memory, or run it
+# in a memory limited cgroup:
+#   systemd-run --user --scope -p MemoryMax=512M python3 tests/readpolicy-bench.py 2048 256
+
+import sys
+sys.path.insert(0, '.')
+
+from server import CustomHandler, ThrottledSendfileDTPHandler
+from readPolicy import ReadPolicy
+from pyftpdlib.servers import FTPServer
+from pyftpdlib.authorizers import DummyAuthorizer
+
+import os
+import mmap
+import ctypes
+from ftplib import FTP
+from tempfile import mkdtemp
+from threading import Thread
+from time import thread_time, monotonic
+from os.path import join, getsize
+from shutil import rmtree
+
+MB = 1048576
+READAHEAD = 8 * MB
+
+sizeMB = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+workingSetMB = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+libc = ctypes.CDLL(None, use_errno=True)
+
+
+def cachedMB(path):
+    # how much of the file is in the page cache, by mincore()
+    size = getsize(path)
+    pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    vec = (ctypes.c_ubyte * pages)()
+    with open(path, "rb") as file:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+        buf = (ctypes.c_char * size).from_buffer(mapping)
+        libc.mincore(ctypes.c_void_p(ctypes.addressof(buf)), ctypes.c_size_t(size), vec)
+        del buf
+        mapping.close()
+    return sum(page & 1 for page in vec) * mmap.PAGESIZE / MB
+
+
+def evict(path):
+    with open(path, "rb") as file:
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def readAll(path):
+    start = monotonic()
+    with open(path, "rb") as file:
+        while file.read(MB):
+            pass
+    return getsize(path) / MB / (monotonic() - start)
+
+
+def writeFile(path, size):
+    with open(path, "wb") as file:
+        chunk = os.urandom(min(size, MB))
+        for i in range(size // len(chunk)):
+            file.write(chunk)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def serve(sharedDir, policy, names):
+    # (MB/s, server CPU seconds) for fetching names one after the other
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(sharedDir)
+    dtp_handler = type("BenchDTPHandler", (ThrottledSendfileDTPHandler,), { "readPolicy": policy })
+    handler = type("BenchHandler", (CustomHandler,), {})
+    handler.authorizer = authorizer
+    handler.dtp_handler = dtp_handler
+    server = FTPServer(('127.0.0.1', 0), handler)
+    port = server.address[1]
+    cpu = {}
+
+    def loop():
+        start = thread_time()
+        server.serve_forever(timeout=0.1, handle_exit=False)
+        cpu["server"] = thread_time() - start
+
+    th = Thread(target=loop)
+    th.start()
+    received = [0]
+    def sink(data):
+        received[0] += len(data)
+    ftp = FTP()
+    ftp.connect('127.0.0.1', port)
+    ftp.login()
+    start = monotonic()
+    for name in names:
+        ftp.retrbinary("RETR /" + name, sink, blocksize=MB)
+    elapsed = monotonic() - start
+    ftp.quit()
+    server.close_all()
+    th.join()
+    return received[0] / MB / elapsed, cpu["server"]
+
+
+def bigFile(sharedDir, workingSet, label, policy):
+    blob = join(sharedDir, "blob")
+    evict(blob)
+    readAll(workingSet)
+    rate, cpu = serve(sharedDir, policy, ["blob"])
+    blobCached, workingCached = cachedMB(blob), cachedMB(workingSet)
+    print("%-26s %8.1f MB/s  %7.1f MB of the file cached  %6.1f/%d MB working set cached, rereads at %.0f MB/s" % \
+        (label, rate, blobCached, workingCached, workingSetMB, readAll(workingSet)))
+
+
+# not in /tmp, which is often tmpfs and has no page cache to speak of
+sharedDir = mkdtemp(dir=".")
+workingSet = join(mkdtemp(dir="."), "workingset")
+try:
+    print ("serving", sizeMB, "MB with a", workingSetMB, "MB working set")
+    writeFile(join(sharedDir, "blob"), sizeMB * MB)
+    writeFile(workingSet, workingSetMB * MB)
+    bigFile(sharedDir, workingSet, "no policy", ReadPolicy(0, 0))
+    bigFile(sharedDir, workingSet, "readahead", ReadPolicy(0, READAHEAD))
+    dropBehind = min(ReadPolicy().dropBehind, sizeMB * MB)
+    bigFile(sharedDir, workingSet, "drop behind", ReadPolicy(dropBehind, 0))
+    bigFile(sharedDir, workingSet, "readahead + drop behind", ReadPolicy(dropBehind, READAHEAD))
+finally:
+    rmtree(sharedDir)
+    rmtree(os.path.dirname(workingSet))
@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+
+# starts, lists, stops and starts again every engine, the second listing
+# must work as well as the first
+# run from the 21Lane directory: python3 tests/restart-test.py [port]
+
+import sys
+sys.path.insert(0, '.')
+
+from server import *
+from config import Settings
+from ftplib import FTP
+from tempfile import mkdtemp
+from time import sleep
+
+p = int(sys.argv[1]) if len(sys.argv) > 1 else 24111
+sharedDir = mkdtemp()
+open(sharedDir + "/a.txt", "w").write("a")
+
+failed = False
+for engine in ENGINES:
+    s = Server()
+    s.setPort(p)
+    s.setSharedDirectory(sharedDir)
+    s.applySettings(dict(Settings.configDic, serverEngine=engine, serverWorkers=2, listingCacheMB=0, \
+        hashCacheFile="", manifestFile="", indexFile="", httpPort=0, metricsPort=0))
+    for run in (1, 2):
+        s.start()
+        sleep(0.5)
+        try:
+            ftp = FTP()
+            ftp.connect("127.0.0.1", p, timeout=5)
+            ftp.login()
+            names = ftp.nlst()
+            ftp.quit()
+            print (engine, "run", run, "lists", names)
+        except Exception as e:
+            print (engine, "run", run, "FAILED", repr(e))
+            failed = True
+        s.stopServer()
+        sleep(0.2)
+
+print ("FAILED" if failed else "ok")
+sys.exit(1 if failed else 0)
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+# loopback benchmark: server CPU time per GB for pyftpdlib's
+# ThrottledDTPHandler vs. our sendfile() keeping handler
+# run from the 21Lane directory: python3 tests/sendfile-bench.py [sizeMB] [limitMB/s]
+
+import sys
+sys.path.insert(0, '.')
+
+from server import ThrottledSendfileDTPHandler
+from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
+from pyftpdlib.servers import FTPServer
+from pyftpdlib.authorizers import DummyAuthorizer
+
+from ftplib import FTP
+from tempfile import mkdtemp
+from threading import Thread
+from time import thread_time, monotonic
+from os.path import join
+from shutil import rmtree
+
+MB = 1048576
+GB = 1073741824
+
+sizeMB = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+limit = int(sys.argv[2]) * MB if len(sys.argv) > 2 else 400 * MB
+
+
+def bench(dtp_handler, sharedDir):
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(sharedDir)
+    handler = type("BenchHandler", (FTPHandler,), {})
+    handler.authorizer = authorizer
+    handler.dtp_handler = dtp_handler
+    if hasattr(dtp_handler, "governor"):
+        dtp_handler.governor.setRate(limit)
+    else:
+        dtp_handler.write_limit = limit
+    server = FTPServer(('127.0.0.1', 0), handler)
+    port = server.address[1]
+    cpu = {}
+
+    def serve():
+        start = thread_time()
+        server.serve_forever(timeout=0.1, handle_exit=False)
+        cpu["server"] = thread_time() - start
+
+    th = Thread(target=serve)
+    th.start()
+    received = [0]
+    def sink(data):
+        received[0] += len(data)
+    ftp = FTP()
+    ftp.connect('127.0.0.1', port)
+    ftp.login()
+    start = monotonic()
+    ftp.retrbinary("RETR /blob", sink, blocksize=MB)
+    elapsed = monotonic() - start
+    ftp.quit()
+    server.close_all()
+    th.join()
+    gb = received[0] / GB
+    print("%-30s %8.1f MB/s  %6.2f server CPU s/GB" % \
+        (dtp_handler.__name__, received[0] / MB / elapsed, cpu["server"] / gb))
+
+
+sharedDir = mkdtemp()
+try:
+    with open(join(sharedDir, "blob"), "wb") as file:
+        chunk = b"\0" * MB
+        for i in range(sizeMB):
+            file.write(chunk)
+    print ("serving", sizeMB, "MB at", limit // MB, "MB/s")
+    bench(ThrottledDTPHandler, sharedDir)
+    bench(ThrottledSendfileDTPHandler, sharedDir)
+finally:
+    rmtree(sharedDir)
@@ -1,26 +1,33 @@
-#!/usr/bin/python3 
+#!/usr/bin/python3
+
+# starts and stops Server, checks that the port is let go
+# run from the 21Lane directory: python3 tests/server-test.py [port] [sharedDir]
+
+import sys
+sys.path.insert(0, '.')
 
 from server import *
 from time import sleep
+from tempfile import mkdtemp
+
+p = int(sys.argv[1]) if len(sys.argv) > 1 else 2121
+sharedDir = sys.argv[2] if len(sys.argv) > 2 else mkdtemp()
 
 s = Server()
-p = int(input("Enter port : "))
-print ("port %d is available " % (p))
 s.setPort(p)
-s.setSharedDirectory("/home/himanshu")
-s.setBandwidth(20)
-s.startServer()
+print ("port %d is available " % (p))
+s.setSharedDirectory(sharedDir)
+s.setBandwidth(20 * 1048576)
+s.start()
 
 i = 0
 while i < 5:
     sleep(0.5)
-    print ("t=", i*0.5, "server is alive", s.server_proc.is_alive())
+    print ("t=", i*0.5, "server is alive", s.isRunning())
     i += 1
 
 print ("port", p, "is available", isPortAvailable(p))
 print ("stopping server")
 s.stopServer()
-print ("server is alive", s.server_proc.is_alive())
+print ("server is alive", s.isRunning())
 print ("port", p, "is available", isPortAvailable(p))
-
-
@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+
+# byte counters fed by the data channels, sampled into a ring buffer so
+# that throughput can be shown while transfers are still running
+
+from collections import deque
+from threading import Lock
+from time import monotonic
+
+SAMPLE_INTERVAL = 1 # seconds
+HISTORY_LENGTH = 300 # samples kept, 5 minutes at one per second
+RATE_WINDOW = 5 # samples averaged for the bytes/sec readout
+
+
+class TransferMeter:
+    def __init__(self, history=HISTORY_LENGTH):
+        self.lock = Lock()
+        self.totalBytes = 0
+        # (timestamp, totalBytes) pairs, oldest first
+        self.samples = deque(maxlen=history)
+
+    def add(self, amount):
+        with self.lock:
+            self.totalBytes += amount
+
+    def sample(self):
+        with self.lock:
+            self.samples.append((monotonic(), self.totalBytes))
+            return self.totalBytes, self._rate(RATE_WINDOW)
+
+    def rate(self, window=RATE_WINDOW):
+        with self.lock:
+            return self._rate(window)
+
+    def _rate(self, window):
+        if len(self.samples) < 2:
+            return 0
+        window = min(window, len(self.samples) - 1)
+        then, before = self.samples[-1 - window]
+        now, after = self.samples[-1]
+        if now <= then:
+            return 0
+        return int((after - before) / (now - then))
+
+    def history(self):
+        with self.lock:
+            return list(self.samples)